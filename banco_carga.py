@@ -0,0 +1,668 @@
+"""Banco de carga de Valencia RP.
+
+Reproduce comandos de barra contra un Discord falso (Interaction, Member y
+Guild de mentira) para medir las rutas calientes de economía y multas sin
+conexión a Discord. Corre en un directorio temporal, así que nunca toca la
+carpeta data/ real.
+
+Uso:
+    python banco_carga.py                      # carga por defecto (50k cuentas, 200k multas)
+    python banco_carga.py --cuentas 5000 --multas 20000 --p99-max 50
+    python banco_carga.py --repetir carga.jsonl --json resultado.json
+    python banco_carga.py --cuentas 5000 --transferencias 6000 --procesos 1,2,4
+
+Escenarios:
+    dinero-dar     ráfagas de transferencias concurrentes entre cuentas
+    top            /top con todas las cuentas sembradas
+    pagar-multas   pagos de multas al azar sobre todas las multas sembradas
+    prestamos      ticks del planificador de préstamos con todos vencidos
+
+Con --repetir se reproduce un fichero JSONL con una invocación por línea:
+    {"comando": "dinero-dar", "usuario": 1001, "args": {"usuario": 1002, "cantidad": 5, "tipo": "bancario"}}
+Los parámetros de tipo usuario se pasan como id y los de opciones como su valor.
+
+Informa de rendimiento (ops/s), latencia p50/p99 y retraso del bucle de
+eventos por escenario. Sale con código 1 si se rompe una invariante (dinero
+creado o destruido, multas mal cobradas, interacciones sin respuesta) o si
+un p99 supera --p99-max, para usarlo como puerta de regresión en CI.
+
+Varios procesos (--procesos): simula un despliegue con shards. Este proceso
+corre el servicio de estado y lanza N procesos trabajadores con
+ALMACENAMIENTO=compartido sobre la misma base; se reparten las
+--transferencias entre cuentas comunes (hay transferencias cruzadas entre
+procesos) y al final el patrimonio total leído de la base debe cuadrar.
+Se informa del total de ops/s y del coste de CPU por operación de los
+trabajadores y del servicio. Resultado en una máquina de 1 CPU (5000
+cuentas, 6000 transferencias, ráfagas de 50):
+
+    latencia-red  procesos   ops/s   CPU trabajador   CPU servicio
+        0 ms          1      1593      0.54 ms/op      0.05 ms/op
+        0 ms          2      1252      0.67 ms/op      0.06 ms/op
+        0 ms          4      1096      0.72 ms/op      0.06 ms/op
+       50 ms          1       547      0.62 ms/op      0.06 ms/op
+       50 ms          2       808      0.67 ms/op      0.06 ms/op
+       50 ms          4       994      0.80 ms/op      0.06 ms/op
+
+Con una sola CPU los procesos se reparten el mismo núcleo: sin latencia el
+total no puede crecer, y con 50 ms por envío crece hasta llenarlo. Con un
+núcleo por proceso el límite lo marcan el servicio (~0.06 ms/op, unas
+15 000 ops/s) y las escrituras de SQLite, que son de una en una.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import types
+
+RAIZ = os.path.dirname(os.path.abspath(__file__))
+GUILD_ID = 1_000_000_000_000_000_001
+UID_BASE = 2_000_000_000_000_000_000
+
+rp = None  # el módulo main, importado ya dentro del directorio temporal
+
+
+# =====================
+# DISCORD FALSO
+# =====================
+class AvatarFalso:
+    url = "https://cdn.discordapp.com/embed/avatars/0.png"
+
+
+def clases_falsas(discord):
+    """Clases falsas; heredan de las de discord.py para pasar los isinstance"""
+
+    class MiembroFalso(discord.Member):
+        def __init__(self, uid: int, gremio):
+            self._uid = uid
+            self._gremio = gremio
+
+        id = property(lambda self: self._uid)
+        name = property(lambda self: f"usuario{self._uid}")
+        display_name = property(lambda self: f"Usuario {self._uid % 100000}")
+        mention = property(lambda self: f"<@{self._uid}>")
+        display_avatar = property(lambda self: AvatarFalso())
+        guild = property(lambda self: self._gremio)
+        roles = property(lambda self: [])
+        bot = property(lambda self: False)
+
+        def __repr__(self):
+            return f"<MiembroFalso {self._uid}>"
+
+    class GremioFalso:
+        def __init__(self, gid: int):
+            self.id = gid
+            self.name = "Valencia RP (banco de carga)"
+            self.icon = None
+            self._miembros = {}
+
+        def get_member(self, uid: int):
+            miembro = self._miembros.get(uid)
+            if miembro is None:
+                miembro = self._miembros[uid] = MiembroFalso(uid, self)
+            return miembro
+
+        def get_role(self, rid):
+            return None
+
+        def get_channel(self, cid):
+            return None
+
+    class SeguimientoFalso:
+        def __init__(self, interaccion):
+            self._interaccion = interaccion
+
+        async def send(self, content=None, **kwargs):
+            await self._interaccion._entregar("followup", content, kwargs)
+
+    class RespuestaFalsa:
+        """Imita InteractionResponse: primera respuesta y luego followup"""
+
+        def __init__(self, interaccion):
+            self._parent = interaccion
+            self._hecha = False
+
+        def is_done(self):
+            return self._hecha
+
+        async def _responder(self, tipo, content, kwargs):
+            if self._hecha:
+                # Igual que la guardia de respuesta: tras el defer automático lo
+                # que llega va por followup; sin él, responder dos veces es un error
+                if tipo != "mensaje" or rp._diferida_por_guardia(self._parent) is None:
+                    raise discord.InteractionResponded(self._parent)
+                return await self._parent.followup.send(content, **kwargs)
+            self._hecha = True
+            await self._parent._entregar(tipo, content, kwargs)
+
+        async def send_message(self, content=None, **kwargs):
+            await self._responder("mensaje", content, kwargs)
+
+        async def defer(self, **kwargs):
+            if self._hecha:
+                if rp._diferida_por_guardia(self._parent) is None:
+                    raise discord.InteractionResponded(self._parent)
+                return
+            self._hecha = True
+            await self._parent._entregar("defer", None, kwargs)
+
+        async def edit_message(self, content=None, **kwargs):
+            await self._responder("edicion", content, kwargs)
+
+        async def send_modal(self, modal):
+            await self._responder("modal", None, {"modal": modal})
+
+    class InteraccionFalsa(discord.Interaction):
+        def __init__(self, usuario, gremio, latencia_red: float):
+            self.id = rp.discord.utils.time_snowflake(rp.discord.utils.utcnow())
+            self.extras = {}
+            self._usuario = usuario
+            self._gremio = gremio
+            self._latencia = latencia_red
+            self._respuesta = RespuestaFalsa(self)
+            self._seguimiento = SeguimientoFalso(self)
+            self.entregas = []
+
+        user = property(lambda self: self._usuario)
+        guild = property(lambda self: self._gremio)
+        guild_id = property(lambda self: self._gremio.id)
+        channel = property(lambda self: None)
+        response = property(lambda self: self._respuesta)
+        followup = property(lambda self: self._seguimiento)
+        command = property(lambda self: None)
+
+        async def _entregar(self, tipo, content, kwargs):
+            # Serializar como lo haría discord.py al enviar
+            for embed in [kwargs.get("embed")] + list(kwargs.get("embeds") or []):
+                if embed is not None:
+                    embed.to_dict()
+            if self._latencia:
+                await asyncio.sleep(self._latencia)
+            self.entregas.append((tipo, content, kwargs))
+
+    # Las respuestas falsas cuentan para las métricas igual que las reales
+    for nombre in ("send_message", "defer", "edit_message", "send_modal"):
+        setattr(RespuestaFalsa, nombre, rp._marcar_respuesta(getattr(RespuestaFalsa, nombre)))
+
+    return types.SimpleNamespace(
+        Miembro=MiembroFalso, Gremio=GremioFalso, Interaccion=InteraccionFalsa
+    )
+
+
+# =====================
+# PREPARACIÓN
+# =====================
+def importar_bot(almacenamiento: str, directorio: str = None, **entorno):
+    """Importa main.py en un directorio temporal, sin token ni servidor web"""
+    global rp
+    directorio = directorio or tempfile.mkdtemp(prefix="banco_carga_")
+    os.chdir(directorio)
+    os.environ.pop("DISCORD_TOKEN", None)
+    os.environ.update({
+        "ALMACENAMIENTO": almacenamiento,
+        "METRICAS_PUERTO": "0",
+        "PRECARGA": "0",
+        "INTERVALO_COPIAS": "0",
+        **entorno,
+    })
+    # keep_alive arranca el servidor web de Replit: aquí no hace falta
+    sys.modules.setdefault("keep_alive", types.SimpleNamespace(keep_alive=lambda: None))
+    sys.path.insert(0, RAIZ)
+    import main
+    rp = main
+    return directorio
+
+
+def sembrar(azar: random.Random, n_cuentas: int, n_multas: int, n_prestamos: int) -> dict:
+    """Escribe las tiendas iniciales con el almacenamiento configurado"""
+    uids = [str(UID_BASE + i) for i in range(n_cuentas)]
+    cuentas = {
+        uid: {
+            "banco": azar.choice(list(rp.BANCOS_VALENCIA) or ["Banco"]),
+            "tarjeta": azar.randint(1_000, 1_000_000),
+            "efectivo": azar.randint(0, 50_000),
+            "fecha_creacion": "2025-01-01",
+            "creado_por": "banco_carga",
+        }
+        for uid in uids
+    }
+    cp = rp.codigo_penal.version_actual()
+    articulos = list(rp.CODIGO_PENAL)
+    multas, codigos = {}, []
+    for i in range(n_multas):
+        uid = uids[azar.randrange(n_cuentas)]
+        codigo = f"BC{i:07d}"
+        arts = azar.sample(articulos, k=min(2, len(articulos)))
+        multas.setdefault(uid, []).append({
+            "codigo": codigo,
+            "agente": "Agente de pruebas",
+            "articulos": arts,
+            "cp": cp,
+            "total": sum(rp.CODIGO_PENAL[a]["precio"] for a in arts),
+            "fecha": "2025-01-01",
+        })
+        codigos.append(codigo)
+    prestamos = {}
+    for uid in azar.sample(uids, k=min(n_prestamos, n_cuentas)):
+        cantidad = azar.randint(1_000, 50_000)
+        prestamos[uid] = {
+            "cantidad": cantidad, "restante": cantidad, "fecha": "2025-01-01",
+            "meses": 1, "dias_totales": 30, "cuota_diaria": max(1, cantidad // 30),
+            "ultimo_descuento": None, "proximo_cobro": 0,
+        }
+    # Por data[key] y save_json, para que valga igual con JSON que con SQLite
+    for key, valor in (("cuentas", cuentas), ("multas", multas), ("prestamos", prestamos)):
+        tienda = rp.data[key]
+        for uid, registro in valor.items():
+            tienda[uid] = rp.tipar_registro(key, registro)
+        rp.save_json(key)
+    return {"uids": uids, "codigos": codigos}
+
+
+def patrimonio_total() -> int:
+    return sum(c["tarjeta"] + c["efectivo"] for c in rp.data["cuentas"].values())
+
+
+# =====================
+# EJECUCIÓN
+# =====================
+class MonitorRetraso:
+    """Mide el retraso del bucle de eventos: cuánto tarda en despertar un sleep"""
+
+    def __init__(self, intervalo: float = 0.01):
+        self.intervalo = intervalo
+        self.hist = rp.HistogramaLatencia()
+        self._tarea = None
+
+    async def _bucle(self):
+        while True:
+            inicio = time.perf_counter()
+            await asyncio.sleep(self.intervalo)
+            self.hist.registrar(max(time.perf_counter() - inicio - self.intervalo, 0) * 1000)
+
+    def __enter__(self):
+        self._tarea = asyncio.get_running_loop().create_task(self._bucle())
+        return self
+
+    def __exit__(self, *exc):
+        self._tarea.cancel()
+
+
+class Banco:
+    def __init__(self, falsos, gremio, latencia_red: float):
+        self.falsos = falsos
+        self.gremio = gremio
+        self.latencia_red = latencia_red
+        self.sin_respuesta = 0
+        self.fallos = 0
+
+    def argumentos(self, comando, args: dict) -> dict:
+        """Convierte los argumentos de una invocación grabada a lo que espera el handler"""
+        opciones = {p.name: p for p in comando.parameters}
+        resultado = {}
+        for nombre, valor in args.items():
+            param = opciones.get(nombre)
+            if param is not None and param.type == rp.discord.AppCommandOptionType.user:
+                valor = self.gremio.get_member(int(valor))
+            elif param is not None and param.choices:
+                valor = next(
+                    (c for c in param.choices if c.value == valor),
+                    rp.app_commands.Choice(name=str(valor), value=valor)
+                )
+            resultado[nombre] = valor
+        return resultado
+
+    async def invocar(self, nombre: str, usuario: int, args: dict, hist):
+        comando = rp.tree.get_command(nombre)
+        if comando is None:
+            raise SystemExit(f"Comando desconocido en la carga: /{nombre}")
+        interaccion = self.falsos.Interaccion(self.gremio.get_member(int(usuario)), self.gremio, self.latencia_red)
+        inicio = time.perf_counter()
+        try:
+            await comando._callback(interaccion, **self.argumentos(comando, args))
+        except Exception as e:
+            self.fallos += 1
+            if self.fallos <= 5:
+                print(f"  ⚠️ /{nombre} falló: {type(e).__name__}: {e}")
+        hist.registrar((time.perf_counter() - inicio) * 1000)
+        if not interaccion.entregas:
+            self.sin_respuesta += 1
+
+    async def reproducir(self, eventos, concurrencia: int) -> tuple:
+        """Lanza los eventos en tandas de `concurrencia`. Devuelve (histograma, segundos)"""
+        hist = rp.HistogramaLatencia()
+        inicio = time.perf_counter()
+        for i in range(0, len(eventos), concurrencia):
+            await asyncio.gather(*(
+                self.invocar(e["comando"], e["usuario"], e.get("args", {}), hist)
+                for e in eventos[i:i + concurrencia]
+            ))
+        return hist, time.perf_counter() - inicio
+
+
+def eventos_dinero_dar(azar, uids, n, cantidad_max=500):
+    eventos = []
+    for _ in range(n):
+        origen, destino = azar.sample(uids, 2)
+        eventos.append({"comando": "dinero-dar", "usuario": int(origen), "args": {
+            "usuario": int(destino),
+            "cantidad": azar.randint(1, cantidad_max),
+            "tipo": azar.choice(["bancario", "efectivo"]),
+        }})
+    return eventos
+
+
+def eventos_pagar_multas(azar, codigos, uids, n):
+    eventos = []
+    for codigo in azar.sample(codigos, k=min(n, len(codigos))):
+        # Se paga de más a propósito: el exceso no se devuelve
+        eventos.append({"comando": "pagar-multas", "usuario": int(azar.choice(uids)),
+                        "args": {"codigo": codigo, "cantidad": 5_000}})
+    return eventos
+
+
+async def escenario_prestamos(hist) -> tuple:
+    """Cobra todos los préstamos vencidos por lotes, como el bucle del planificador"""
+    plan = rp.planificador_prestamos
+    plan.reconstruir()
+    cobrados = 0
+    inicio = time.perf_counter()
+    while True:
+        uids = plan._sacar_vencidos(time.time())
+        if not uids:
+            break
+        t = time.perf_counter()
+        await plan.cobrar(uids)
+        hist.registrar((time.perf_counter() - t) * 1000)
+        cobrados += len(uids)
+    return cobrados, time.perf_counter() - inicio
+
+
+async def ejecutar(opciones) -> dict:
+    azar = random.Random(opciones.semilla)
+    falsos = clases_falsas(rp.discord)
+    t = time.perf_counter()
+    semilla = sembrar(azar, opciones.cuentas, opciones.multas, opciones.prestamos)
+    print(f"🌱 Datos sembrados en {time.perf_counter() - t:.1f}s "
+          f"({opciones.cuentas} cuentas, {opciones.multas} multas, {opciones.prestamos} préstamos)")
+
+    # Lo mismo que hace setup_hook, sin conectarse a Discord
+    rp.escritor.iniciar()
+    rp.instrumentar_comandos(rp.tree)
+    avisos = []
+    rp.notificaciones.encolar = lambda destino, *a, **k: avisos.append(destino)
+
+    banco = Banco(falsos, falsos.Gremio(GUILD_ID), opciones.latencia_red / 1000)
+    uids = semilla["uids"]
+    resultados, errores = {}, []
+
+    def anotar(nombre, ops, segundos, hist, retraso):
+        resultados[nombre] = {
+            "ops": ops,
+            "segundos": round(segundos, 3),
+            "ops_s": round(ops / segundos, 1) if segundos else None,
+            "p50_ms": round(hist.percentil(50), 3),
+            "p99_ms": round(hist.percentil(99), 3),
+            "max_ms": round(hist.maximo, 3),
+            "retraso_bucle_p99_ms": round(retraso.hist.percentil(99), 3),
+            "retraso_bucle_max_ms": round(retraso.hist.maximo, 3),
+        }
+        if opciones.p99_max is not None and hist.percentil(99) > opciones.p99_max:
+            errores.append(f"{nombre}: p99 {hist.percentil(99):.1f} ms > {opciones.p99_max} ms")
+
+    if opciones.repetir:
+        with open(opciones.repetir, encoding="utf-8") as f:
+            eventos = [json.loads(linea) for linea in f if linea.strip()]
+        with MonitorRetraso() as retraso:
+            hist, segundos = await banco.reproducir(eventos, opciones.rafaga)
+        anotar("repetir", len(eventos), segundos, hist, retraso)
+    else:
+        # Primer acceso fuera de la medición: carga perezosa de las tiendas
+        antes = patrimonio_total()
+        len(rp.data["multas"])
+
+        eventos = eventos_dinero_dar(azar, uids, opciones.transferencias)
+        with MonitorRetraso() as retraso:
+            hist, segundos = await banco.reproducir(eventos, opciones.rafaga)
+        anotar("dinero-dar", len(eventos), segundos, hist, retraso)
+        if patrimonio_total() != antes:
+            errores.append(f"dinero-dar: el patrimonio total cambió ({antes} -> {patrimonio_total()})")
+
+        eventos = [{"comando": "top", "usuario": int(azar.choice(uids))} for _ in range(opciones.tops)]
+        with MonitorRetraso() as retraso:
+            hist, segundos = await banco.reproducir(eventos, opciones.rafaga)
+        anotar("top", len(eventos), segundos, hist, retraso)
+
+        multas_antes = sum(len(v) for v in rp.data["multas"].values())
+        antes = patrimonio_total()
+        eventos = eventos_pagar_multas(azar, semilla["codigos"], uids, opciones.pagos)
+        with MonitorRetraso() as retraso:
+            hist, segundos = await banco.reproducir(eventos, opciones.rafaga)
+        anotar("pagar-multas", len(eventos), segundos, hist, retraso)
+        pagadas = multas_antes - sum(len(v) for v in rp.data["multas"].values())
+        if eventos and not pagadas:
+            errores.append("pagar-multas: no se pagó ninguna multa")
+        if antes - patrimonio_total() != pagadas * 5_000:
+            errores.append(f"pagar-multas: {pagadas} multas pagadas pero se cobraron {antes - patrimonio_total()}€")
+
+        hist = rp.HistogramaLatencia()
+        with MonitorRetraso() as retraso:
+            cobrados, segundos = await escenario_prestamos(hist)
+        anotar("prestamos", cobrados, segundos, hist, retraso)
+        resultados["prestamos"]["unidad"] = "préstamos cobrados (latencia por lote)"
+
+    t = time.perf_counter()
+    await rp.escritor.detener()
+    resultados["volcado_final_s"] = round(time.perf_counter() - t, 3)
+
+    if banco.sin_respuesta:
+        errores.append(f"{banco.sin_respuesta} interacciones terminaron sin respuesta")
+    if banco.fallos:
+        errores.append(f"{banco.fallos} invocaciones lanzaron una excepción")
+    resultados["errores"] = errores
+    return resultados
+
+
+# =====================
+# VARIOS PROCESOS (SHARDS)
+# =====================
+# Con --procesos se simula un despliegue con shards: el servicio de estado
+# corre en este proceso y cada trabajador es un proceso aparte que importa
+# main.py con ALMACENAMIENTO=compartido sobre la misma base. Todos reparten
+# /dinero-dar entre las mismas cuentas, así que hay transferencias cruzadas
+# entre procesos, y al final el patrimonio total de la base debe cuadrar.
+def patrimonio_en_base(directorio: str) -> int:
+    """Suma leída directamente de la base compartida, sin cachés de nadie"""
+    import sqlite3
+    conn = sqlite3.connect(os.path.join(directorio, "data", "almacen.db"))
+    try:
+        return sum(c["tarjeta"] + c["efectivo"] for (v,) in conn.execute("SELECT valor FROM cuentas") for c in [json.loads(v)])
+    finally:
+        conn.close()
+
+
+async def trabajador(opciones):
+    """Proceso trabajador: espera la orden de salida, reproduce su parte de
+    /dinero-dar y escribe el resultado como JSON en stdout"""
+    falsos = clases_falsas(rp.discord)
+    rp.cliente_estado.iniciar()
+    await rp.cliente_estado.esperar_conexion(10)
+    rp.escritor.iniciar()
+    rp.instrumentar_comandos(rp.tree)
+    banco = Banco(falsos, falsos.Gremio(GUILD_ID), opciones.latencia_red / 1000)
+    uids = [str(UID_BASE + i) for i in range(opciones.cuentas)]
+    eventos = eventos_dinero_dar(random.Random(opciones.semilla + opciones.trabajador), uids, opciones.transferencias)
+    print("LISTO", flush=True)
+    await asyncio.get_running_loop().run_in_executor(None, sys.stdin.readline)
+    cpu = time.process_time()
+    hist, segundos = await banco.reproducir(eventos, opciones.rafaga)
+    cpu = time.process_time() - cpu
+    await rp.escritor.detener()
+    print("RESULTADO", json.dumps({
+        "ops": len(eventos),
+        "segundos": segundos,
+        "p50_ms": hist.percentil(50),
+        "p99_ms": hist.percentil(99),
+        "cpu_s": cpu,
+        "fallos": banco.fallos,
+        "sin_respuesta": banco.sin_respuesta,
+        "cambios_recibidos": rp.cliente_estado.cambios_recibidos,
+    }), flush=True)
+
+
+async def ronda_procesos(opciones, directorio: str, puerto: int, n: int, servicio) -> tuple:
+    """Lanza `n` trabajadores con el total de transferencias repartido entre ellos"""
+    entorno = dict(os.environ, ESTADO_PUERTO=str(puerto))
+    base = opciones.transferencias // n
+    procesos = []
+    for k in range(n):
+        procesos.append(await asyncio.create_subprocess_exec(
+            sys.executable, os.path.join(RAIZ, "banco_carga.py"),
+            "--trabajador", str(k), "--directorio", directorio,
+            "--cuentas", str(opciones.cuentas), "--semilla", str(opciones.semilla + 1000 * n),
+            "--transferencias", str(base + (1 if k < opciones.transferencias % n else 0)),
+            "--rafaga", str(opciones.rafaga), "--latencia-red", str(opciones.latencia_red),
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, env=entorno,
+        ))
+    for proceso in procesos:
+        # Lo que main.py imprime al importarse va antes de LISTO
+        linea = b"-"
+        while linea and linea.strip() != b"LISTO":
+            linea = await proceso.stdout.readline()
+        if not linea:
+            raise SystemExit("Un trabajador no arrancó")
+    antes = patrimonio_en_base(directorio)
+    concedidos = servicio.concedidos
+    cpu = time.process_time()
+    inicio = time.perf_counter()
+    for proceso in procesos:
+        proceso.stdin.write(b"ya\n")
+    resultados = []
+    for k, proceso in enumerate(procesos):
+        while True:
+            linea = (await proceso.stdout.readline()).decode()
+            if not linea or linea.startswith("RESULTADO "):
+                break
+            print(f"  [{k}] {linea.rstrip()}")
+        await proceso.wait()
+        if not linea:
+            raise SystemExit(f"El trabajador {k} terminó sin resultado (código {proceso.returncode})")
+        resultados.append(json.loads(linea[len("RESULTADO "):]))
+    segundos = time.perf_counter() - inicio
+    ops = sum(r["ops"] for r in resultados)
+    ronda = {
+        "procesos": n,
+        "ops": ops,
+        "segundos": round(segundos, 3),
+        "ops_s": round(ops / segundos, 1),
+        "ops_s_por_proceso": round(ops / segundos / n, 1),
+        "p50_ms": round(max(r["p50_ms"] for r in resultados), 3),
+        "p99_ms": round(max(r["p99_ms"] for r in resultados), 3),
+        "cpu_trabajador_ms_op": round(sum(r["cpu_s"] for r in resultados) / ops * 1000, 3),
+        "cpu_servicio_ms_op": round((time.process_time() - cpu) / ops * 1000, 3),
+        "bloqueos": servicio.concedidos - concedidos,
+    }
+    errores = []
+    despues = patrimonio_en_base(directorio)
+    if despues != antes:
+        errores.append(f"{n} procesos: el patrimonio total cambió ({antes} -> {despues})")
+    for r in resultados:
+        if r["fallos"] or r["sin_respuesta"]:
+            errores.append(f"{n} procesos: {r['fallos']} fallos y {r['sin_respuesta']} interacciones sin respuesta")
+    return ronda, errores
+
+
+async def ejecutar_procesos(opciones, directorio: str) -> dict:
+    azar = random.Random(opciones.semilla)
+    t = time.perf_counter()
+    sembrar(azar, opciones.cuentas, 0, 0)
+    print(f"🌱 {opciones.cuentas} cuentas sembradas en {time.perf_counter() - t:.1f}s")
+    servicio = rp.ServicioEstado("127.0.0.1", 0)
+    await servicio.iniciar()
+    puerto = servicio._servidor.sockets[0].getsockname()[1]
+    print(f"🔒 Servicio de estado en 127.0.0.1:{puerto}; {os.cpu_count()} CPU")
+    rondas, errores = [], []
+    try:
+        for n in opciones.procesos:
+            ronda, fallos = await ronda_procesos(opciones, directorio, puerto, n, servicio)
+            rondas.append(ronda)
+            errores.extend(fallos)
+    finally:
+        await servicio.detener()
+    return {"rondas": rondas, "errores": errores}
+
+
+def imprimir_procesos(resultados: dict):
+    print(f"\n{'procesos':>8}{'ops':>8}{'ops/s':>10}{'ops/s/proc':>12}{'p50 ms':>9}{'p99 ms':>9}{'CPU trab ms/op':>16}{'CPU serv ms/op':>16}")
+    for r in resultados["rondas"]:
+        print(f"{r['procesos']:>8}{r['ops']:>8}{r['ops_s']:>10.1f}{r['ops_s_por_proceso']:>12.1f}{r['p50_ms']:>9.2f}"
+              f"{r['p99_ms']:>9.2f}{r['cpu_trabajador_ms_op']:>16.3f}{r['cpu_servicio_ms_op']:>16.3f}")
+    for error in resultados["errores"]:
+        print(f"❌ {error}")
+    if not resultados["errores"]:
+        print("✅ Invariantes correctas (patrimonio total intacto en la base compartida)")
+
+
+def imprimir(resultados: dict):
+    print(f"\n{'escenario':<14}{'ops':>8}{'ops/s':>11}{'p50 ms':>10}{'p99 ms':>10}{'máx ms':>10}{'bucle p99':>11}{'bucle máx':>11}")
+    for nombre, r in resultados.items():
+        if not isinstance(r, dict):
+            continue
+        print(f"{nombre:<14}{r['ops']:>8}{r['ops_s'] or 0:>11.1f}{r['p50_ms']:>10.2f}{r['p99_ms']:>10.2f}"
+              f"{r['max_ms']:>10.2f}{r['retraso_bucle_p99_ms']:>11.2f}{r['retraso_bucle_max_ms']:>11.2f}")
+    print(f"\n💾 Volcado final del escritor: {resultados['volcado_final_s']}s")
+    for error in resultados["errores"]:
+        print(f"❌ {error}")
+    if not resultados["errores"]:
+        print("✅ Invariantes correctas")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Banco de carga offline de los comandos de Valencia RP")
+    parser.add_argument("--cuentas", type=int, default=50_000)
+    parser.add_argument("--multas", type=int, default=200_000)
+    parser.add_argument("--prestamos", type=int, default=5_000)
+    parser.add_argument("--transferencias", type=int, default=5_000, help="invocaciones de /dinero-dar")
+    parser.add_argument("--tops", type=int, default=500, help="invocaciones de /top")
+    parser.add_argument("--pagos", type=int, default=5_000, help="invocaciones de /pagar-multas")
+    parser.add_argument("--rafaga", type=int, default=50, help="invocaciones concurrentes por tanda")
+    parser.add_argument("--latencia-red", type=float, default=0.0, help="ms simulados por envío a Discord")
+    parser.add_argument("--almacenamiento", choices=["json", "sqlite"], default="json")
+    parser.add_argument("--procesos", type=lambda v: [int(n) for n in v.split(",")],
+                        help="rondas de /dinero-dar con N procesos sobre la base compartida (p. ej. 1,2,4)")
+    parser.add_argument("--trabajador", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--directorio", help=argparse.SUPPRESS)
+    parser.add_argument("--semilla", type=int, default=1234)
+    parser.add_argument("--repetir", help="JSONL con invocaciones grabadas a reproducir")
+    parser.add_argument("--p99-max", type=float, default=None, help="falla si algún p99 (ms) lo supera")
+    parser.add_argument("--json", help="guardar los resultados en este fichero")
+    opciones = parser.parse_args()
+    if opciones.repetir:
+        opciones.repetir = os.path.abspath(opciones.repetir)
+    salida = os.path.abspath(opciones.json) if opciones.json else None
+
+    if opciones.trabajador is not None:
+        importar_bot("compartido", opciones.directorio, PROCESO=f"banco-{opciones.trabajador}")
+        asyncio.run(trabajador(opciones))
+        return
+    if opciones.procesos:
+        directorio = importar_bot("compartido", PROCESO="banco")
+        print(f"📁 Directorio de trabajo: {directorio}")
+        resultados = asyncio.run(ejecutar_procesos(opciones, directorio))
+        imprimir_procesos(resultados)
+    else:
+        directorio = importar_bot(opciones.almacenamiento)
+        print(f"📁 Directorio de trabajo: {directorio}")
+        resultados = asyncio.run(ejecutar(opciones))
+        imprimir(resultados)
+    if salida:
+        with open(salida, "w", encoding="utf-8") as f:
+            json.dump(resultados, f, indent=2, ensure_ascii=False)
+    sys.exit(1 if resultados["errores"] else 0)
+
+
+if __name__ == "__main__":
+    main()
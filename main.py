@@ -5,7 +5,11 @@ import discord
 from discord import app_commands, Interaction, Embed
 from discord.ui import View, Button, Select, Modal, TextInput  # <-- Añadido Modal y TextInput
 from discord.ext import commands
-import os, json, random, string, asyncio, datetime, time
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor
+import os, sys, json, random, string, asyncio, datetime, collections, time, logging, sqlite3, copy, contextlib, weakref, bisect, heapq, hashlib, gzip, shutil, functools, contextvars, threading, traceback, logging.handlers
+
+INICIO_PROCESO = time.perf_counter()  # para el informe de arranque
 
 # =====================
 # CONFIGURACIÓN CENTRALIZADA
@@ -26,6 +30,61 @@ class Config:
     CANAL_SOLICITUDES = 1415652632231677982
     CANAL_LOGS = None  # Se configurará dinámicamente
     
+    # Solicitudes de DNI y multas (valores por defecto; cada servidor puede
+    # cambiarlos en data/config/servidores/<id>.json)
+    CANAL_REVISION_DNI = 1415316625397387318
+    ROL_REVISION_DNI = 1416126180888674374
+    ROL_POLICIA_MULTAS_ID = 1401538045567565877
+    
+    # Varios servidores en un proceso: con MULTISERVIDOR cada servidor guarda
+    # sus datos en data/servidores/<id>, salvo SERVIDOR_PRINCIPAL (data/)
+    MULTISERVIDOR = os.getenv("MULTISERVIDOR", "0") == "1"
+    SERVIDOR_PRINCIPAL = int(os.getenv("SERVIDOR_PRINCIPAL", "0")) or None
+
+    # Shards: SHARDS = número total (vacío = el que recomiende Discord) y
+    # SHARD_IDS = los que atiende este proceso ("0,1"; vacío = todos). Varios
+    # procesos comparten datos con ALMACENAMIENTO = "compartido" y el servicio
+    # de estado (python main.py servicio-estado) en ESTADO_HOST:ESTADO_PUERTO
+    SHARDS = int(os.getenv("SHARDS", "0")) or None
+    SHARD_IDS = [int(s) for s in os.getenv("SHARD_IDS", "").split(",") if s.strip()] or None
+    PROCESO = os.getenv("PROCESO") or "shards-" + "-".join(map(str, SHARD_IDS or [0]))
+    COORDINADOR = SHARD_IDS is None or 0 in SHARD_IDS  # sincroniza comandos y hace las copias
+    ESTADO_HOST = os.getenv("ESTADO_HOST", "127.0.0.1")
+    ESTADO_PUERTO = int(os.getenv("ESTADO_PUERTO", "9470"))
+    ESTADO_ESPERA = float(os.getenv("ESTADO_ESPERA", "5"))  # segundos esperando conexión antes de fallar
+
+    # Persistencia: "json" (instantánea + diario), "sqlite" o "compartido"
+    # (SQLite en WAL compartida por los procesos de los shards)
+    ALMACENAMIENTO = os.getenv("ALMACENAMIENTO", "json")
+    SQLITE_ARCHIVO = os.getenv("SQLITE_ARCHIVO", os.path.join("data", "almacen.db"))
+    INTERVALO_GUARDADO = float(os.getenv("INTERVALO_GUARDADO", "2"))  # segundos entre escrituras
+    UMBRAL_GUARDADO = int(os.getenv("UMBRAL_GUARDADO", "200"))  # registros pendientes que fuerzan escritura
+    HILOS_PERSISTENCIA = int(os.getenv("HILOS_PERSISTENCIA", "2"))  # hilos de E/S compartidos por los servidores
+    PRECARGA = os.getenv("PRECARGA", "1") == "1"  # leer en segundo plano las tiendas tras on_ready
+    
+    # Copias de seguridad (data/backups)
+    INTERVALO_COPIAS = float(os.getenv("INTERVALO_COPIAS", "3600"))  # segundos; 0 = desactivadas
+    COPIAS_HORARIAS = int(os.getenv("COPIAS_HORARIAS", "24"))
+    COPIAS_DIARIAS = int(os.getenv("COPIAS_DIARIAS", "7"))
+    COPIAS_SEMANALES = int(os.getenv("COPIAS_SEMANALES", "4"))
+    
+    # Tareas de fondo
+    PRESTAMOS_LOTE_MAX = int(os.getenv("PRESTAMOS_LOTE_MAX", "500"))  # préstamos cobrados por lote
+    NOTIF_TRABAJADORES = int(os.getenv("NOTIF_TRABAJADORES", "3"))
+    NOTIF_COLA_MAX = int(os.getenv("NOTIF_COLA_MAX", "1000"))  # MD en espera antes de descartar
+    
+    # Métricas de comandos (endpoint Prometheus local; puerto 0 = desactivado).
+    # Con SHARD_IDS cada proceso escucha en METRICAS_PUERTO + su primer shard
+    METRICAS_HOST = os.getenv("METRICAS_HOST", "127.0.0.1")
+    METRICAS_PUERTO = int(os.getenv("METRICAS_PUERTO", "9464"))
+    PRESUPUESTO_RESPUESTA = float(os.getenv("PRESUPUESTO_RESPUESTA", "2"))  # segundos antes del defer automático; 0 = nunca
+    VIGILANTE_INTERVALO = float(os.getenv("VIGILANTE_INTERVALO", "0.1"))  # segundos entre latidos; 0 = sin vigilante
+    UMBRAL_BLOQUEO_MS = float(os.getenv("UMBRAL_BLOQUEO_MS", "250"))  # bucle parado más que esto = bloqueo
+    # Modo debug de asyncio: avisa de cada callback que pase de UMBRAL_BLOQUEO_MS
+    # (a data/bucle_lento.log). Tiene coste en todo el bucle; para diagnosticar
+    VIGILANTE_DEBUG_ASYNCIO = os.getenv("VIGILANTE_DEBUG_ASYNCIO", "0") == "1"
+    PERFIL_MAX_SEGUNDOS = int(os.getenv("PERFIL_MAX_SEGUNDOS", "300"))
+    
     # Configuración de economía
     SALDO_INICIAL_TARJETA = 1200
     SALDO_INICIAL_EFECTIVO = 0
@@ -48,15 +107,40 @@ class Config:
 # Instancia global de configuración
 config = Config()
 
-# Bot con intents completos
+# Bot con intents completos (con shards automáticos; ver SHARDS / SHARD_IDS)
+class BotRP(commands.AutoShardedBot):
+    """Bot que arranca y detiene las tareas de fondo (persistencia, préstamos, MD)"""
+
+    async def setup_hook(self):
+        if config.ALMACENAMIENTO == "compartido":
+            cliente_estado.iniciar()
+        notificaciones.iniciar()
+        # Escritor, préstamos, robos y copias de cada partición abierta (y de
+        # las que se abran después)
+        particiones.iniciar()
+        # Botones de revisión de DNI de solicitudes anteriores al reinicio
+        self.add_dynamic_items(BotonSolicitudDNI, BotonPagina)
+        instrumentar_comandos(self.tree)
+        await servidor_metricas.iniciar()
+        vigilante_bucle.iniciar()
+
+    async def close(self):
+        # Para los servicios de cada partición y vuelca a disco lo pendiente
+        await particiones.detener()
+        await notificaciones.detener()
+        await servidor_metricas.detener()
+        await vigilante_bucle.detener()
+        await cliente_estado.detener()
+        await super().close()
+
 intents = discord.Intents.all()
-bot = commands.Bot(command_prefix="!", intents=intents)
+bot = BotRP(command_prefix="!", intents=intents, shard_count=config.SHARDS, shard_ids=config.SHARD_IDS)
 tree = bot.tree
 
 # Data files (asegura la carpeta data)
 DATA_DIR = "data"
 # Ensure data directory structure exists
-SUBDIRS = ["identity", "economy", "enforcement", "gameplay", "governance", "config", "backups"]
+SUBDIRS = ["identity", "economy", "enforcement", "gameplay", "governance", "config", "backups", "cuarentena", "perfiles", os.path.join("config", "servidores")]
 for subdir in [DATA_DIR] + [os.path.join(DATA_DIR, s) for s in SUBDIRS]:
     if not os.path.exists(subdir):
         os.makedirs(subdir)
@@ -66,6 +150,7 @@ FILES = {
     "dnis": os.path.join(DATA_DIR, "identity", "dnis.json"),
     "carnets": os.path.join(DATA_DIR, "identity", "carnets.json"),
     "oposiciones": os.path.join(DATA_DIR, "identity", "oposiciones.json"),
+    "solicitudes_dni": os.path.join(DATA_DIR, "identity", "solicitudes_dni.json"),
     
     # Economic System
     "cuentas": os.path.join(DATA_DIR, "economy", "cuentas.json"),
@@ -76,6 +161,8 @@ FILES = {
     "multas": os.path.join(DATA_DIR, "enforcement", "multas.json"),
     "sanciones": os.path.join(DATA_DIR, "enforcement", "sanciones.json"),
     "incautaciones": os.path.join(DATA_DIR, "enforcement", "incautaciones.json"),
+    "confirmaciones_robo": os.path.join(DATA_DIR, "enforcement", "confirmaciones_robo.json"),
+    "codigo_penal": os.path.join(DATA_DIR, "enforcement", "codigo_penal.json"),
     
     # Gameplay & Items
     "inventario": os.path.join(DATA_DIR, "gameplay", "inventario.json"),
@@ -90,83 +177,3020 @@ FILES = {
     "alertas": os.path.join(DATA_DIR, "config", "alertas.json")
 }
 
-data = {}
-for k, path in FILES.items():
+# =====================
+# REGISTROS TIPADOS
+# =====================
+# Cuentas, préstamos, multas y sanciones viven en memoria como objetos con
+# __slots__ en vez de dicts: sin tabla de claves por registro y con acceso
+# por atributo en los handlers calientes. Siguen admitiendo registro["campo"]
+# y .get() para el código de siempre, y en disco se escriben como el dict de
+# antes (a_dict), así que el formato no cambia.
+class Registro:
+    """Base de los registros tipados. Un campo sin asignar equivale a una
+    clave ausente; las claves no previstas se conservan en `extra`."""
+    __slots__ = ("extra",)
+    CAMPOS = ()
+    DEFECTOS = {}
+    INTERNAR = frozenset()  # campos de texto repetido (banco, fechas...)
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._CAMPOS = frozenset(cls.CAMPOS)
+
+    def __init__(self, **valores):
+        for campo, defecto in self.DEFECTOS.items():
+            valores.setdefault(campo, defecto)
+        for campo in self.CAMPOS:
+            if campo in valores:
+                self[campo] = valores.pop(campo)
+        self.extra = valores or None
+
+    @classmethod
+    def desde_dict(cls, valor):
+        return cls(**valor) if isinstance(valor, dict) else valor
+
+    def a_dict(self) -> dict:
+        d = {}
+        for campo in self.CAMPOS:
+            try:
+                d[campo] = getattr(self, campo)
+            except AttributeError:
+                pass
+        if self.extra:
+            d.update(self.extra)
+        return d
+
+    # --- Acceso como dict ---
+    def __getitem__(self, clave):
+        if clave in self._CAMPOS:
+            try:
+                return getattr(self, clave)
+            except AttributeError:
+                raise KeyError(clave) from None
+        if self.extra and clave in self.extra:
+            return self.extra[clave]
+        raise KeyError(clave)
+
+    def __setitem__(self, clave, valor):
+        if clave in self._CAMPOS:
+            if clave in self.INTERNAR and isinstance(valor, str):
+                valor = sys.intern(valor)
+            setattr(self, clave, valor)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[clave] = valor
+
+    def __delitem__(self, clave):
+        try:
+            if clave in self._CAMPOS:
+                delattr(self, clave)
+            else:
+                del self.extra[clave]
+        except (AttributeError, KeyError, TypeError):
+            raise KeyError(clave) from None
+
+    def __contains__(self, clave):
+        try:
+            self[clave]
+            return True
+        except KeyError:
+            return False
+
+    def get(self, clave, defecto=None):
+        try:
+            return self[clave]
+        except KeyError:
+            return defecto
+
+    def keys(self):
+        return self.a_dict().keys()
+
+    def items(self):
+        return self.a_dict().items()
+
+    def __iter__(self):
+        return iter(self.a_dict())
+
+    def __len__(self):
+        return len(self.a_dict())
+
+    def __eq__(self, otro):
+        if isinstance(otro, Registro):
+            return type(otro) is type(self) and otro.a_dict() == self.a_dict()
+        return isinstance(otro, dict) and otro == self.a_dict()
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.a_dict()!r})"
+
+class Cuenta(Registro):
+    __slots__ = CAMPOS = ("banco", "tarjeta", "efectivo", "fecha_creacion", "creado_por")
+    DEFECTOS = {"tarjeta": 0, "efectivo": 0}
+    INTERNAR = frozenset({"banco", "creado_por"})
+
+class Prestamo(Registro):
+    __slots__ = CAMPOS = ("cantidad", "restante", "fecha", "meses", "dias_totales",
+                          "cuota_diaria", "ultimo_descuento", "proximo_cobro")
+    INTERNAR = frozenset({"fecha", "ultimo_descuento"})
+
+class ArticuloPenal(Registro):
+    """Artículo del código penal citado en una multa. Es inmutable y se
+    comparte: todas las multas que citan el mismo artículo (mismo código,
+    texto y precio) apuntan al mismo objeto."""
+    __slots__ = CAMPOS = ("codigo", "descripcion", "precio")
+    _internados = {}
+
+    @classmethod
+    def de(cls, codigo, descripcion, precio, **extra):
+        clave = (codigo, descripcion, precio)
+        if extra:
+            return cls(codigo=codigo, descripcion=descripcion, precio=precio, **extra)
+        if clave not in cls._internados:
+            cls._internados[clave] = cls(codigo=codigo, descripcion=descripcion, precio=precio)
+        return cls._internados[clave]
+
+    @classmethod
+    def desde_dict(cls, valor):
+        return cls.de(**valor) if isinstance(valor, dict) else valor
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __hash__(self):
+        return hash((self.codigo, self.descripcion, self.precio))
+
+class Multa(Registro):
+    """Multa normalizada: `articulos` son códigos de artículo de la versión
+    `cp` del código penal y `total` el importe que se impuso. Las multas
+    anteriores a las versiones traen los artículos completos (ArticuloPenal)
+    hasta que se migran con `python main.py migrar-multas`."""
+    __slots__ = CAMPOS = ("codigo", "agente", "articulos", "cp", "total", "fecha")
+    INTERNAR = frozenset({"agente", "fecha"})
+
+    def __setitem__(self, clave, valor):
+        if clave == "articulos":
+            valor = tuple(
+                sys.intern(a) if isinstance(a, str) else ArticuloPenal.desde_dict(a)
+                for a in valor
+            )
+        super().__setitem__(clave, valor)
+
+    def normalizada(self) -> bool:
+        return all(isinstance(a, str) for a in self.get("articulos", ()))
+
+class Sancion(Registro):
+    __slots__ = CAMPOS = ("staff", "motivo", "fecha", "apelable", "tipo")
+    INTERNAR = frozenset({"staff", "fecha", "apelable", "tipo"})
+
+# tienda -> (clase del registro, si cada uid guarda una lista de ellos)
+TIPOS_REGISTRO = {
+    "cuentas": (Cuenta, False),
+    "prestamos": (Prestamo, False),
+    "multas": (Multa, True),
+    "sanciones": (Sancion, True),
+}
+
+def tipar_registro(key: str, valor):
+    """Convierte el valor guardado de un uid (dict o lista) a su clase"""
+    tipo = TIPOS_REGISTRO.get(key)
+    if tipo is None:
+        return valor
+    clase, es_lista = tipo
+    if es_lista:
+        return [clase.desde_dict(v) for v in valor] if isinstance(valor, list) else valor
+    return clase.desde_dict(valor)
+
+def tipar_tienda(key: str, valor):
+    """Convierte en su sitio todos los registros de una tienda cargada"""
+    if key in TIPOS_REGISTRO and isinstance(valor, dict):
+        for uid, registro in valor.items():
+            valor[uid] = tipar_registro(key, registro)
+    return valor
+
+def serializar_registro(obj):
+    if isinstance(obj, Registro):
+        return obj.a_dict()
+    raise TypeError(f"{type(obj).__name__} no es serializable a JSON")
+
+def a_json(valor) -> str:
+    return json.dumps(valor, ensure_ascii=False, default=serializar_registro)
+
+# =====================
+# ALMACENAMIENTO CON DIARIO (WAL)
+# =====================
+# Cada tienda se guarda como una instantánea JSON (FILES[key]) más un diario
+# (FILES[key] + ".log") al que solo se añaden los registros modificados.
+# Al arrancar se carga la instantánea y se reproduce el diario encima; cuando
+# el diario crece demasiado se compacta en una instantánea nueva.
+#
+# La primera línea del diario es {"base": sha256} de la instantánea sobre la
+# que se escribe. Si el proceso cae al compactar, entre sustituir la
+# instantánea y borrar el diario, la base ya no coincide y el diario viejo se
+# descarta en vez de reproducirse sobre la instantánea nueva (que ya lo
+# incluye, y donde podría devolver valores antiguos o registros borrados).
+#
+# Guardar va en dos pasos: preparar() serializa en el bucle de eventos lo que
+# hay que escribir (solo los registros tocados, salvo al compactar) y la
+# escritura hace la E/S, de modo que puede ir a un hilo aparte.
+#
+# Las entradas escritas por el escritor en segundo plano llevan el id del lote
+# ("tx") y solo cuentan al reproducir el diario si ese id aparece en el
+# transacciones.log de su partición, que se escribe cuando el lote entero
+# está en disco. Al compactar, los lotes que ya no aparecen en ningún diario
+# se quitan de transacciones.log (y de memoria) para que no crezca sin fin.
+DIARIO_MAX_ENTRADAS = 500
+PODA_TRANSACCIONES = 1000  # lotes anotados antes de intentar podar transacciones.log
+
+class InstantaneaCorrupta(Exception):
+    """La instantánea no se puede leer o no cuadra con su suma de control"""
+
+class DiarioJSON:
+    """Instantánea + diario de cambios por registro de una tienda JSON"""
+
+    def __init__(self, key: str, path: str, particion):
+        self.key = key
+        self.path = path
+        self.particion = particion
+        self.path_diario = path + ".log"
+        # sha256 de la instantánea actual y de la anterior, una por línea: si
+        # caemos entre escribir la suma y sustituir la instantánea sigue cuadrando
+        self.path_suma = path + ".sha256"
+        self.entradas = 0
+        self._suma = None  # sha256 de la instantánea en disco (None = no hay)
+        self._suma_conocida = False
+
+    def suma_instantanea(self):
+        """sha256 de la instantánea en disco; se recuerda tras leerla o escribirla"""
+        if not self._suma_conocida:
+            self._suma = None
+            if os.path.exists(self.path):
+                with open(self.path, "rb") as f:
+                    self._suma = hashlib.sha256(f.read()).hexdigest()
+            self._suma_conocida = True
+        return self._suma
+
+    def _sumas_validas(self):
+        if not os.path.exists(self.path_suma):
+            return None
+        with open(self.path_suma, "r", encoding="utf-8") as f:
+            return [linea.strip() for linea in f if linea.strip()]
+
+    def cargar(self):
+        """Carga la instantánea y reproduce el diario encima"""
+        valor = {}
+        suma = None
+        if os.path.exists(self.path):
+            with open(self.path, "rb") as f:
+                crudo = f.read()
+            suma = hashlib.sha256(crudo).hexdigest()
+            sumas = self._sumas_validas()
+            if sumas and suma not in sumas:
+                raise InstantaneaCorrupta("la suma de control no coincide")
+            try:
+                valor = json.loads(crudo.decode("utf-8"))
+            except ValueError as e:
+                raise InstantaneaCorrupta(f"JSON ilegible: {e}") from e
+        self._suma, self._suma_conocida = suma, True
+        if not os.path.exists(self.path_diario):
+            return valor
+
+        confirmadas = self.particion.transacciones_confirmadas()
+        obsoleto = False
+        with open(self.path_diario, "r", encoding="utf-8") as f:
+            for linea in f:
+                try:
+                    entrada = json.loads(linea)
+                except ValueError:
+                    # Última línea a medio escribir por una caída: se descarta
+                    logging.warning(f"Diario '{self.key}': entrada incompleta descartada")
+                    break
+                if "base" in entrada:
+                    obsoleto = entrada["base"] != suma
+                    if obsoleto:
+                        break
+                    continue
+                if "tx" in entrada and entrada["tx"] not in confirmadas:
+                    # Lote que no llegó a confirmarse: se descarta entero
+                    continue
+                if not isinstance(valor, dict):
+                    continue
+                if "v" in entrada:
+                    valor[entrada["k"]] = entrada["v"]
+                else:
+                    valor.pop(entrada["k"], None)
+                self.entradas += 1
+        if obsoleto:
+            # Compactación interrumpida: la instantánea ya lo incluye
+            logging.warning(f"Diario '{self.key}': anterior a la instantánea, se descarta")
+            os.remove(self.path_diario)
+        return valor
+
+    def preparar(self, valor, uids, tx=None):
+        """Serializa los registros indicados y, si toca compactar, la tienda
+        entera. Devuelve (líneas de diario, texto de instantánea)"""
+        if not uids or not isinstance(valor, dict):
+            self.entradas = 0
+            return None, a_json(valor)
+
+        lineas = []
+        for uid in uids:
+            uid = str(uid)
+            entrada = {"k": uid, "v": valor[uid]} if uid in valor else {"k": uid}
+            if tx:
+                entrada["tx"] = tx
+            lineas.append(a_json(entrada))
+        self.entradas += len(lineas)
+        instantanea = None
+        if self.entradas >= DIARIO_MAX_ENTRADAS:
+            self.entradas = 0
+            instantanea = a_json(valor)
+        return lineas, instantanea
+
+    def escribir_diario(self, lineas, sincronizar: bool = False):
+        if not os.path.exists(self.path_diario):
+            lineas = [a_json({"base": self.suma_instantanea()})] + list(lineas)
+        with open(self.path_diario, "a", encoding="utf-8") as f:
+            f.write("\n".join(lineas) + "\n")
+            if sincronizar:
+                f.flush()
+                os.fsync(f.fileno())
+
+    def escribir_instantanea(self, texto: str):
+        """Instantánea nueva de forma atómica; el sangrado se hace aquí y no
+        en el bucle porque el codificador con indent es el lento"""
+        crudo = json.dumps(json.loads(texto), indent=4, ensure_ascii=False).encode("utf-8")
+        sumas = [hashlib.sha256(crudo).hexdigest()] + (self._sumas_validas() or [])[:1]
+        temporal_suma = self.path_suma + ".tmp"
+        with open(temporal_suma, "w", encoding="utf-8") as f:
+            f.write("\n".join(sumas) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporal_suma, self.path_suma)
+        temporal = self.path + ".tmp"
+        with open(temporal, "wb") as f:
+            f.write(crudo)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporal, self.path)
+        self._suma, self._suma_conocida = sumas[0], True
+        # Si caemos aquí el diario queda con la base de la instantánea
+        # anterior y cargar() lo descarta
+        if os.path.exists(self.path_diario):
+            os.remove(self.path_diario)
+
+    def transacciones_en_diario(self) -> set:
+        """Ids de lote que aparecen en el diario en disco"""
+        ids = set()
+        if os.path.exists(self.path_diario):
+            with open(self.path_diario, "r", encoding="utf-8") as f:
+                for linea in f:
+                    try:
+                        entrada = json.loads(linea)
+                    except ValueError:
+                        break
+                    if "tx" in entrada:
+                        ids.add(entrada["tx"])
+        return ids
+
+    def escribir(self, preparado):
+        """Hace la E/S de lo preparado (puede ejecutarse en otro hilo)"""
+        lineas, instantanea = preparado
+        if lineas:
+            self.escribir_diario(lineas)
+        if instantanea is not None:
+            self.escribir_instantanea(instantanea)
+
+    def guardar(self, valor, uids):
+        """Con uids se anota en el diario; sin ellos se compacta"""
+        self.escribir(self.preparar(valor, uids))
+
+    def compactar(self, valor):
+        """Escribe una instantánea nueva y vacía el diario"""
+        self.guardar(valor, None)
+
+# =====================
+# ALMACENAMIENTO SQLITE
+# =====================
+# Con config.ALMACENAMIENTO = "sqlite" las tiendas por usuario viven en una
+# tabla (uid, valor JSON) cada una. Los registros se leen bajo demanda por
+# clave primaria y se guardan fila a fila, así que arrancar no obliga a leer
+# toda la base y cada escritura toca solo las filas afectadas.
+#
+# Con "compartido" la base es la de todos los procesos de un despliegue con
+# shards, así que van a ella todas las tiendas diccionario. Los registros que
+# solo se amplían (alertas, cuentas eliminadas) siguen en JSON, con un archivo
+# por proceso para que nadie pise el de otro.
+#
+# Cada escritura en una tabla sube su versión en _versiones dentro de la misma
+# transacción; las copias de seguridad la usan como firma de la tabla. La
+# versión empieza en un valor al azar para que una base recreada no repita
+# las firmas de la anterior.
+SQL_VERSIONES = 'CREATE TABLE IF NOT EXISTS _versiones (tabla TEXT PRIMARY KEY, version INTEGER NOT NULL)'
+SQL_SUBIR_VERSION = (
+    'INSERT INTO _versiones (tabla, version) VALUES (?, random() & 0x3FFFFFFFFFFFFFFF) '
+    'ON CONFLICT(tabla) DO UPDATE SET version = version + 1'
+)
+TIENDAS_SQLITE = ["cuentas", "prestamos", "multas", "sanciones", "inventario", "dnis", "solicitudes_dni", "carnets", "vehiculos"]
+REGISTROS_POR_PROCESO = ["alertas", "cuentas_eliminadas"]
+
+def tiendas_sqlite() -> list:
+    """Tiendas con tabla en la base (las que migra importar-json)"""
+    if config.ALMACENAMIENTO == "compartido":
+        return [k for k in FILES if k not in REGISTROS_POR_PROCESO]
+    return TIENDAS_SQLITE
+
+def usa_sqlite(key: str) -> bool:
+    return config.ALMACENAMIENTO in ("sqlite", "compartido") and key in tiendas_sqlite()
+
+class TiendaSQLite(MutableMapping):
+    """Tienda respaldada por una tabla SQLite con caché de registros.
+
+    Se comporta como el dict de siempre (data["cuentas"][uid]...), pero cada
+    registro se lee de la base la primera vez que se pide y se mantiene el
+    mismo objeto en caché para que las modificaciones in situ se guarden con
+    save_json(key, uid).
+    """
+
+    def __init__(self, key: str, path_json: str, particion):
+        self.key = key
+        self.path_json = path_json
+        self.particion = particion
+        self._cache = {}
+        # Los borrados se recuerdan aunque ya se hayan escrito, para no
+        # consultar la base por un uid cuyo DELETE aún está en cola
+        self._borrados = set()
+        # Sentencias fijas por tabla: sqlite3 las prepara una vez y las reutiliza
+        self._sql_leer = f'SELECT valor FROM "{key}" WHERE uid = ?'
+        self._sql_existe = f'SELECT 1 FROM "{key}" WHERE uid = ?'
+        self._sql_claves = f'SELECT uid FROM "{key}"'
+        self._sql_todo = f'SELECT uid, valor FROM "{key}"'
+        self._sql_escribir = f'INSERT OR REPLACE INTO "{key}" (uid, valor) VALUES (?, ?)'
+        self._sql_borrar = f'DELETE FROM "{key}" WHERE uid = ?'
+
+    def cargar(self):
+        """Crea la tabla si falta; la primera vez importa el JSON existente"""
+        conn = self.particion.conexion_sqlite(escritura=True)
+        with self.particion.escritura:
+            nueva = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (self.key,)
+            ).fetchone() is None
+            conn.execute(f'CREATE TABLE IF NOT EXISTS "{self.key}" (uid TEXT PRIMARY KEY, valor TEXT NOT NULL) WITHOUT ROWID')
+            conn.execute(SQL_VERSIONES)
+            if nueva:
+                self.importar_json()
+        return self
+
+    # --- Protocolo de diccionario ---
+    def __getitem__(self, uid):
+        uid = str(uid)
+        if uid in self._cache:
+            return self._cache[uid]
+        if uid in self._borrados:
+            raise KeyError(uid)
+        fila = self.particion.conexion_sqlite().execute(self._sql_leer, (uid,)).fetchone()
+        if fila is None:
+            raise KeyError(uid)
+        valor = self._cache[uid] = tipar_registro(self.key, json.loads(fila[0]))
+        return valor
+
+    def __setitem__(self, uid, valor):
+        uid = str(uid)
+        self._cache[uid] = valor
+        self._borrados.discard(uid)
+
+    def __delitem__(self, uid):
+        uid = str(uid)
+        if uid not in self:
+            raise KeyError(uid)
+        self._cache.pop(uid, None)
+        self._borrados.add(uid)
+
+    def __contains__(self, uid):
+        uid = str(uid)
+        if uid in self._cache:
+            return True
+        if uid in self._borrados:
+            return False
+        return self.particion.conexion_sqlite().execute(self._sql_existe, (uid,)).fetchone() is not None
+
+    def __iter__(self):
+        claves = {fila[0] for fila in self.particion.conexion_sqlite().execute(self._sql_claves)}
+        claves.update(self._cache)
+        claves.difference_update(self._borrados)
+        return iter(claves)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def items(self):
+        """Recorrido completo con una sola consulta (usado por /top).
+
+        Los registros que no estaban en caché se leen sin quedarse en ella,
+        así que recorrer la tabla no la deja entera en memoria; para
+        modificar uno hay que pedirlo con tienda[uid].
+        """
+        sin_escribir = set(self._cache)
+        for uid, valor in self.particion.conexion_sqlite().execute(self._sql_todo):
+            if uid in self._borrados:
+                continue
+            sin_escribir.discard(uid)
+            registro = self._cache.get(uid)
+            yield uid, registro if registro is not None else tipar_registro(self.key, json.loads(valor))
+        # Registros nuevos que aún no han llegado a la base
+        for uid in sin_escribir:
+            if uid in self._cache:
+                yield uid, self._cache[uid]
+
+    # --- Persistencia ---
+    def preparar(self, valor, uids, tx=None):
+        """Serializa las filas a escribir o borrar como (sentencia, parámetros)"""
+        if not uids:
+            uids = list(self._cache) + list(self._borrados)
+        operaciones = []
+        for uid in uids:
+            uid = str(uid)
+            if uid in self._cache:
+                operaciones.append((self._sql_escribir, (uid, a_json(self._cache[uid]))))
+            elif uid in self._borrados:
+                operaciones.append((self._sql_borrar, (uid,)))
+        if operaciones:
+            operaciones.append((SQL_SUBIR_VERSION, (self.key,)))
+        return operaciones
+
+    def escribir(self, operaciones):
+        """Aplica las operaciones en una sola transacción (puede ir en otro hilo)"""
+        ejecutar_sqlite_atomico(self.particion, operaciones)
+
+    def guardar(self, valor, uids):
+        self.escribir(self.preparar(valor, uids))
+
+    # --- Base compartida entre procesos ---
+    def olvidar(self, uid=None):
+        """Descarta `uid` (o toda la caché): otro proceso lo ha cambiado"""
+        if uid is None:
+            self._cache.clear()
+            self._borrados.clear()
+        else:
+            uid = str(uid)
+            self._cache.pop(uid, None)
+            self._borrados.discard(uid)
+
+    # --- Migración JSON <-> SQLite ---
+    def importar_json(self):
+        """Vuelca en la tabla el contenido del JSON (instantánea + diario)"""
+        if not os.path.exists(self.path_json):
+            return 0
+        try:
+            valor = DiarioJSON(self.key, self.path_json, self.particion).cargar()
+        except Exception:
+            logging.error(f"No se pudo importar '{self.path_json}' a SQLite")
+            return 0
+        if not isinstance(valor, dict) or not valor:
+            return 0
+        conn = self.particion.conexion_sqlite(escritura=True)
+        with self.particion.escritura:
+            conn.execute(SQL_VERSIONES)
+            conn.execute("BEGIN")
+            conn.executemany(
+                self._sql_escribir,
+                ((str(uid), a_json(v)) for uid, v in valor.items())
+            )
+            conn.execute(SQL_SUBIR_VERSION, (self.key,))
+            conn.execute("COMMIT")
+        self._cache.clear()
+        self._borrados.clear()
+        logging.info(f"Importados {len(valor)} registros de '{self.key}' a SQLite")
+        return len(valor)
+
+    def exportar_json(self):
+        """Escribe la tabla completa como instantánea JSON compatible"""
+        DiarioJSON(self.key, self.path_json, self.particion).compactar(dict(self.items()))
+
+def ejecutar_sqlite_atomico(particion, operaciones):
+    """Ejecuta (sentencia, parámetros) dentro de un único BEGIN/COMMIT"""
+    conn = particion.conexion_sqlite(escritura=True)
+    with particion.escritura:
+        conn.execute("BEGIN")
+        try:
+            for sql, parametros in operaciones:
+                conn.execute(sql, parametros)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+def escribir_lote(particion, tx, partes):
+    """Escribe un lote de varias tiendas de una partición de forma atómica.
+
+    `partes` es una lista de (almacén, preparado). Primero van las entradas de
+    diario (con fsync) y las filas SQLite en una sola transacción; después se
+    confirma `tx` en particion.archivo_transacciones y solo entonces se
+    compactan las instantáneas. Si el proceso cae antes de confirmar, al arrancar se
+    descartan todas las entradas del lote. Las tiendas por usuario de una
+    misma operación comparten backend, así que el lote no mezcla ambos.
+    """
+    operaciones_sql = []
+    hay_diario = False
+    for almacen, preparado in partes:
+        if isinstance(almacen, TiendaSQLite):
+            operaciones_sql.extend(preparado)
+        elif preparado[0]:
+            almacen.escribir_diario(preparado[0], sincronizar=bool(tx))
+            hay_diario = True
+    if operaciones_sql:
+        ejecutar_sqlite_atomico(particion, operaciones_sql)
+    if tx and hay_diario:
+        particion.confirmar_transaccion(tx)
+    compactadas = False
+    for almacen, preparado in partes:
+        if isinstance(almacen, DiarioJSON) and preparado[1] is not None:
+            almacen.escribir_instantanea(preparado[1])
+            compactadas = True
+    if compactadas:
+        particion.podar_transacciones()
+
+def nuevo_id_transaccion() -> str:
+    return f"{time.time_ns():x}"
+
+def crear_almacen(particion, key: str, path: str):
+    if usa_sqlite(key):
+        return TiendaSQLite(key, path, particion)
+    return DiarioJSON(key, path, particion)
+
+# =====================
+# CARGA PEREZOSA DE TIENDAS
+# =====================
+# Ninguna tienda se lee al importar: data[key] carga la tienda la primera vez
+# que se pide y, tras on_ready, precargar_tiendas() lee en un hilo las que
+# falten. Una instantánea que no se puede leer o no cuadra con su suma de
+# control se mueve a la carpeta cuarentena de su partición en vez de pisarla
+# con {}.
+def poner_en_cuarentena(almacen: DiarioJSON, motivo: str):
+    sello = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+    for path in (almacen.path, almacen.path_diario, almacen.path_suma):
+        if os.path.exists(path):
+            os.replace(path, os.path.join(almacen.particion.dir_cuarentena, f"{os.path.basename(path)}.{sello}"))
+    almacen._suma_conocida = False
+    logging.error(f"Tienda '{almacen.key}' de {almacen.particion} en cuarentena ({motivo}); se arranca vacía")
+
+def leer_tienda(particion, key: str):
+    """Lee una tienda de disco (sin tocar `data`). Devuelve (valor, estado)"""
+    almacen = particion.almacenes[key]
     try:
-        with open(path, "r", encoding="utf-8") as f:
-            data[k] = json.load(f)
-    except Exception:
-        data[k] = {}
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump({}, f)
+        valor = almacen.cargar()
+    except InstantaneaCorrupta as e:
+        poner_en_cuarentena(almacen, str(e))
+        return {}, "cuarentena"
+    # En SQLite los registros se tipan al leerlos uno a uno
+    return tipar_tienda(key, valor), "ok"
+
+class DatosPerezosos(dict):
+    """datos[key] lee la tienda de la partición la primera vez que se pide"""
+
+    def __init__(self, particion):
+        super().__init__()
+        self.particion = particion
+
+    def __missing__(self, key):
+        if key not in self.particion.almacenes:
+            raise KeyError(key)
+        inicio = time.perf_counter()
+        valor, estado = leer_tienda(self.particion, key)
+        return self.instalar(key, valor, estado, time.perf_counter() - inicio)
+
+    def instalar(self, key, valor, estado, segundos):
+        if dict.__contains__(self, key):
+            # Otra ruta la cargó mientras tanto: manda la que ya está en uso
+            return dict.__getitem__(self, key)
+        dict.__setitem__(self, key, valor)
+        self.particion.informe_carga[key] = {
+            "ms": segundos * 1000,
+            # En SQLite contar obligaría a recorrer la tabla entera
+            "registros": len(valor) if isinstance(valor, (dict, list)) else None,
+            "estado": estado,
+        }
+        almacen = self.particion.almacenes[key]
+        escritor = self.particion.escritor
+        # Dejar la instantánea al día para seguir con el diario vacío
+        if estado == "cuarentena" or (isinstance(almacen, DiarioJSON) and almacen.entradas):
+            if escritor.activo():
+                escritor.marcar(key, ())
+            else:
+                almacen.compactar(valor)
+        with usar_particion(self.particion):
+            avisar_guardado(key, ())
+        return valor
+
+    def get(self, key, defecto=None):
+        if key in self.particion.almacenes:
+            return self[key]
+        return dict.get(self, key, defecto)
+
+    def __contains__(self, key):
+        return key in self.particion.almacenes or dict.__contains__(self, key)
+
+    def cargada(self, key) -> bool:
+        return dict.__contains__(self, key)
+
+tarea_precarga = None
+
+async def precargar_tiendas():
+    """Lee en un hilo las tiendas que aún no se han pedido, partición a partición"""
+    loop = asyncio.get_running_loop()
+    inicio = time.perf_counter()
+    for particion in particiones.todas():
+        for key in particion.almacenes:
+            if particion.datos.cargada(key):
+                continue
+            t0 = time.perf_counter()
+            try:
+                valor, estado = await loop.run_in_executor(None, leer_tienda, particion, key)
+            except Exception:
+                logging.exception(f"No se pudo precargar '{key}' de {particion}")
+                continue
+            particion.datos.instalar(key, valor, estado, time.perf_counter() - t0)
+    logging.info(f"Precarga completada en {(time.perf_counter() - inicio) * 1000:.0f} ms")
+    for particion in particiones.todas():
+        for key, info in particion.informe_carga.items():
+            registros = "?" if info["registros"] is None else info["registros"]
+            logging.info(f"  {particion} {key}: {registros} registros, {info['ms']:.1f} ms, {info['estado']}")
+
+# =====================
+# PARTICIONES POR SERVIDOR
+# =====================
+# Cada servidor tiene su partición: tiendas, diarios, base SQLite, copias y
+# escritor propios bajo data/servidores/<id>/, que se cargan y se guardan por
+# separado. Así un solo proceso atiende varios servidores sin mezclar datos y
+# sin que las escrituras de uno esperen a las de otro. Sin MULTISERVIDOR (y
+# siempre para SERVIDOR_PRINCIPAL y los MD) se usa la partición principal,
+# que es la carpeta data/ de siempre.
+#
+# La partición en uso va en una ContextVar: se fija al recibir cada
+# interacción o mensaje y las tareas creadas desde ahí la heredan, así que
+# data[...] y los demás objetos por servidor (PorParticion) la resuelven solos.
+DIR_SERVIDORES = os.path.join(DATA_DIR, "servidores")
+
+class Particion:
+    """Tiendas y persistencia de un servidor (servidor None = principal)"""
+
+    def __init__(self, servidor, directorio: str):
+        self.servidor = servidor
+        self.dir = directorio
+        self.nombre = "principal" if servidor is None else str(servidor)
+        # Base compartida con los demás procesos: los archivos propios de cada
+        # proceso (registros JSON y su confirmación de lotes) llevan su nombre
+        self.compartida = config.ALMACENAMIENTO == "compartido"
+        sufijo = f".{config.PROCESO}" if self.compartida else ""
+        self.files = {k: os.path.join(directorio, os.path.relpath(path, DATA_DIR)) for k, path in FILES.items()}
+        for key in REGISTROS_POR_PROCESO:
+            base, extension = os.path.splitext(self.files[key])
+            self.files[key] = base + sufijo + extension
+        self.archivo_transacciones = os.path.join(directorio, f"transacciones{sufijo}.log")
+        if servidor is None:
+            self.sqlite_archivo = config.SQLITE_ARCHIVO
+        else:
+            self.sqlite_archivo = os.path.join(directorio, os.path.basename(config.SQLITE_ARCHIVO))
+        self.dir_copias = os.path.join(directorio, "backups")
+        self.dir_cuarentena = os.path.join(directorio, "cuarentena")
+        for subdir in {os.path.dirname(p) for p in self.files.values()} | {self.dir_copias, self.dir_cuarentena}:
+            os.makedirs(subdir, exist_ok=True)
+        # Sin diarios pendientes, las confirmaciones antiguas ya no hacen falta
+        if os.path.exists(self.archivo_transacciones) and not any(os.path.exists(p + ".log") for p in self.files.values()):
+            os.remove(self.archivo_transacciones)
+        self._confirmadas = None
+        self._anotadas = 0  # líneas en archivo_transacciones
+        self._poda_en = PODA_TRANSACCIONES
+        self._conexiones = {}
+        # Una transacción a la vez en la conexión de escritura (la usan los
+        # hilos de persistencia y, con la base compartida, el bucle)
+        self.escritura = threading.RLock()
+        self.almacenes = {k: crear_almacen(self, k, path) for k, path in self.files.items()}
+        self.datos = DatosPerezosos(self)
+        self.informe_carga = {}  # key -> {"ms", "registros", "estado"}
+        self.escritor = EscritorPersistencia(self, config.INTERVALO_GUARDADO, config.UMBRAL_GUARDADO)
+        self.estado = {}  # PorParticion -> objeto de esta partición
+
+    def __repr__(self):
+        return "partición principal" if self.servidor is None else f"partición {self.servidor}"
+
+    def transacciones_confirmadas(self) -> set:
+        """Ids de lote confirmados (se leen una vez al abrir la partición)"""
+        if self._confirmadas is None:
+            self._confirmadas = set()
+            if os.path.exists(self.archivo_transacciones):
+                with open(self.archivo_transacciones, "r", encoding="utf-8") as f:
+                    self._confirmadas.update(linea.strip() for linea in f if linea.strip())
+            self._anotadas = len(self._confirmadas)
+        return self._confirmadas
+
+    def confirmar_transaccion(self, tx: str):
+        """Anota el lote `tx` como entero en disco (hilo de persistencia)"""
+        with open(self.archivo_transacciones, "a", encoding="utf-8") as f:
+            f.write(tx + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        # Para quien relea un diario en esta misma ejecución (copias)
+        self.transacciones_confirmadas().add(tx)
+        self._anotadas += 1
+
+    def podar_transacciones(self):
+        """Deja en archivo_transacciones solo los lotes que aún aparecen en
+        algún diario (también los de tiendas sin cargar). Se llama tras
+        compactar, desde el hilo que escribe la partición"""
+        confirmadas = self.transacciones_confirmadas()
+        if self._anotadas < self._poda_en:
+            return
+        referenciadas = set()
+        for almacen in self.almacenes.values():
+            if isinstance(almacen, DiarioJSON):
+                referenciadas |= almacen.transacciones_en_diario()
+        vivas = confirmadas & referenciadas
+        temporal = self.archivo_transacciones + ".tmp"
+        with open(temporal, "w", encoding="utf-8") as f:
+            f.write("".join(tx + "\n" for tx in sorted(vivas)))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporal, self.archivo_transacciones)
+        self._confirmadas = vivas
+        self._anotadas = len(vivas)
+        # Si casi todo sigue vivo, no volver a recorrer los diarios enseguida
+        self._poda_en = max(PODA_TRANSACCIONES, 2 * len(vivas))
+        logging.info(f"{self}: transacciones.log podado a {len(vivas)} lotes ({len(confirmadas) - len(vivas)} fuera)")
+
+    def conexion_sqlite(self, escritura: bool = False) -> sqlite3.Connection:
+        """Conexiones compartidas en modo WAL: una de lectura para el bucle de
+        eventos y otra de escritura para el hilo de persistencia"""
+        clave = "escritura" if escritura else "lectura"
+        if clave not in self._conexiones:
+            # isolation_level=None: las transacciones se abren a mano con BEGIN
+            conn = sqlite3.connect(self.sqlite_archivo, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._conexiones[clave] = conn
+        return self._conexiones[clave]
+
+_particion = contextvars.ContextVar("particion", default=None)
+
+# Objetos por partición con tareas propias (préstamos, robos, copias)
+SERVICIOS_POR_PARTICION = []
+
+class RegistroParticiones:
+    """Particiones abiertas por id de servidor.
+
+    Una partición se abre la primera vez que se pide; si el bot ya está en
+    marcha se arrancan en ese momento su escritor y sus servicios.
+    """
+
+    def __init__(self):
+        self._principal = None
+        self._servidores = {}  # id -> Particion
+        self.activo = False
+
+    def principal(self) -> Particion:
+        if self._principal is None:
+            self._principal = Particion(None, DATA_DIR)
+            if self.activo:
+                self._iniciar(self._principal)
+        return self._principal
+
+    def de(self, servidor) -> Particion:
+        """Partición en la que se guardan los datos de `servidor`"""
+        if servidor is None or not config.MULTISERVIDOR or int(servidor) == config.SERVIDOR_PRINCIPAL:
+            return self.principal()
+        return self.abrir(int(servidor))
+
+    def abrir(self, servidor: int) -> Particion:
+        """Partición propia de `servidor` (también sin MULTISERVIDOR, para la
+        línea de comandos)"""
+        particion = self._servidores.get(servidor)
+        if particion is None:
+            particion = self._servidores[servidor] = Particion(servidor, os.path.join(DIR_SERVIDORES, str(servidor)))
+            logging.info(f"Abierta la {particion}")
+            if self.activo:
+                self._iniciar(particion)
+        return particion
+
+    def abierta(self, nombre: str):
+        """Partición ya abierta con ese nombre (Particion.nombre), o None"""
+        if nombre == "principal":
+            return self._principal
+        return self._servidores.get(int(nombre))
+
+    def todas(self) -> list:
+        return [self.principal()] + list(self._servidores.values())
+
+    def en_disco(self) -> list:
+        """Todas las particiones con carpeta en disco (línea de comandos)"""
+        if os.path.isdir(DIR_SERVIDORES):
+            for nombre in sorted(os.listdir(DIR_SERVIDORES)):
+                if nombre.isdigit():
+                    self.abrir(int(nombre))
+        return self.todas()
+
+    def _iniciar(self, particion: Particion):
+        # Las tareas creadas aquí heredan la partición de la ContextVar
+        with usar_particion(particion):
+            particion.escritor.iniciar()
+            for servicio in SERVICIOS_POR_PARTICION:
+                servicio.de(particion).iniciar()
+
+    def iniciar(self):
+        self.activo = True
+        for particion in self.todas():
+            self._iniciar(particion)
+
+    async def detener(self):
+        """Para los servicios y vacía el escritor de cada partición"""
+        self.activo = False
+        for particion in self.todas():
+            with usar_particion(particion):
+                for servicio in SERVICIOS_POR_PARTICION:
+                    await servicio.de(particion).detener()
+                await particion.escritor.detener()
+
+particiones = RegistroParticiones()
+
+def particion_actual() -> Particion:
+    return _particion.get() or particiones.principal()
+
+@contextlib.contextmanager
+def usar_particion(particion: Particion):
+    token = _particion.set(particion)
+    try:
+        yield particion
+    finally:
+        _particion.reset(token)
+
+def en_servidor(servidor):
+    """with en_servidor(guild_id): ... trabaja sobre la partición de ese servidor"""
+    return usar_particion(particiones.de(servidor))
+
+class PorParticion:
+    """Nombre global detrás del cual hay un objeto por partición.
+
+    Cada acceso (atributo, [] o in) se resuelve en la partición actual, y el
+    objeto se crea con fabrica() la primera vez que se pide en cada una. Con
+    servicio=True además se arranca y se detiene con su partición. Los objetos
+    leen `data` de la partición en curso, así que lo obtenido con de() se usa
+    dentro de usar_particion().
+    """
+
+    def __init__(self, fabrica, servicio: bool = False):
+        self._fabrica = fabrica
+        if servicio:
+            SERVICIOS_POR_PARTICION.append(self)
+
+    def de(self, particion: Particion):
+        objeto = particion.estado.get(self)
+        if objeto is None:
+            with usar_particion(particion):
+                objeto = particion.estado[self] = self._fabrica()
+        return objeto
+
+    def actual(self):
+        return self.de(particion_actual())
+
+    def __getattr__(self, nombre):
+        return getattr(self.actual(), nombre)
+
+    def __getitem__(self, clave):
+        return self.actual()[clave]
+
+    def __setitem__(self, clave, valor):
+        self.actual()[clave] = valor
+
+    def __delitem__(self, clave):
+        del self.actual()[clave]
+
+    def __contains__(self, clave):
+        return clave in self.actual()
+
+    def __iter__(self):
+        return iter(self.actual())
+
+    def __len__(self):
+        return len(self.actual())
+
+# data["cuentas"]... del servidor de la operación en curso
+data = PorParticion(lambda: particion_actual().datos)
+
+# Conectar cada interacción a la partición de su servidor: el comando, el
+# botón o el modal se ejecutan en tareas creadas dentro de este bloque.
+# ConnectionState copia sus parse_* a `parsers` al crearse, así que se
+# sustituye la entrada del estado ya creado (parchear la clase no serviría)
+def _interacciones_en_servidor(estado):
+    original = estado.parsers["INTERACTION_CREATE"]
+
+    def parse_interaction_create(payload):
+        with en_servidor(payload.get("guild_id")):
+            original(payload)
+
+    estado.parsers["INTERACTION_CREATE"] = parse_interaction_create
+
+_interacciones_en_servidor(bot._connection)
+
+# =====================
+# MÉTRICAS DE COMANDOS
+# =====================
+# Cada comando de barra se mide por fases (ver instrumentar_comandos):
+#   espera     creación de la interacción -> empieza el handler
+#   respuesta  empieza el handler -> primera respuesta (send_message, defer...)
+#   plazo      creación de la interacción -> primera respuesta (Discord da 3 s)
+#   guardado   tiempo dentro de save_json / Transaccion.confirmar
+#   total      duración completa del handler
+LIMITE_RESPUESTA_MS = 3000
+FASES_METRICAS = ("espera", "respuesta", "plazo", "guardado", "total")
+# Cubos `le` (segundos) del endpoint de Prometheus
+CUBOS_PROMETHEUS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2, 3, 5, 10)
+
+class HistogramaLatencia:
+    """Histograma log-lineal al estilo HDR, en microsegundos.
+
+    Cada potencia de dos se parte en 2**(BITS - 1) sub-cubos, así que el
+    ancho de un cubo es menos del 0,8% de sus valores (1/128) y la memoria
+    depende del rango de valores, no del número de muestras.
+    """
+    BITS = 8
+    __slots__ = ("cuentas", "n", "suma", "maximo")
+
+    def __init__(self):
+        self.cuentas = {}  # índice de cubo -> muestras
+        self.n = 0
+        self.suma = 0.0
+        self.maximo = 0.0
+
+    @classmethod
+    def _indice(cls, us: int) -> int:
+        e = max(us.bit_length() - cls.BITS, 0)
+        return (e << cls.BITS) | (us >> e)
+
+    @classmethod
+    def _suelo(cls, indice: int) -> int:
+        """Límite inferior (inclusivo) en µs del cubo `indice`"""
+        e = indice >> cls.BITS
+        return (indice & ((1 << cls.BITS) - 1)) << e
+
+    @classmethod
+    def _techo(cls, indice: int) -> int:
+        """Límite superior (exclusivo) en µs del cubo `indice`"""
+        e = indice >> cls.BITS
+        return ((indice & ((1 << cls.BITS) - 1)) + 1) << e
+
+    def registrar(self, ms: float):
+        i = self._indice(max(int(ms * 1000), 0))
+        self.cuentas[i] = self.cuentas.get(i, 0) + 1
+        self.n += 1
+        self.suma += ms
+        if ms > self.maximo:
+            self.maximo = ms
+
+    def percentil(self, p: float) -> float:
+        """ms por debajo de los cuales queda el p% de las muestras"""
+        if not self.n:
+            return 0.0
+        objetivo = max(1, -(-self.n * p // 100))
+        acumulado = 0
+        for i in sorted(self.cuentas):
+            acumulado += self.cuentas[i]
+            if acumulado >= objetivo:
+                return min(self._techo(i) / 1000, self.maximo)
+        return self.maximo
+
+    def acumulado_hasta(self, limites_s) -> list:
+        """Muestras <= cada límite (en segundos), para los cubos `le`.
+
+        Un cubo que cruza un límite cuenta entero en el primero que alcanza
+        su suelo: así una muestra justo en el límite entra en su `le`, y el
+        error queda dentro del ancho de un cubo, como en percentil().
+        """
+        indices = sorted(self.cuentas)
+        resultado, acumulado, pos = [], 0, 0
+        for limite in limites_s:
+            while pos < len(indices) and self._suelo(indices[pos]) <= limite * 1_000_000:
+                acumulado += self.cuentas[indices[pos]]
+                pos += 1
+            resultado.append(acumulado)
+        return resultado
+
+class Medicion:
+    """Tiempos de una ejecución de comando; vive en `interaction.extras`"""
+    __slots__ = ("comando", "espera", "inicio", "respondida", "guardado", "error",
+                 "respondiendo", "diferida", "original_pendiente")
+
+    def __init__(self, comando: str, interaction):
+        self.comando = comando
+        self.inicio = time.perf_counter()
+        # created_at viene del snowflake: con relojes desfasados puede salir negativo
+        self.espera = max((discord.utils.utcnow() - interaction.created_at).total_seconds() * 1000, 0.0)
+        self.respondida = None
+        self.guardado = 0.0
+        self.error = False
+        self.respondiendo = False       # hay una respuesta en vuelo
+        self.diferida = None            # tarea del defer automático
+        self.original_pendiente = False # el "pensando..." del defer sigue sin contenido
+
+medicion_actual = contextvars.ContextVar("medicion_actual", default=None)
+
+def anotar_guardado(inicio: float):
+    """Suma a la medición en curso (si la hay) el tiempo desde `inicio`"""
+    medicion = medicion_actual.get()
+    if medicion is not None:
+        medicion.guardado += time.perf_counter() - inicio
+
+class MetricasComandos:
+    """Histogramas por comando y fase, más contadores de errores y plazos perdidos"""
+
+    def __init__(self):
+        self.comandos = {}        # nombre -> {fase: HistogramaLatencia}
+        self.fuera_de_plazo = {}  # nombre -> respuestas después de 3 s (o ninguna)
+        self.errores = {}
+        self.diferidas = {}       # nombre -> veces que saltó el defer automático
+        self.desde = datetime.datetime.now()
+
+    def registrar(self, m: Medicion):
+        fin = time.perf_counter()
+        hist = self.comandos.get(m.comando)
+        if hist is None:
+            hist = self.comandos[m.comando] = {fase: HistogramaLatencia() for fase in FASES_METRICAS}
+        hist["espera"].registrar(m.espera)
+        hist["guardado"].registrar(m.guardado * 1000)
+        hist["total"].registrar((fin - m.inicio) * 1000)
+        if m.respondida is not None:
+            respuesta = (m.respondida - m.inicio) * 1000
+            hist["respuesta"].registrar(respuesta)
+            hist["plazo"].registrar(m.espera + respuesta)
+        if m.respondida is None or m.espera + (m.respondida - m.inicio) * 1000 > LIMITE_RESPUESTA_MS:
+            self.fuera_de_plazo[m.comando] = self.fuera_de_plazo.get(m.comando, 0) + 1
+        if m.error:
+            self.errores[m.comando] = self.errores.get(m.comando, 0) + 1
+
+    def resumen(self, fase: str = "plazo") -> list:
+        """[(comando, histograma de `fase`)] de más lento a más rápido por p99"""
+        filas = [(nombre, h[fase]) for nombre, h in self.comandos.items() if h[fase].n]
+        return sorted(filas, key=lambda f: f[1].percentil(99), reverse=True)
+
+    def prometheus(self) -> str:
+        """Exposición en formato de texto de Prometheus"""
+        lineas = [
+            "# HELP rp_comando_latencia_segundos Latencia de los comandos de barra por fase",
+            "# TYPE rp_comando_latencia_segundos histogram",
+        ]
+        for nombre, hist in sorted(self.comandos.items()):
+            for fase, h in hist.items():
+                etiquetas = f'comando="{nombre}",fase="{fase}"'
+                for limite, n in zip(CUBOS_PROMETHEUS, h.acumulado_hasta(CUBOS_PROMETHEUS)):
+                    lineas.append(f'rp_comando_latencia_segundos_bucket{{{etiquetas},le="{limite}"}} {n}')
+                lineas.append(f'rp_comando_latencia_segundos_bucket{{{etiquetas},le="+Inf"}} {h.n}')
+                lineas.append(f"rp_comando_latencia_segundos_sum{{{etiquetas}}} {h.suma / 1000:.6f}")
+                lineas.append(f"rp_comando_latencia_segundos_count{{{etiquetas}}} {h.n}")
+        for metrica, ayuda, contador in (
+            ("rp_comando_fuera_de_plazo_total", "Comandos que no respondieron en 3 s", self.fuera_de_plazo),
+            ("rp_comando_errores_total", "Comandos que terminaron con excepción", self.errores),
+            ("rp_comando_diferidos_total", "Comandos diferidos automáticamente por pasar del presupuesto", self.diferidas),
+        ):
+            lineas.append(f"# HELP {metrica} {ayuda}")
+            lineas.append(f"# TYPE {metrica} counter")
+            for nombre, n in sorted(contador.items()):
+                lineas.append(f'{metrica}{{comando="{nombre}"}} {n}')
+        return "\n".join(lineas) + "\n"
+
+metricas = MetricasComandos()
+
+def _medido(nombre: str, callback):
+    """Envuelve el callback de un comando para medirlo"""
+    @functools.wraps(callback)
+    async def medido(*args, **kwargs):
+        interaction = next(a for a in args if isinstance(a, discord.Interaction))
+        m = interaction.extras["medicion"] = Medicion(nombre, interaction)
+        token = medicion_actual.set(m)
+        # El presupuesto cuenta desde que Discord creó la interacción
+        guardia = asyncio.get_running_loop().call_later(
+            max(config.PRESUPUESTO_RESPUESTA - m.espera / 1000, 0), _diferir_si_tarda, interaction, m
+        ) if config.PRESUPUESTO_RESPUESTA > 0 else None
+        try:
+            return await callback(*args, **kwargs)
+        except BaseException:
+            m.error = True
+            raise
+        finally:
+            if guardia is not None:
+                guardia.cancel()
+            medicion_actual.reset(token)
+            metricas.registrar(m)
+    medido.__medido__ = True
+    return medido
+
+# Código de cada handler -> nombre del comando, para atribuir bloqueos del bucle
+codigos_comando = {}
+
+def instrumentar_comandos(arbol):
+    """Mide todos los comandos de barra del árbol (idempotente)"""
+    for cmd in arbol.walk_commands():
+        if isinstance(cmd, app_commands.Command) and not getattr(cmd._callback, "__medido__", False):
+            codigos_comando[cmd._callback.__code__] = cmd.qualified_name
+            cmd._callback = _medido(cmd.qualified_name, cmd._callback)
+
+# =====================
+# GUARDIA DE RESPUESTA
+# =====================
+# Si un comando no ha respondido cuando se agota PRESUPUESTO_RESPUESTA, se
+# difiere solo (el usuario ve "pensando...") para no perder los 3 s de
+# Discord. Solo en ese caso, lo que el handler envíe después con
+# interaction.response se redirige a interaction.followup; una segunda
+# respuesta de un handler sin defer automático sigue fallando con
+# InteractionResponded, como siempre.
+#
+# El "pensando..." del defer automático es público. Si el handler quería
+# responder en privado (send_message o defer con ephemeral=True), se borra,
+# y lo siguiente sale como mensaje efímero nuevo en vez de ocuparlo.
+def _diferir_si_tarda(interaction, m: Medicion):
+    if m.respondida is not None or m.respondiendo or interaction.response.is_done():
+        return
+    m.original_pendiente = True
+    m.diferida = asyncio.ensure_future(interaction.response.defer(thinking=True))
+    metricas.diferidas[m.comando] = metricas.diferidas.get(m.comando, 0) + 1
+    logging.info(f"Comando '{m.comando}' diferido automáticamente tras {m.espera + (time.perf_counter() - m.inicio) * 1000:.0f} ms")
+
+async def _esperar_defer(m):
+    """Espera a que termine el defer automático, si lo hubo"""
+    if m is not None and m.diferida is not None:
+        try:
+            await m.diferida
+        except discord.HTTPException as e:
+            logging.warning(f"Falló el defer automático de '{m.comando}': {e}")
+
+async def _soltar_original(interaction, m, efimero: bool):
+    """Primer envío tras el defer automático: uno público ocupa el
+    "pensando..."; uno efímero lo borra para salir como mensaje nuevo"""
+    if not m.original_pendiente:
+        return
+    m.original_pendiente = False
+    if efimero:
+        with contextlib.suppress(discord.HTTPException):
+            await interaction.delete_original_response()
+
+async def _enviar_por_followup(interaction, m, content=None, *, delete_after=None, **kwargs):
+    """send_message de un comando ya diferido por la guardia, enviado con
+    followup.send. Devuelve el WebhookMessage del followup (no hay
+    InteractionCallbackResponse que devolver)"""
+    if kwargs.get("view", discord.utils.MISSING) is None:
+        del kwargs["view"]
+    await _soltar_original(interaction, m, kwargs.get("ephemeral", False))
+    mensaje = await interaction.followup.send(content, wait=True, **kwargs)
+    if delete_after is not None:
+        await mensaje.delete(delay=delete_after)
+    return mensaje
+
+def _marcar_respuesta(metodo):
+    @functools.wraps(metodo)
+    async def envuelto(self, *args, **kwargs):
+        m = self._parent.extras.get("medicion")
+        if m is not None:
+            m.respondiendo = True
+        try:
+            resultado = await metodo(self, *args, **kwargs)
+        finally:
+            if m is not None:
+                m.respondiendo = False
+        if m is not None and m.respondida is None:
+            m.respondida = time.perf_counter()
+        return resultado
+    return envuelto
+
+# Originales ya marcados como primera respuesta (la que cuenta para los 3 s)
+_send_message_original = _marcar_respuesta(discord.InteractionResponse.send_message)
+_defer_original = _marcar_respuesta(discord.InteractionResponse.defer)
+
+def _diferida_por_guardia(interaction):
+    """Medición del comando si la guardia lo difirió (y no es la propia guardia)"""
+    m = interaction.extras.get("medicion")
+    if m is not None and m.diferida is not None and m.diferida is not asyncio.current_task():
+        return m
+    return None
+
+@functools.wraps(_send_message_original)
+async def _send_message_guardado(self, *args, **kwargs):
+    m = _diferida_por_guardia(self._parent)
+    if m is not None:
+        await _esperar_defer(m)
+        if self.is_done():
+            return await _enviar_por_followup(self._parent, m, *args, **kwargs)
+    return await _send_message_original(self, *args, **kwargs)
+
+@functools.wraps(_defer_original)
+async def _defer_guardado(self, *args, **kwargs):
+    m = _diferida_por_guardia(self._parent)
+    if m is not None:
+        await _esperar_defer(m)
+        if self.is_done():
+            # La guardia ya difirió: si el handler lo quería privado, fuera el
+            # "pensando..." público para que sus followups salgan efímeros
+            await _soltar_original(self._parent, m, kwargs.get("ephemeral", False))
+            return None
+    return await _defer_original(self, *args, **kwargs)
+
+discord.InteractionResponse.send_message = _send_message_guardado
+discord.InteractionResponse.defer = _defer_guardado
+for _metodo in ("edit_message", "send_modal"):
+    setattr(discord.InteractionResponse, _metodo, _marcar_respuesta(getattr(discord.InteractionResponse, _metodo)))
+
+class ServidorMetricas:
+    """Endpoint HTTP local con las métricas en formato Prometheus (GET /metrics)"""
+
+    def __init__(self, host: str, puerto: int):
+        self.host = host
+        self.puerto = puerto
+        self._servidor = None
+
+    async def iniciar(self):
+        if self.puerto <= 0 or self._servidor is not None:
+            return
+        try:
+            self._servidor = await asyncio.start_server(self._atender, self.host, self.puerto)
+            logging.info(f"Métricas en http://{self.host}:{self.puerto}/metrics")
+        except OSError as e:
+            logging.warning(f"No se pudo abrir el endpoint de métricas en {self.host}:{self.puerto}: {e}")
+
+    async def detener(self):
+        if self._servidor is not None:
+            self._servidor.close()
+            await self._servidor.wait_closed()
+            self._servidor = None
+
+    async def _atender(self, lector, escritor_http):
+        try:
+            peticion = await asyncio.wait_for(lector.readline(), 5)
+            while (await asyncio.wait_for(lector.readline(), 5)) not in (b"\r\n", b"\n", b""):
+                pass
+            partes = peticion.decode("latin-1").split()
+            if len(partes) >= 2 and partes[0] == "GET" and partes[1].split("?")[0] == "/metrics":
+                cuerpo = metricas.prometheus().encode()
+                cabecera = "HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            else:
+                cuerpo = b"no encontrado\n"
+                cabecera = "HTTP/1.0 404 Not Found\r\nContent-Type: text/plain\r\n"
+            escritor_http.write(f"{cabecera}Content-Length: {len(cuerpo)}\r\n\r\n".encode() + cuerpo)
+            await escritor_http.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            escritor_http.close()
+
+def puerto_metricas() -> int:
+    """Puerto de métricas de este proceso: varios procesos de shards en la
+    misma máquina no pueden compartir uno"""
+    if config.METRICAS_PUERTO <= 0 or config.SHARD_IDS is None:
+        return config.METRICAS_PUERTO
+    return config.METRICAS_PUERTO + min(config.SHARD_IDS)
+
+servidor_metricas = ServidorMetricas(config.METRICAS_HOST, puerto_metricas())
+
+# =====================
+# VIGILANTE DEL BUCLE DE EVENTOS
+# =====================
+# Una tarea late cada `intervalo` y mide cuánto se retrasa su despertar
+# (retraso del bucle). Un hilo aparte vigila ese latido: si el bucle lleva
+# más de `umbral` sin latir, algo lo está bloqueando, y el hilo toma
+# muestras de la pila del hilo del bucle para ver qué código es y a qué
+# comando pertenece. Al volver el latido, el bloqueo se cierra con su
+# duración real y se escribe en data/bucle_lento.log (rotativo; con la base
+# compartida, uno por proceso: data/bucle_lento.<PROCESO>.log). Con
+# VIGILANTE_DEBUG_ASYNCIO el bucle va además en modo debug y los avisos de
+# callback lento de asyncio acaban en el mismo archivo.
+ARCHIVO_BUCLE_LENTO = os.path.join(
+    "data", f"bucle_lento.{config.PROCESO}.log" if config.ALMACENAMIENTO == "compartido" else "bucle_lento.log"
+)
+
+registro_bucle = logging.getLogger("bucle_lento")
+registro_bucle.propagate = False
+
+class Bloqueo:
+    """Un bloqueo del bucle: cuándo, cuánto, de qué comando y con qué pilas"""
+    __slots__ = ("inicio", "duracion_ms", "comando", "funcion", "pila", "muestras")
+
+    def __init__(self, inicio: float):
+        self.inicio = inicio  # time.time() del último latido antes del bloqueo
+        self.duracion_ms = 0.0
+        self.comando = None
+        self.funcion = None
+        self.pila = []
+        self.muestras = 0
+
+class _AvisosAsyncio(logging.Handler):
+    """Lleva al registro del bucle los avisos de callback lento de asyncio"""
+
+    def emit(self, record):
+        if isinstance(record.msg, str) and record.msg.startswith("Executing "):
+            registro_bucle.warning(f"asyncio: {record.getMessage()}")
+
+class VigilanteBucle:
+    def __init__(self, intervalo: float, umbral_ms: float, max_muestras: int = 5, debug_asyncio: bool = False):
+        self.intervalo = intervalo
+        self.debug_asyncio = debug_asyncio
+        self.umbral = umbral_ms / 1000
+        self.max_muestras = max_muestras
+        self.retraso = HistogramaLatencia()
+        self.recientes = collections.deque(maxlen=50)
+        self.total_bloqueos = 0
+        self._latido = time.monotonic()
+        self._bloqueo = None   # lo escribe el hilo vigilante, lo cierra el bucle
+        self._lock = threading.Lock()
+        self._hilo_bucle = None
+        self._tarea = None
+        self._parar = threading.Event()
+
+    def iniciar(self):
+        if self.intervalo <= 0 or (self._tarea is not None and not self._tarea.done()):
+            return
+        loop = asyncio.get_running_loop()
+        if not registro_bucle.handlers:
+            manejador = logging.handlers.RotatingFileHandler(
+                ARCHIVO_BUCLE_LENTO, maxBytes=1_000_000, backupCount=3, encoding="utf-8"
+            )
+            manejador.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+            registro_bucle.addHandler(manejador)
+        if self.debug_asyncio:
+            # Detección propia de asyncio (callback a callback): solo funciona
+            # en modo debug. Sin él, el retraso lo mide solo el hilo vigilante
+            loop.set_debug(True)
+            loop.slow_callback_duration = self.umbral
+            registro_asyncio = logging.getLogger("asyncio")
+            if not any(isinstance(h, _AvisosAsyncio) for h in registro_asyncio.handlers):
+                registro_asyncio.addHandler(_AvisosAsyncio(logging.WARNING))
+        self._hilo_bucle = threading.get_ident()
+        self._latido = time.monotonic()
+        self._parar.clear()
+        self._tarea = loop.create_task(self._latir())
+        threading.Thread(target=self._vigilar, name="vigilante-bucle", daemon=True).start()
+
+    async def detener(self):
+        self._parar.set()
+        if self._tarea is not None:
+            self._tarea.cancel()
+            self._tarea = None
+
+    async def _latir(self):
+        while True:
+            antes = time.monotonic()
+            await asyncio.sleep(self.intervalo)
+            ahora = time.monotonic()
+            retraso = max(ahora - antes - self.intervalo, 0.0)
+            self.retraso.registrar(retraso * 1000)
+            with self._lock:
+                self._latido = ahora
+                bloqueo, self._bloqueo = self._bloqueo, None
+            if bloqueo is not None:
+                bloqueo.duracion_ms = retraso * 1000
+                self._cerrar(bloqueo)
+
+    def _vigilar(self):
+        """Hilo vigilante: muestrea la pila del bucle mientras esté bloqueado"""
+        paso = min(self.intervalo, self.umbral) / 2
+        while not self._parar.wait(paso):
+            # Con el lock el bucle no puede cerrar el bloqueo a medio muestrear
+            with self._lock:
+                parado = time.monotonic() - self._latido
+                if parado < self.umbral:
+                    continue
+                if self._bloqueo is None:
+                    self._bloqueo = Bloqueo(time.time() - parado)
+                if self._bloqueo.muestras >= self.max_muestras:
+                    continue
+                marco = sys._current_frames().get(self._hilo_bucle)
+                if marco is not None:
+                    self._muestrear(self._bloqueo, marco)
+
+    def _muestrear(self, bloqueo: Bloqueo, marco):
+        pila = traceback.extract_stack(marco)
+        bloqueo.muestras += 1
+        if bloqueo.pila:
+            return  # basta con la primera pila; el resto solo cuenta
+        bloqueo.pila = [f"{os.path.basename(f.filename)}:{f.lineno} {f.name}" for f in pila[-12:]]
+        # Comando: el primer handler que aparezca desde dentro hacia fuera
+        f = marco
+        while f is not None and bloqueo.comando is None:
+            bloqueo.comando = codigos_comando.get(f.f_code)
+            f = f.f_back
+        # Función culpable: la más interna que sea código del bot
+        propio = os.path.abspath(__file__)
+        f = marco
+        while f is not None:
+            if os.path.abspath(f.f_code.co_filename) == propio:
+                bloqueo.funcion = getattr(f.f_code, "co_qualname", f.f_code.co_name)
+                break
+            f = f.f_back
+
+    def _cerrar(self, bloqueo: Bloqueo):
+        self.total_bloqueos += 1
+        self.recientes.append(bloqueo)
+        registro_bucle.warning(
+            f"Bucle bloqueado {bloqueo.duracion_ms:.0f} ms | comando: {bloqueo.comando or '-'} | "
+            f"función: {bloqueo.funcion or '-'} | muestras: {bloqueo.muestras}\n    "
+            + "\n    ".join(bloqueo.pila)
+        )
+
+vigilante_bucle = VigilanteBucle(config.VIGILANTE_INTERVALO, config.UMBRAL_BLOQUEO_MS,
+                                 debug_asyncio=config.VIGILANTE_DEBUG_ASYNCIO)
+
+# =====================
+# PERFILADOR POR MUESTREO
+# =====================
+# Perfilador estadístico que el staff enciende en caliente (/perfilador-iniciar).
+# Un hilo toma la pila del hilo del bucle cada `intervalo` y cuenta pilas
+# iguales; no instrumenta nada, así que el coste es solo el de cada muestra.
+# Si ese coste pasa de SOBRECARGA_MAX del tiempo, el intervalo se alarga
+# solo. El resultado se escribe en data/perfiles/ en formato de pilas
+# colapsadas ("a;b;c N"), el que leen flamegraph.pl y speedscope.
+DIR_PERFILES = os.path.join("data", "perfiles")
+
+class PerfiladorMuestreo:
+    SOBRECARGA_MAX = 0.01   # fracción del tiempo que puede irse en muestrear
+    PROFUNDIDAD_MAX = 64
+
+    def __init__(self):
+        self.activo = False
+        self.ultimo = None     # resumen del último perfil terminado
+        self._hilo = None
+        self._parar = threading.Event()
+        self._hilo_bucle = None
+
+    def iniciar(self, segundos: float, intervalo_ms: float, comando: str = None):
+        """Arranca el muestreo en un hilo. Devuelve una tarea que acaba con el resumen"""
+        if self.activo:
+            raise RuntimeError("ya hay un perfil en marcha")
+        self.activo = True
+        self._parar.clear()
+        self._hilo_bucle = threading.get_ident()
+        estado = {
+            "inicio": datetime.datetime.now(),
+            "segundos": segundos,
+            "intervalo": intervalo_ms / 1000,
+            "comando": comando,
+            "pilas": collections.Counter(),
+            "muestras": 0,
+            "inactivo": 0,
+            "descartadas": 0,
+            "coste": 0.0,
+        }
+        self._hilo = threading.Thread(target=self._muestrear, args=(estado,), name="perfilador", daemon=True)
+        self._hilo.start()
+        return asyncio.get_running_loop().create_task(self._terminar(estado))
+
+    def detener(self):
+        self._parar.set()
+
+    async def _terminar(self, estado) -> dict:
+        await asyncio.to_thread(self._hilo.join)
+        try:
+            self.ultimo = await asyncio.to_thread(self._guardar, estado)
+        finally:
+            self.activo = False
+        return self.ultimo
+
+    def _muestrear(self, estado):
+        propio = os.path.abspath(__file__)
+        fin = time.monotonic() + estado["segundos"]
+        intervalo = estado["intervalo"]
+        codigos = {c for c, n in codigos_comando.items() if n == estado["comando"]} if estado["comando"] else None
+        while not self._parar.wait(intervalo) and time.monotonic() < fin:
+            # Tiempo de CPU del hilo: la espera por el GIL no es coste del muestreo
+            t = time.thread_time()
+            marco = sys._current_frames().get(self._hilo_bucle)
+            if marco is None:
+                break
+            pila, dentro = [], codigos is None
+            while marco is not None and len(pila) < self.PROFUNDIDAD_MAX:
+                codigo = marco.f_code
+                if codigos is not None and codigo in codigos:
+                    dentro = True
+                # La maquinaria de asyncio por encima de la tarea no aporta
+                if codigo.co_name == "_run" and codigo.co_filename.endswith(os.path.join("asyncio", "events.py")):
+                    break
+                archivo = "main" if os.path.abspath(codigo.co_filename) == propio else os.path.splitext(os.path.basename(codigo.co_filename))[0]
+                pila.append(f"{archivo}:{getattr(codigo, 'co_qualname', codigo.co_name)}")
+                marco = marco.f_back
+            del marco
+            if not pila or pila[0].startswith("selectors:"):
+                estado["inactivo"] += 1   # bucle esperando eventos
+            elif not dentro:
+                estado["descartadas"] += 1
+            else:
+                estado["pilas"][tuple(reversed(pila))] += 1
+            estado["muestras"] += 1
+            coste = time.thread_time() - t
+            estado["coste"] += coste
+            # Mantener la sobrecarga acotada
+            intervalo = max(intervalo, coste / self.SOBRECARGA_MAX)
+        estado["intervalo_final"] = intervalo
+
+    def _guardar(self, estado) -> dict:
+        pilas = estado["pilas"]
+        nombre = f"perfil-{estado['inicio']:%Y%m%d-%H%M%S}.folded"
+        ruta = os.path.join(DIR_PERFILES, nombre)
+        with open(ruta, "w", encoding="utf-8") as f:
+            for pila, n in pilas.most_common():
+                f.write(f"{';'.join(pila)} {n}\n")
+        propias, inclusivas, comandos = collections.Counter(), collections.Counter(), collections.Counter()
+        for pila, n in pilas.items():
+            propias[pila[-1]] += n
+            for funcion in set(pila):
+                inclusivas[funcion] += n
+        ocupadas = sum(pilas.values())
+        resumen = {
+            "archivo": ruta,
+            "inicio": estado["inicio"],
+            "comando": estado["comando"],
+            "muestras": estado["muestras"],
+            "ocupadas": ocupadas,
+            "inactivo": estado["inactivo"],
+            "descartadas": estado["descartadas"],
+            "intervalo_ms": estado.get("intervalo_final", estado["intervalo"]) * 1000,
+            "coste_ms": estado["coste"] * 1000,
+            "propias": propias.most_common(10),
+            "inclusivas": inclusivas.most_common(10),
+        }
+        logging.info(f"Perfil guardado en {ruta}: {estado['muestras']} muestras, {ocupadas} con el bucle ocupado")
+        return resumen
+
+perfilador = PerfiladorMuestreo()
+
+def embed_perfil(resumen: dict) -> discord.Embed:
+    embed = discord.Embed(title="🔬 Perfil de Ejecución", color=config.COLOR_INFO)
+    ocupadas = max(resumen["ocupadas"], 1)
+    embed.description = (
+        f"{resumen['muestras']} muestras cada {resumen['intervalo_ms']:.0f} ms • "
+        f"bucle ocupado en {resumen['ocupadas']}, inactivo en {resumen['inactivo']}"
+        + (f"\nSolo `/{resumen['comando']}` ({resumen['descartadas']} muestras de otro código descartadas)" if resumen["comando"] else "")
+    )
+    for titulo, filas in (("🔥 Tiempo propio", resumen["propias"]), ("📚 Tiempo inclusivo", resumen["inclusivas"])):
+        texto = "\n".join(f"`{n * 100 / ocupadas:5.1f}%` {funcion[:80]}" for funcion, n in filas[:8])
+        embed.add_field(name=titulo, value=texto or "Sin muestras", inline=False)
+    embed.add_field(name="📁 Pilas colapsadas", value=f"`{resumen['archivo']}`", inline=False)
+    embed.set_footer(text=f"{config.FOOTER_ADMINISTRATIVO} • Coste del muestreo {resumen['coste_ms']:.0f} ms")
+    return embed
+
+# =====================
+# ESCRITOR EN SEGUNDO PLANO
+# =====================
+# Hilos de E/S compartidos por los escritores de todas las particiones
+hilos_persistencia = ThreadPoolExecutor(max_workers=max(1, config.HILOS_PERSISTENCIA), thread_name_prefix="persistencia")
+
+class EscritorPersistencia:
+    """Agrupa los save_json pendientes de una partición y los escribe desde
+    un hilo.
+
+    Mientras la tarea está activa, save_json solo marca la tienda (y los uids)
+    como sucios; cada config.INTERVALO_GUARDADO segundos, o antes si se
+    acumulan config.UMBRAL_GUARDADO registros, se serializa lo pendiente y la
+    E/S se hace en hilos_persistencia para no frenar el bucle de eventos.
+    """
+
+    def __init__(self, particion, intervalo: float, umbral: int):
+        self.particion = particion
+        self.intervalo = intervalo
+        self.umbral = umbral
+        self._pendientes = {}  # key -> set de uids, o None = instantánea completa
+        self._n_pendientes = 0
+        self._despertar = None
+        self._lock = None
+        self._tarea = None
+
+    def activo(self) -> bool:
+        return self._tarea is not None and not self._tarea.done()
+
+    def iniciar(self):
+        if self.activo():
+            return
+        self._despertar = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._tarea = asyncio.get_running_loop().create_task(self._bucle())
+
+    def marcar(self, key, uids):
+        if not uids:
+            self._pendientes[key] = None
+        else:
+            actual = self._pendientes.setdefault(key, set())
+            if actual is not None:
+                actual.update(str(uid) for uid in uids)
+        self._n_pendientes += max(1, len(uids))
+        if self._n_pendientes >= self.umbral:
+            self._despertar.set()
+
+    def pendientes(self) -> int:
+        return self._n_pendientes
+
+    async def _bucle(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._despertar.wait(), timeout=self.intervalo)
+            except asyncio.TimeoutError:
+                pass
+            self._despertar.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logging.exception("Error guardando datos en segundo plano")
+
+    async def flush(self) -> int:
+        """Escribe ya todo lo pendiente. Devuelve cuántas tiendas se guardaron"""
+        async with self._lock:
+            return await self._volcar()
+
+    async def _volcar(self) -> int:
+        if not self._pendientes:
+            return 0
+        pendientes, self._pendientes, self._n_pendientes = self._pendientes, {}, 0
+        # Todo lo pendiente sale como un único lote atómico: las
+        # operaciones que tocan varias tiendas entran enteras o no entran
+        tx = nuevo_id_transaccion()
+        almacenes, datos = self.particion.almacenes, self.particion.datos
+        partes = [
+            (almacenes[key], almacenes[key].preparar(datos.get(key, {}), uids, tx))
+            for key, uids in pendientes.items()
+        ]
+        try:
+            # Los volcados de una partición van de uno en uno (bajo _lock),
+            # así que sus escrituras salen en orden aunque haya varios hilos
+            await asyncio.get_running_loop().run_in_executor(hilos_persistencia, escribir_lote, self.particion, tx, partes)
+        except Exception:
+            # Volver a marcarlas para reintentar en la siguiente pasada
+            for key, uids in pendientes.items():
+                self.marcar(key, uids)
+            raise
+        return len(partes)
+
+    @contextlib.asynccontextmanager
+    async def en_pausa(self):
+        """Vacía lo pendiente y no escribe nada más hasta salir del bloque,
+        para que lo que hay en disco no cambie (copias de seguridad)"""
+        if not self.activo():
+            yield
+            return
+        async with self._lock:
+            await self._volcar()
+            yield
+
+    async def detener(self):
+        """Para la tarea y vacía lo pendiente (al cerrar el bot)"""
+        if self._tarea is not None:
+            self._tarea.cancel()
+            self._tarea = None
+        if self._lock is not None:
+            await self.flush()
+
+# Escritor de la partición del servidor en curso
+escritor = PorParticion(lambda: particion_actual().escritor)
+
+# Estructuras derivadas (ranking, índices...) que se actualizan al guardar
+observadores_guardado = {}
+
+def observar_guardado(key):
+    """Decorador: llama a fn(uids) cada vez que se guardan registros de `key`
+    (uids vacío = la tienda entera ha podido cambiar). Se llama dentro de la
+    partición que guarda, así que un objeto PorParticion se actualiza solo en
+    ella si se registra como `lambda uids: objeto.metodo(uids)`"""
+    def decorador(fn):
+        observadores_guardado.setdefault(key, []).append(fn)
+        return fn
+    return decorador
+
+def avisar_guardado(key, uids):
+    for fn in observadores_guardado.get(key, ()):
+        fn(uids)
 
 # Helpers
-def save_json(key):
+def save_json(key, *uids):
+    """Persiste una tienda de la partición en curso.
+
+    Con `uids` solo se guardan esos registros (si un uid ya no está en la
+    tienda se registra su borrado); sin ellos se reescribe la tienda
+    completa. Con el bot en marcha la escritura la hace el escritor en
+    segundo plano; antes de arrancar se escribe en el momento. Con la base
+    compartida se escribe siempre en el momento y se avisa a los demás
+    procesos para que no sigan usando su copia.
+    """
     if key not in FILES:
         return
-    with open(FILES[key], "w", encoding="utf-8") as f:
-        json.dump(data.get(key, {}), f, indent=4, ensure_ascii=False)
+    inicio = time.perf_counter()
+    particion = particion_actual()
+    avisar_guardado(key, uids)
+    if particion.compartida and isinstance(particion.almacenes[key], TiendaSQLite):
+        particion.almacenes[key].guardar(None, uids)
+        cliente_estado.publicar(particion, key, uids)
+    elif particion.escritor.activo():
+        particion.escritor.marcar(key, uids)
+    else:
+        particion.almacenes[key].guardar(particion.datos.get(key, {}), uids)
+    anotar_guardado(inicio)
+
+# =====================
+# TRANSACCIONES SOBRE `data`
+# =====================
+_AUSENTE = object()
+
+class GestorBloqueos:
+    """Bloqueos asyncio por usuario para las operaciones con saldo.
+
+    Los bloqueos se crean al pedirlos y desaparecen solos (referencias
+    débiles) cuando nadie los tiene ni espera por ellos, así que el registro
+    no crece con el número de usuarios. Si una operación implica a varios
+    usuarios (transferencias, robos) se toman en orden de uid para que dos
+    operaciones cruzadas no puedan bloquearse mutuamente.
+    """
+
+    def __init__(self):
+        self._bloqueos = weakref.WeakValueDictionary()
+        self.adquisiciones = 0
+        self.contenciones = 0
+        self.espera_total = 0.0
+        self.espera_max = 0.0
+
+    def _bloqueo(self, uid: str) -> asyncio.Lock:
+        bloqueo = self._bloqueos.get(uid)
+        if bloqueo is None:
+            bloqueo = self._bloqueos[uid] = asyncio.Lock()
+        return bloqueo
+
+    @contextlib.asynccontextmanager
+    async def bloquear(self, *uids):
+        bloqueos = [self._bloqueo(uid) for uid in sorted({str(u) for u in uids})]
+        adquiridos = []
+        try:
+            for bloqueo in bloqueos:
+                if bloqueo.locked():
+                    # Contención: medir cuánto se espera
+                    self.contenciones += 1
+                    inicio = time.perf_counter()
+                    await bloqueo.acquire()
+                    espera = time.perf_counter() - inicio
+                    self.espera_total += espera
+                    self.espera_max = max(self.espera_max, espera)
+                else:
+                    await bloqueo.acquire()
+                adquiridos.append(bloqueo)
+                self.adquisiciones += 1
+            yield
+        finally:
+            for bloqueo in reversed(adquiridos):
+                bloqueo.release()
+
+    def estadisticas(self) -> dict:
+        return {
+            "activos": len(self._bloqueos),
+            "adquisiciones": self.adquisiciones,
+            "contenciones": self.contenciones,
+            "espera_media_ms": (self.espera_total / self.contenciones * 1000) if self.contenciones else 0.0,
+            "espera_max_ms": self.espera_max * 1000,
+        }
+
+# Bloqueos por partición: el mismo usuario en dos servidores no se espera
+gestor_bloqueos = PorParticion(GestorBloqueos)
+
+class Transaccion:
+    """Cambios de una operación económica sobre varias tiendas.
+
+    Cada registro que se vaya a modificar se pide con registro(), que guarda
+    una copia para poder deshacer. Al confirmar se guardan juntos todos los
+    registros tocados en un único lote atómico.
+    """
+
+    def __init__(self):
+        self.particion = particion_actual()
+        self._copias = {}  # (key, uid) -> copia previa o _AUSENTE
+
+    def registro(self, key: str, uid, defecto=None):
+        """Devuelve data[key][uid] (creándolo con `defecto` si falta) y lo
+        apunta como modificado"""
+        uid = str(uid)
+        tienda = self.particion.datos[key]
+        if (key, uid) not in self._copias:
+            self._copias[(key, uid)] = copy.deepcopy(tienda[uid]) if uid in tienda else _AUSENTE
+        if uid not in tienda and defecto is not None:
+            tienda[uid] = defecto
+        return tienda.get(uid)
+
+    def cambios(self) -> dict:
+        por_tienda = {}
+        for key, uid in self._copias:
+            por_tienda.setdefault(key, []).append(uid)
+        return por_tienda
+
+    def lote(self, cambios: dict) -> tuple:
+        """(tx, partes) para escribir_lote con los registros de `cambios`"""
+        tx = nuevo_id_transaccion()
+        almacenes, datos = self.particion.almacenes, self.particion.datos
+        return tx, [
+            (almacenes[key], almacenes[key].preparar(datos.get(key, {}), uids, tx))
+            for key, uids in cambios.items()
+        ]
+
+    def confirmar(self):
+        cambios = self.cambios()
+        if not cambios:
+            return
+        inicio = time.perf_counter()
+        particion = self.particion
+        with usar_particion(particion):
+            for key, uids in cambios.items():
+                avisar_guardado(key, uids)
+        if particion.escritor.activo():
+            # Marcado sin awaits de por medio: todo cae en el mismo lote
+            for key, uids in cambios.items():
+                particion.escritor.marcar(key, uids)
+        else:
+            escribir_lote(particion, *self.lote(cambios))
+        anotar_guardado(inicio)
+
+    async def confirmar_compartida(self, bloqueo):
+        """Confirmación con la base compartida: el lote se escribe ya, con los
+        bloqueos del servicio aún tomados, y sus registros se publican al
+        soltarlos para que el siguiente proceso lea lo escrito"""
+        cambios = self.cambios()
+        if not cambios:
+            return
+        inicio = time.perf_counter()
+        if not bloqueo.vigente():
+            raise ConnectionError("Se perdió la conexión con el servicio de estado durante la transacción")
+        try:
+            await asyncio.get_running_loop().run_in_executor(hilos_persistencia, escribir_lote, self.particion, *self.lote(cambios))
+        except asyncio.CancelledError:
+            # La escritura sigue en su hilo y puede llegar a la base: en vez
+            # de deshacer, que todos (también este proceso) relean de ella
+            for key, uids in cambios.items():
+                for uid in uids:
+                    self.particion.almacenes[key].olvidar(uid)
+                    bloqueo.cambios.append([self.particion.nombre, key, uid])
+            self._copias.clear()
+            raise
+        with usar_particion(self.particion):
+            for key, uids in cambios.items():
+                avisar_guardado(key, uids)
+                bloqueo.cambios.extend([self.particion.nombre, key, uid] for uid in uids)
+        anotar_guardado(inicio)
+
+    def deshacer(self):
+        datos = self.particion.datos
+        for (key, uid), copia in self._copias.items():
+            if copia is _AUSENTE:
+                datos[key].pop(uid, None)
+            else:
+                datos[key][uid] = copia
+        self._copias.clear()
+
+@contextlib.asynccontextmanager
+async def transaccion(*uids):
+    """Abre una transacción bloqueando a los usuarios implicados.
+
+    Uso:
+        async with transaccion(uid) as tx:
+            cuenta = tx.registro("cuentas", uid)
+            ...
+    Si el bloque lanza una excepción los cambios se deshacen; si termina
+    bien se confirman. Con la base compartida los usuarios se bloquean
+    también en el servicio de estado, para todos los procesos.
+    """
+    particion = particion_actual()
+    async with gestor_bloqueos.bloquear(*uids), cliente_estado.bloquear(particion, uids) as bloqueo:
+        tx = Transaccion()
+        try:
+            yield tx
+            if bloqueo is not None:
+                await tx.confirmar_compartida(bloqueo)
+        except BaseException:
+            tx.deshacer()
+            raise
+        if bloqueo is None:
+            tx.confirmar()
+
+# =====================
+# ESTADO COMPARTIDO ENTRE SHARDS
+# =====================
+# Con ALMACENAMIENTO = "compartido" cada proceso de shards lee y escribe la
+# misma base SQLite (en WAL) y se coordina con un servicio local
+# (python main.py servicio-estado) por TCP, con un mensaje JSON por línea:
+#   bloquear {id, claves}            -> concedido {id}
+#   liberar  {claves, cambios}       suelta los bloqueos y publica lo escrito
+#   cambios  {cambios}               registros guardados fuera de transacción
+# Las claves son "<partición>:<uid>" y se conceden en orden de llegada; los
+# cambios son [partición, tienda, uid] (uid None = la tienda entera; tienda
+# None = ese uid en todas las tiendas). El servicio reenvía los cambios a los
+# demás procesos antes de ceder los bloqueos, y cada proceso descarta esos
+# registros de su caché; así quien entra en una transacción ya ha visto lo
+# que escribió el anterior. Si un proceso se desconecta con bloqueos
+# tomados pudo escribir en la base sin publicarlo: antes de cederlos se
+# reenvía [partición, None, uid] por cada uno. Las lecturas sin transacción
+# pueden ir unos milisegundos por detrás.
+class _ConexionEstado:
+    """Proceso conectado al servicio de estado"""
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.claves = set()  # bloqueos que tiene concedidos
+        self.cerrada = False
+        self._salida = []
+
+    def enviar(self, linea: bytes):
+        # Lo de una misma vuelta del bucle sale en una sola escritura
+        if self.cerrada:
+            return
+        self._salida.append(linea)
+        if len(self._salida) == 1:
+            asyncio.get_running_loop().call_soon(self._vaciar)
+
+    def _vaciar(self):
+        if not self.cerrada:
+            self.writer.write(b"".join(self._salida))
+        self._salida.clear()
+
+class _PeticionBloqueo:
+    __slots__ = ("conexion", "id", "claves", "siguiente")
+
+    def __init__(self, conexion, id_peticion, claves):
+        self.conexion = conexion
+        self.id = id_peticion
+        self.claves = sorted(claves)
+        self.siguiente = 0  # claves[:siguiente] ya concedidas
+
+def _linea_estado(mensaje: dict) -> bytes:
+    return (json.dumps(mensaje, ensure_ascii=False) + "\n").encode("utf-8")
+
+class ServicioEstado:
+    """Bloqueos por clave y reparto de cambios entre los procesos de shards.
+
+    Cada petición toma sus claves en orden y espera en la cola de la primera
+    ocupada; como todas las piden ordenadas, dos transacciones cruzadas no se
+    bloquean mutuamente. Si un proceso se desconecta se sueltan sus bloqueos.
+    """
+
+    def __init__(self, host: str, puerto: int):
+        self.host = host
+        self.puerto = puerto
+        self._duenos = {}  # clave -> _ConexionEstado que la tiene
+        self._colas = {}   # clave -> deque de _PeticionBloqueo
+        self._conexiones = set()
+        self._servidor = None
+        self.concedidos = 0
+        self.esperas = 0
+        self.reenviados = 0
+
+    async def iniciar(self):
+        self._servidor = await asyncio.start_server(self._atender, self.host, self.puerto, limit=2 ** 20)
+        logging.info(f"Servicio de estado escuchando en {self.host}:{self.puerto}")
+
+    async def servir(self):
+        await self.iniciar()
+        async with self._servidor:
+            await self._servidor.serve_forever()
+
+    async def detener(self):
+        if self._servidor is not None:
+            self._servidor.close()
+            for conexion in list(self._conexiones):
+                conexion.writer.close()
+            await self._servidor.wait_closed()
+            self._servidor = None
+
+    def estadisticas(self) -> dict:
+        return {
+            "procesos": len(self._conexiones),
+            "bloqueos": len(self._duenos),
+            "concedidos": self.concedidos,
+            "esperas": self.esperas,
+            "cambios_reenviados": self.reenviados,
+        }
+
+    async def _atender(self, reader, writer):
+        conexion = _ConexionEstado(writer)
+        self._conexiones.add(conexion)
+        try:
+            async for linea in reader:
+                mensaje = json.loads(linea)
+                op = mensaje.get("op")
+                if op == "bloquear":
+                    self._avanzar(_PeticionBloqueo(conexion, mensaje["id"], mensaje["claves"]))
+                elif op == "liberar":
+                    # Primero los cambios: el siguiente en entrar ya los habrá recibido
+                    if mensaje.get("cambios"):
+                        self._reenviar(conexion, mensaje["cambios"])
+                    for clave in mensaje["claves"]:
+                        if self._duenos.get(clave) is conexion:
+                            self._soltar(clave)
+                elif op == "cambios":
+                    self._reenviar(conexion, mensaje["cambios"])
+        except (ConnectionError, ValueError) as e:
+            logging.warning(f"Servicio de estado: conexión cerrada ({type(e).__name__}: {e})")
+        except asyncio.CancelledError:
+            pass  # servicio apagándose: asyncio registraría la cancelación como error
+        finally:
+            conexion.cerrada = True
+            self._conexiones.discard(conexion)
+            if conexion.claves:
+                # Pudo escribir sin llegar a publicarlo: que los demás
+                # relean a esos usuarios antes de que entre el siguiente
+                perdidos = []
+                for clave in sorted(conexion.claves):
+                    nombre, _, uid = clave.rpartition(":")
+                    perdidos.append([nombre, None, uid])
+                self._reenviar(conexion, perdidos)
+            for clave in list(conexion.claves):
+                self._soltar(clave)
+            writer.close()
+
+    def _avanzar(self, peticion: _PeticionBloqueo):
+        """Toma las claves libres en orden; se queda en la cola de la primera ocupada"""
+        while peticion.siguiente < len(peticion.claves):
+            clave = peticion.claves[peticion.siguiente]
+            if clave in self._duenos:
+                self._colas.setdefault(clave, collections.deque()).append(peticion)
+                self.esperas += 1
+                return
+            self._duenos[clave] = peticion.conexion
+            peticion.conexion.claves.add(clave)
+            peticion.siguiente += 1
+        self.concedidos += 1
+        peticion.conexion.enviar(_linea_estado({"op": "concedido", "id": peticion.id}))
+
+    def _soltar(self, clave: str):
+        self._duenos.pop(clave).claves.discard(clave)
+        cola = self._colas.get(clave)
+        while cola:
+            peticion = cola.popleft()
+            if not peticion.conexion.cerrada:
+                self._avanzar(peticion)
+                break
+        if cola is not None and not cola:
+            del self._colas[clave]
+
+    def _reenviar(self, origen: _ConexionEstado, cambios: list):
+        linea = _linea_estado({"op": "cambios", "cambios": cambios})
+        for conexion in self._conexiones:
+            if conexion is not origen:
+                conexion.enviar(linea)
+        self.reenviados += len(cambios)
+
+class BloqueoCompartido:
+    """Bloqueos concedidos por el servicio a una transacción, con los cambios
+    que se publicarán al soltarlos"""
+
+    def __init__(self, cliente, claves: list):
+        self.cliente = cliente
+        self.claves = claves
+        self.conexion = cliente.conexiones
+        self.cambios = []
+
+    def vigente(self) -> bool:
+        """False si la conexión se cortó después de la concesión (el servicio
+        ya habrá soltado los bloqueos)"""
+        return self.cliente.conectado() and self.cliente.conexiones == self.conexion
+
+class ClienteEstado:
+    """Conexión de este proceso con el servicio de estado.
+
+    Se reconecta sola; sin conexión las transacciones fallan en vez de seguir
+    sin coordinar. Al reconectar se vacía la caché de la base compartida, por
+    si se perdió algún aviso de cambios.
+    """
+
+    def __init__(self, host: str, puerto: int):
+        self.host = host
+        self.puerto = puerto
+        self._writer = None
+        self._listo = None
+        self._tarea = None
+        self._esperas = {}  # id -> (futuro, claves)
+        self._ultimo_id = 0
+        self._salida = []  # mensajes de esta vuelta del bucle
+        self._sin_enviar = []  # cambios publicados mientras no había conexión
+        self.conexiones = 0
+        self.cambios_recibidos = 0
+
+    def conectado(self) -> bool:
+        return self._writer is not None
+
+    def iniciar(self):
+        if self._tarea is not None and not self._tarea.done():
+            return
+        self._listo = asyncio.Event()
+        self._tarea = asyncio.get_running_loop().create_task(self._bucle())
+
+    async def detener(self):
+        if self._tarea is not None:
+            self._tarea.cancel()
+            self._tarea = None
+
+    async def esperar_conexion(self, espera: float):
+        if self.conectado():
+            return
+        if self._listo is None:
+            raise ConnectionError("El cliente del servicio de estado no está iniciado")
+        try:
+            await asyncio.wait_for(self._listo.wait(), timeout=espera)
+        except asyncio.TimeoutError:
+            raise ConnectionError(f"Sin conexión con el servicio de estado ({self.host}:{self.puerto})") from None
+
+    async def _bucle(self):
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection(self.host, self.puerto, limit=2 ** 20)
+            except OSError as e:
+                logging.warning(f"Servicio de estado no disponible en {self.host}:{self.puerto} ({e}); reintentando")
+                await asyncio.sleep(1)
+                continue
+            self._writer = writer
+            self.conexiones += 1
+            self._olvidar_todo()
+            if self._sin_enviar:
+                self._enviar({"op": "cambios", "cambios": self._sin_enviar})
+                self._sin_enviar = []
+            self._listo.set()
+            logging.info(f"Conectado al servicio de estado en {self.host}:{self.puerto} como {config.PROCESO}")
+            try:
+                async for linea in reader:
+                    self._recibir(json.loads(linea))
+                logging.warning("El servicio de estado cerró la conexión")
+            except (ConnectionError, ValueError) as e:
+                logging.warning(f"Conexión con el servicio de estado perdida ({type(e).__name__}: {e})")
+            finally:
+                self._listo.clear()
+                self._writer = None
+                writer.close()
+                for futuro, _ in self._esperas.values():
+                    if not futuro.done():
+                        futuro.set_exception(ConnectionError("Conexión con el servicio de estado perdida"))
+                self._esperas.clear()
+            await asyncio.sleep(1)
+
+    def _enviar(self, mensaje: dict):
+        # Lo de una misma vuelta del bucle sale en una sola escritura
+        self._salida.append(mensaje)
+        if len(self._salida) == 1:
+            if self._writer is None:
+                self._vaciar()
+            else:
+                asyncio.get_running_loop().call_soon(self._vaciar)
+
+    def _vaciar(self):
+        if self._writer is None:
+            # Los bloqueos ya los soltó el servicio; los cambios salen al reconectar
+            for mensaje in self._salida:
+                self._sin_enviar.extend(mensaje.get("cambios") or ())
+        else:
+            self._writer.write(b"".join(map(_linea_estado, self._salida)))
+        self._salida.clear()
+
+    def _recibir(self, mensaje: dict):
+        op = mensaje.get("op")
+        if op == "concedido":
+            espera = self._esperas.pop(mensaje["id"], None)
+            if espera is None:
+                return
+            futuro, claves = espera
+            if futuro.done():
+                # Quien lo pidió se canceló mientras esperaba
+                self._enviar({"op": "liberar", "claves": claves})
+            else:
+                futuro.set_result(None)
+        elif op == "cambios":
+            self.cambios_recibidos += len(mensaje["cambios"])
+            self._aplicar(mensaje["cambios"])
+
+    def _aplicar(self, cambios: list):
+        """Descarta de la caché lo que han escrito otros procesos y avisa a
+        los observadores (ranking, índices...)"""
+        por_tienda = {}  # (partición, key) -> uids, o None = la tienda entera
+        for nombre, tienda, uid in cambios:
+            particion = particiones.abierta(nombre)
+            if particion is None:
+                continue
+            for key in (particion.almacenes if tienda is None else (tienda,)):
+                almacen = particion.almacenes.get(key)
+                if not isinstance(almacen, TiendaSQLite):
+                    continue
+                almacen.olvidar(uid)
+                if uid is None:
+                    por_tienda[(particion, key)] = None
+                elif por_tienda.setdefault((particion, key), []) is not None:
+                    por_tienda[(particion, key)].append(uid)
+        for (particion, key), uids in por_tienda.items():
+            if particion.datos.cargada(key):
+                with usar_particion(particion):
+                    avisar_guardado(key, uids or ())
+
+    def _olvidar_todo(self):
+        for particion in particiones.todas():
+            for key, almacen in particion.almacenes.items():
+                if isinstance(almacen, TiendaSQLite) and (almacen._cache or almacen._borrados):
+                    almacen.olvidar()
+                    with usar_particion(particion):
+                        avisar_guardado(key, ())
+
+    @contextlib.asynccontextmanager
+    async def bloquear(self, particion, uids):
+        """Bloquea `uids` en todos los procesos. Devuelve un BloqueoCompartido,
+        o None si la partición no usa la base compartida"""
+        if not particion.compartida:
+            yield None
+            return
+        await self.esperar_conexion(config.ESTADO_ESPERA)
+        claves = sorted({f"{particion.nombre}:{uid}" for uid in uids})
+        self._ultimo_id += 1
+        futuro = asyncio.get_running_loop().create_future()
+        self._esperas[self._ultimo_id] = (futuro, claves)
+        self._enviar({"op": "bloquear", "id": self._ultimo_id, "claves": claves})
+        await futuro
+        bloqueo = BloqueoCompartido(self, claves)
+        try:
+            yield bloqueo
+        finally:
+            self._enviar({"op": "liberar", "claves": claves, "cambios": bloqueo.cambios})
+
+    def publicar(self, particion, key: str, uids):
+        """Avisa a los demás procesos de registros guardados fuera de una transacción"""
+        cambios = [[particion.nombre, key, str(uid)] for uid in uids] or [[particion.nombre, key, None]]
+        self._enviar({"op": "cambios", "cambios": cambios})
+
+servicio_estado = ServicioEstado(config.ESTADO_HOST, config.ESTADO_PUERTO)
+cliente_estado = ClienteEstado(config.ESTADO_HOST, config.ESTADO_PUERTO)
+
+# =====================
+# COLA DE NOTIFICACIONES
+# =====================
+# Todos los MD salen por aquí: quien notifica solo encola y sigue. Unos pocos
+# trabajadores entregan respetando un cubo de tokens por ruta, reintentan con
+# espera exponencial ante 429/5xx y lo que no se puede entregar se apunta en
+# ARCHIVO_NOTIFICACIONES_FALLIDAS.
+ARCHIVO_NOTIFICACIONES_FALLIDAS = os.path.join(DATA_DIR, "notificaciones_fallidas.jsonl")
+
+class CuboTokens:
+    """Cubo de tokens: hasta `capacidad` envíos seguidos y `por_segundo` de media"""
+
+    def __init__(self, capacidad: float, por_segundo: float):
+        self.capacidad = capacidad
+        self.por_segundo = por_segundo
+        self._tokens = capacidad
+        self._ultimo = time.monotonic()
+
+    async def tomar(self):
+        while True:
+            ahora = time.monotonic()
+            self._tokens = min(self.capacidad, self._tokens + (ahora - self._ultimo) * self.por_segundo)
+            self._ultimo = ahora
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.por_segundo)
+
+class Notificacion:
+    __slots__ = ("destino", "contenido", "embed", "ruta", "intentos", "encolada")
+
+    def __init__(self, destino, contenido, embed, ruta):
+        self.destino = int(destino)
+        self.contenido = contenido
+        self.embed = embed
+        self.ruta = ruta
+        self.intentos = 0
+        self.encolada = time.monotonic()
+
+class ColaNotificaciones:
+    """Cola acotada de MD con N trabajadores, límites por ruta y reintentos"""
+
+    # ruta -> (capacidad, por segundo); la ruta "md" es la de los MD a usuarios
+    RUTAS = {"md": (5, 2.0)}
+    INTENTOS_MAX = 5
+    ESPERA_BASE = 1.0
+
+    def __init__(self, trabajadores: int, tamano_max: int):
+        self.trabajadores = trabajadores
+        self.tamano_max = tamano_max
+        self._cola = None
+        self._tareas = []
+        self._cubos = {}
+        self._reintentos_pendientes = set()
+        self.enviadas = 0
+        self.fallidas = 0
+        self.reintentos = 0
+        self.limitadas = 0
+        self._latencia_total = 0.0
+        self._latencia_max = 0.0
+
+    def iniciar(self):
+        if self._tareas:
+            return
+        self._cola = asyncio.Queue(maxsize=self.tamano_max)
+        loop = asyncio.get_running_loop()
+        self._tareas = [loop.create_task(self._trabajador()) for _ in range(self.trabajadores)]
+
+    def encolar(self, destino, contenido: str = None, embed: discord.Embed = None, ruta: str = "md"):
+        """Programa un MD para `destino` (usuario o id). No espera al envío"""
+        notif = Notificacion(getattr(destino, "id", destino), contenido, embed, ruta)
+        if self._cola is None:
+            self._descartar(notif, "cola parada")
+            return
+        try:
+            self._cola.put_nowait(notif)
+        except asyncio.QueueFull:
+            self._descartar(notif, "cola llena")
+
+    def _cubo(self, ruta) -> CuboTokens:
+        if ruta not in self._cubos:
+            self._cubos[ruta] = CuboTokens(*self.RUTAS.get(ruta, self.RUTAS["md"]))
+        return self._cubos[ruta]
+
+    def _descartar(self, notif: Notificacion, motivo: str):
+        self.fallidas += 1
+        logging.warning(f"Notificación a {notif.destino} descartada: {motivo}")
+        entrada = {
+            "destino": notif.destino,
+            "ruta": notif.ruta,
+            "contenido": notif.contenido,
+            "embed": notif.embed.to_dict() if notif.embed else None,
+            "intentos": notif.intentos,
+            "motivo": motivo,
+            "fecha": datetime.datetime.now().isoformat(timespec="seconds"),
+        }
+        try:
+            with open(ARCHIVO_NOTIFICACIONES_FALLIDAS, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entrada, ensure_ascii=False) + "\n")
+        except OSError:
+            logging.exception("No se pudo apuntar la notificación fallida")
+
+    def _reintentar(self, notif: Notificacion, espera: float):
+        # Se vuelve a encolar más tarde sin ocupar a un trabajador mientras tanto
+        self.reintentos += 1
+        def volver():
+            self._reintentos_pendientes.discard(handle)
+            if self._cola is None:
+                self._descartar(notif, "cola parada")
+                return
+            try:
+                self._cola.put_nowait(notif)
+            except asyncio.QueueFull:
+                self._descartar(notif, "cola llena")
+        handle = asyncio.get_running_loop().call_later(espera, volver)
+        self._reintentos_pendientes.add(handle)
+
+    async def _entregar(self, notif: Notificacion):
+        await self._cubo(notif.ruta).tomar()
+        user = bot.get_user(notif.destino) or await bot.fetch_user(notif.destino)
+        await user.send(content=notif.contenido, embed=notif.embed)
+
+    async def _trabajador(self):
+        while True:
+            notif = await self._cola.get()
+            try:
+                notif.intentos += 1
+                await self._entregar(notif)
+                latencia = time.monotonic() - notif.encolada
+                self.enviadas += 1
+                self._latencia_total += latencia
+                self._latencia_max = max(self._latencia_max, latencia)
+            except asyncio.CancelledError:
+                raise
+            except (discord.Forbidden, discord.NotFound) as e:
+                # MD cerrados o usuario inexistente: reintentar no sirve
+                self._descartar(notif, f"{type(e).__name__}: {e}")
+            except discord.HTTPException as e:
+                if e.status != 429 and e.status < 500:
+                    self._descartar(notif, f"HTTP {e.status}: {e}")
+                elif notif.intentos >= self.INTENTOS_MAX:
+                    self._descartar(notif, f"HTTP {e.status} tras {notif.intentos} intentos")
+                else:
+                    if e.status == 429:
+                        self.limitadas += 1
+                    espera = self.ESPERA_BASE * 2 ** (notif.intentos - 1)
+                    self._reintentar(notif, max(espera, getattr(e, "retry_after", 0) or 0))
+            except Exception as e:
+                logging.exception(f"Error enviando notificación a {notif.destino}")
+                self._descartar(notif, f"{type(e).__name__}: {e}")
+            finally:
+                self._cola.task_done()
+
+    def estadisticas(self) -> dict:
+        return {
+            "en_cola": self._cola.qsize() if self._cola else 0,
+            "reintentos_programados": len(self._reintentos_pendientes),
+            "enviadas": self.enviadas,
+            "fallidas": self.fallidas,
+            "reintentos": self.reintentos,
+            "limitadas_429": self.limitadas,
+            "latencia_media_ms": (self._latencia_total / self.enviadas * 1000) if self.enviadas else 0.0,
+            "latencia_max_ms": self._latencia_max * 1000,
+        }
+
+    async def detener(self, espera: float = 5.0):
+        """Da unos segundos para vaciar la cola y para los trabajadores"""
+        if self._cola is not None and self._tareas:
+            try:
+                await asyncio.wait_for(self._cola.join(), timeout=espera)
+            except asyncio.TimeoutError:
+                pass
+        for handle in self._reintentos_pendientes:
+            handle.cancel()
+        self._reintentos_pendientes.clear()
+        for tarea in self._tareas:
+            tarea.cancel()
+        self._tareas = []
+        if self._cola is not None:
+            while not self._cola.empty():
+                self._descartar(self._cola.get_nowait(), "bot cerrado")
+        self._cola = None
+
+notificaciones = ColaNotificaciones(config.NOTIF_TRABAJADORES, config.NOTIF_COLA_MAX)
+
+def importar_json_a_sqlite():
+    """Migración: copia los JSON actuales a las tablas SQLite (todas las particiones)"""
+    for particion in particiones.en_disco():
+        for key in tiendas_sqlite():
+            tienda = TiendaSQLite(key, particion.files[key], particion)
+            particion.conexion_sqlite(escritura=True).execute(f'CREATE TABLE IF NOT EXISTS "{key}" (uid TEXT PRIMARY KEY, valor TEXT NOT NULL) WITHOUT ROWID')
+            tienda.importar_json()
+
+def exportar_sqlite_a_json():
+    """Migración inversa: vuelca las tablas SQLite a sus JSON (todas las particiones)"""
+    for particion in particiones.en_disco():
+        for key in tiendas_sqlite():
+            tienda = TiendaSQLite(key, particion.files[key], particion).cargar()
+            tienda.exportar_json()
+
+# =====================
+# COPIAS DE SEGURIDAD
+# =====================
+# Cada copia es una carpeta backups/<AAAAmmdd-HHMMSS> de su partición con un
+# <tienda>.json.gz por tienda y un manifiesto.json. Se hacen con el escritor en
+# pausa para que todas las tiendas salgan del mismo instante, y la lectura y
+# compresión van en un hilo, tienda a tienda, sin copiar `data` en memoria.
+# Una tienda cuyos archivos no han cambiado desde la copia anterior se enlaza
+# (hard link) a la de esa copia en vez de volver a comprimirse. Las funciones
+# reciben la partición porque se ejecutan en hilos, fuera de su contexto.
+def firma_tienda(particion, key: str):
+    """Tamaño y fecha de los archivos de la tienda (versión de la tabla en
+    SQLite, cuya base comparten todas): si no cambian, su contenido tampoco"""
+    if isinstance(particion.almacenes[key], TiendaSQLite):
+        return ["sqlite", version_tabla(particion, key)]
+    paths = [particion.files[key], particion.files[key] + ".log"]
+    firma = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+            firma.append([st.st_size, st.st_mtime_ns])
+        except FileNotFoundError:
+            firma.append(None)
+    return firma
+
+def version_tabla(particion, key: str):
+    """Versión de la tabla en _versiones (None si aún no se ha escrito)"""
+    if not os.path.exists(particion.sqlite_archivo):
+        return None
+    conn = sqlite3.connect(particion.sqlite_archivo)
+    try:
+        fila = conn.execute("SELECT version FROM _versiones WHERE tabla = ?", (key,)).fetchone()
+    except sqlite3.OperationalError:
+        fila = None  # base anterior a _versiones
+    finally:
+        conn.close()
+    return fila[0] if fila else None
+
+def volcar_tienda(particion, key: str, f) -> int:
+    """Escribe en `f` el contenido actual de una tienda leído de disco (sin
+    tocar `data`) como un objeto JSON. Devuelve el número de registros.
+
+    En SQLite se recorre la tabla fila a fila y cada `valor`, que ya es
+    JSON, se escribe tal cual: la copia no guarda la tabla en memoria. Una
+    tienda JSON sí se carga entera, porque el diario solo tiene sentido
+    aplicado sobre la instantánea; es la tienda de un solo archivo que ya se
+    carga así al arrancar, y se copia de una en una."""
+    if not isinstance(particion.almacenes[key], TiendaSQLite):
+        valor = DiarioJSON(key, particion.files[key], particion).cargar()
+        json.dump(valor, f, ensure_ascii=False)
+        return len(valor)
+    conn = sqlite3.connect(particion.sqlite_archivo)
+    registros = 0
+    try:
+        f.write("{")
+        try:
+            for uid, valor in conn.execute(f'SELECT uid, valor FROM "{key}"'):
+                f.write(f'{", " if registros else ""}{json.dumps(uid, ensure_ascii=False)}: {valor}')
+                registros += 1
+        except sqlite3.OperationalError:
+            pass  # tabla aún no creada
+        f.write("}")
+    finally:
+        conn.close()
+    return registros
+
+def listar_copias(particion) -> list:
+    """Ids de las copias completas, de la más antigua a la más reciente"""
+    if not os.path.isdir(particion.dir_copias):
+        return []
+    return sorted(
+        nombre for nombre in os.listdir(particion.dir_copias)
+        if os.path.exists(os.path.join(particion.dir_copias, nombre, "manifiesto.json"))
+    )
+
+def leer_manifiesto(particion, id_copia: str) -> dict:
+    with open(os.path.join(particion.dir_copias, id_copia, "manifiesto.json"), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def crear_copia(particion, id_copia: str) -> dict:
+    """Escribe la copia `id_copia` (en un hilo, con el escritor en pausa)"""
+    anterior = listar_copias(particion)[-1:]
+    manifiesto_anterior = leer_manifiesto(particion, anterior[0]) if anterior else {"tiendas": {}}
+    destino = os.path.join(particion.dir_copias, id_copia)
+    temporal = destino + ".tmp"
+    os.makedirs(temporal, exist_ok=True)
+    tiendas = {}
+    for key in particion.files:
+        archivo = f"{key}.json.gz"
+        firma = firma_tienda(particion, key)
+        previa = manifiesto_anterior["tiendas"].get(key)
+        if previa and previa["firma"] == firma:
+            try:
+                os.link(os.path.join(particion.dir_copias, anterior[0], archivo), os.path.join(temporal, archivo))
+                tiendas[key] = {"firma": firma, "registros": previa["registros"], "enlazada": True}
+                continue
+            except OSError:
+                pass  # sin hard links (o copia anterior incompleta): se comprime otra vez
+        try:
+            with gzip.open(os.path.join(temporal, archivo), "wt", encoding="utf-8", compresslevel=6) as f:
+                registros = volcar_tienda(particion, key, f)
+        except Exception:
+            logging.exception(f"Copia {id_copia} de {particion}: no se pudo leer '{key}'")
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(os.path.join(temporal, archivo))
+            continue
+        tiendas[key] = {"firma": firma, "registros": registros, "enlazada": False}
+    manifiesto = {"creada": datetime.datetime.now().isoformat(timespec="seconds"), "tiendas": tiendas}
+    with open(os.path.join(temporal, "manifiesto.json"), "w", encoding="utf-8") as f:
+        json.dump(manifiesto, f, indent=4)
+    # La carpeta solo aparece con su nombre definitivo cuando está completa
+    os.replace(temporal, destino)
+    return manifiesto
+
+def copias_a_conservar(ids: list, horarias: int, diarias: int, semanales: int) -> set:
+    """Retención por niveles: las últimas `horarias` copias, la más reciente de
+    cada uno de los últimos `diarias` días y de las últimas `semanales` semanas"""
+    fechas = {i: datetime.datetime.strptime(i, "%Y%m%d-%H%M%S") for i in ids}
+    recientes = sorted(ids, reverse=True)
+    conservar = set(recientes[:horarias])
+    for clave, cupo in ((lambda f: f.date(), diarias), (lambda f: f.isocalendar()[:2], semanales)):
+        vistos = set()
+        for i in recientes:
+            periodo = clave(fechas[i])
+            if periodo not in vistos and len(vistos) < cupo:
+                vistos.add(periodo)
+                conservar.add(i)
+    return conservar
+
+def podar_copias(particion) -> list:
+    ids = listar_copias(particion)
+    conservar = copias_a_conservar(ids, config.COPIAS_HORARIAS, config.COPIAS_DIARIAS, config.COPIAS_SEMANALES)
+    borradas = [i for i in ids if i not in conservar]
+    for i in borradas:
+        shutil.rmtree(os.path.join(particion.dir_copias, i), ignore_errors=True)
+    # Restos de copias que se cortaron a medias
+    for nombre in os.listdir(particion.dir_copias):
+        if nombre.endswith(".tmp"):
+            shutil.rmtree(os.path.join(particion.dir_copias, nombre), ignore_errors=True)
+    return borradas
+
+def restaurar_tienda(particion, key: str, valor):
+    """Sustituye en disco una tienda entera por `valor` (en un hilo)"""
+    almacen = particion.almacenes[key]
+    if isinstance(almacen, TiendaSQLite):
+        almacen.cargar()  # crea la tabla si aún no existe
+        conn = particion.conexion_sqlite(escritura=True)
+        with particion.escritura:
+            conn.execute("BEGIN")
+            try:
+                conn.execute(f'DELETE FROM "{key}"')
+                conn.executemany(
+                    almacen._sql_escribir,
+                    ((str(uid), a_json(v)) for uid, v in valor.items())
+                )
+                conn.execute(SQL_SUBIR_VERSION, (key,))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+    else:
+        almacen.compactar(valor)
+
+def leer_tienda_de_copia(particion, id_copia: str, key: str):
+    with gzip.open(os.path.join(particion.dir_copias, id_copia, f"{key}.json.gz"), "rt", encoding="utf-8") as f:
+        return json.load(f)
+
+class ServicioCopias:
+    """Tarea que hace una copia de una partición cada `intervalo` segundos y
+    poda las viejas"""
+
+    def __init__(self, particion, intervalo: float):
+        self.particion = particion
+        self.intervalo = intervalo
+        self._tarea = None
+        self._lock = asyncio.Lock()
+        self.ultima = None
+
+    def iniciar(self):
+        # Con shards solo copia el proceso coordinador
+        if self.intervalo > 0 and config.COORDINADOR and (self._tarea is None or self._tarea.done()):
+            self._tarea = asyncio.get_running_loop().create_task(self._bucle())
+
+    async def detener(self):
+        if self._tarea is not None:
+            self._tarea.cancel()
+            self._tarea = None
+
+    async def _bucle(self):
+        while True:
+            await asyncio.sleep(self.intervalo)
+            try:
+                await self.copiar()
+            except Exception:
+                logging.exception(f"Error creando la copia de seguridad de la {self.particion}")
+
+    def listar(self) -> list:
+        return listar_copias(self.particion)
+
+    def manifiesto(self, id_copia: str) -> dict:
+        return leer_manifiesto(self.particion, id_copia)
+
+    async def copiar(self) -> tuple:
+        """Hace una copia ahora. Devuelve (id, manifiesto)"""
+        loop = asyncio.get_running_loop()
+        particion = self.particion
+        async with self._lock:
+            id_copia = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+            if id_copia in self.listar():
+                return id_copia, self.manifiesto(id_copia)
+            inicio = time.perf_counter()
+            async with particion.escritor.en_pausa():
+                manifiesto = await loop.run_in_executor(None, crear_copia, particion, id_copia)
+            borradas = await loop.run_in_executor(None, podar_copias, particion)
+            enlazadas = sum(1 for t in manifiesto["tiendas"].values() if t["enlazada"])
+            logging.info(
+                f"Copia {id_copia} de {particion}: {len(manifiesto['tiendas'])} tiendas ({enlazadas} sin cambios) "
+                f"en {time.perf_counter() - inicio:.1f}s; {len(borradas)} copias antiguas borradas"
+            )
+            self.ultima = id_copia
+            return id_copia, manifiesto
+
+    async def restaurar(self, id_copia: str, claves=None) -> list:
+        """Vuelve las tiendas (todas o `claves`) al estado de la copia"""
+        loop = asyncio.get_running_loop()
+        particion = self.particion
+        manifiesto = self.manifiesto(id_copia)
+        claves = [k for k in (claves or manifiesto["tiendas"]) if k in manifiesto["tiendas"] and k in FILES]
+        async with self._lock:
+            async with particion.escritor.en_pausa():
+                for key in claves:
+                    valor = await loop.run_in_executor(None, leer_tienda_de_copia, particion, id_copia, key)
+                    await loop.run_in_executor(None, restaurar_tienda, particion, key, valor)
+                    tipar_tienda(key, valor)
+                    almacen = particion.almacenes[key]
+                    if isinstance(almacen, TiendaSQLite):
+                        almacen.olvidar()
+                        dict.__setitem__(particion.datos, key, almacen)
+                        if particion.compartida:
+                            cliente_estado.publicar(particion, key, ())
+                    else:
+                        dict.__setitem__(particion.datos, key, valor)
+                    with usar_particion(particion):
+                        avisar_guardado(key, ())
+        logging.warning(f"Restauradas {len(claves)} tiendas de la {particion} desde la copia {id_copia}")
+        return claves
+
+# Copias de la partición del servidor en curso
+servicio_copias = PorParticion(lambda: ServicioCopias(particion_actual(), config.INTERVALO_COPIAS), servicio=True)
+
+def restaurar_copia_sin_bot(id_copia: str, particion=None):
+    """Restauración desde la línea de comandos, con el bot apagado"""
+    particion = particion or particiones.principal()
+    manifiesto = leer_manifiesto(particion, id_copia)
+    for key in manifiesto["tiendas"]:
+        if key in FILES:
+            restaurar_tienda(particion, key, leer_tienda_de_copia(particion, id_copia, key))
+    return list(manifiesto["tiendas"])
 
 def generar_dni():
     return str(random.randint(10000000, 99999999)) + random.choice(string.ascii_uppercase)
 
+# =====================
+# ÍNDICE DE MULTAS
+# =====================
+class IndiceMultas:
+    """Índice código de multa -> (uid, posición en su lista).
+
+    Se construye al arrancar y se rehace por usuario cada vez que se guardan
+    sus multas, así que pagar o eliminar por código no recorre el historial
+    de todo el servidor.
+    """
+
+    def __init__(self):
+        self._codigos = {}  # codigo -> (uid, posicion)
+        self._por_usuario = {}  # uid -> códigos indexados
+        self._listo = False
+
+    def reconstruir(self):
+        multas = data["multas"]
+        self._codigos.clear()
+        self._por_usuario.clear()
+        for uid, lista in multas.items():
+            self._indexar(uid, lista)
+        self._listo = True
+
+    def _indexar(self, uid, lista):
+        codigos = set()
+        for pos, multa in enumerate(lista or ()):
+            self._codigos[multa["codigo"]] = (uid, pos)
+            codigos.add(multa["codigo"])
+        self._por_usuario[uid] = codigos
+
+    def actualizar(self, uids):
+        if not self._listo:
+            return  # se construirá entero en la primera consulta
+        if not uids:
+            self.reconstruir()
+            return
+        for uid in uids:
+            uid = str(uid)
+            for codigo in self._por_usuario.pop(uid, ()):
+                if self._codigos.get(codigo, (None,))[0] == uid:
+                    del self._codigos[codigo]
+            if uid in data["multas"]:
+                self._indexar(uid, data["multas"][uid])
+
+    def buscar(self, codigo):
+        """Devuelve (uid, posicion, multa) o None si el código no existe"""
+        if not self._listo:
+            self.reconstruir()
+        entrada = self._codigos.get(codigo)
+        if entrada is None:
+            return None
+        uid, pos = entrada
+        lista = data["multas"].get(uid) or []
+        if pos < len(lista) and lista[pos]["codigo"] == codigo:
+            return uid, pos, lista[pos]
+        # Lista modificada sin pasar por save_json: reindexar a ese usuario
+        logging.warning(f"Índice de multas desfasado para {uid}; reindexando")
+        self.actualizar([uid])
+        entrada = self._codigos.get(codigo)
+        if entrada is None:
+            return None
+        uid, pos = entrada
+        return uid, pos, data["multas"][uid][pos]
+
+    def __contains__(self, codigo):
+        if not self._listo:
+            self.reconstruir()
+        return codigo in self._codigos
+
+indice_multas = PorParticion(IndiceMultas)
+observar_guardado("multas")(lambda uids: indice_multas.actualizar(uids))
+
 def generar_codigo_multa():
-    return "M" + "".join(random.choices(string.digits, k=10))
+    while True:
+        codigo = "M" + "".join(random.choices(string.digits, k=10))
+        if codigo not in indice_multas:
+            return codigo
 
 # =====================
 # UTILIDADES MEJORADAS
 # =====================
+# Sueldo por ID de rol: se cobra el del rol mejor pagado
+SUELDOS_ROLES = {
+    1401538045567565875: 1900,
+    1401538045567565876: 1800,
+    1401538045567565877: 1770,
+    1401538045567565881: 1500,
+    1401538045567565882: 1400,
+    1401538045567565883: 1267,
+    1401538045584605204: 1800,
+    1401538045584605205: 1700,
+    1401538045584605206: 1500,
+    1401538045634674790: 600
+}
+SUELDO_POR_DEFECTO = 1200  # Sueldo por defecto si no tiene rol de trabajo
+
+# Configuración por servidor: data/config/servidores/<id>.json, por ejemplo
+#   {"STAFF_ROLE_ID": 123, "CANAL_SOLICITUDES": 456, "SUELDOS_ROLES": {"789": 1500}}
+# Lo que no aparezca toma el valor de Config / SUELDOS_ROLES, así que el
+# servidor para el que se escribió el bot no necesita archivo.
+DIR_CONFIG_SERVIDORES = os.path.join(DATA_DIR, "config", "servidores")
+
+class ConfigServidor:
+    """Roles, canales y sueldos de un servidor"""
+
+    IDS = (
+        "STAFF_ROLE_ID", "ECONOMIA_ROLE_ID", "ROL_POLICIA_ID", "ROL_POLICIA_MULTAS_ID",
+        "ROL_VERIFICADO", "ROL_REVISION_DNI", "CANAL_VERIFICACIONES", "CANAL_SOLICITUDES",
+        "CANAL_REVISION_DNI",
+    )
+
+    def __init__(self, servidor, ajustes: dict):
+        self.servidor = servidor
+        for clave in self.IDS:
+            setattr(self, clave, int(ajustes.get(clave, getattr(config, clave))))
+        sueldos = ajustes.get("SUELDOS_ROLES")
+        self.SUELDOS_ROLES = SUELDOS_ROLES if sueldos is None else {int(rol): int(s) for rol, s in sueldos.items()}
+        self.SUELDO_POR_DEFECTO = int(ajustes.get("SUELDO_POR_DEFECTO", SUELDO_POR_DEFECTO))
+
+    @classmethod
+    def leer(cls, servidor) -> "ConfigServidor":
+        ajustes = {}
+        path = os.path.join(DIR_CONFIG_SERVIDORES, f"{servidor}.json")
+        if servidor is not None and os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    ajustes = json.load(f)
+            except (OSError, ValueError):
+                logging.exception(f"Configuración ilegible en '{path}'; se usan los valores por defecto")
+        return cls(servidor, ajustes)
+
+# id de servidor -> ConfigServidor (se lee una vez; /config-servidor la recarga)
+_configs_servidor = {}
+
+def config_servidor(servidor) -> ConfigServidor:
+    """Configuración del servidor `servidor` (id, Guild o None)"""
+    if isinstance(servidor, discord.Guild):
+        servidor = servidor.id
+    servidor = int(servidor) if servidor is not None else None
+    ajustes = _configs_servidor.get(servidor)
+    if ajustes is None:
+        ajustes = _configs_servidor[servidor] = ConfigServidor.leer(servidor)
+    return ajustes
+
+class CapacidadesRol:
+    """Lo que permiten los roles de un miembro, calculado una sola vez"""
+    __slots__ = ("roles", "staff", "economia", "policia", "sueldo", "rol_sueldo")
+
+    def __init__(self, roles: frozenset, ajustes: ConfigServidor):
+        sueldos = ajustes.SUELDOS_ROLES
+        self.roles = roles
+        self.staff = ajustes.STAFF_ROLE_ID in roles
+        self.economia = ajustes.ECONOMIA_ROLE_ID in roles
+        self.policia = ajustes.ROL_POLICIA_ID in roles
+        # El sueldo por defecto hace de mínimo: un rol peor pagado no lo rebaja
+        # (ni cuenta como trabajo), igual que antes de la caché
+        mejor = max(roles & sueldos.keys(), key=sueldos.get, default=None)
+        if mejor is not None and sueldos[mejor] > ajustes.SUELDO_POR_DEFECTO:
+            self.rol_sueldo, self.sueldo = mejor, sueldos[mejor]
+        else:
+            self.rol_sueldo, self.sueldo = None, ajustes.SUELDO_POR_DEFECTO
+
+    def tiene(self, rol_id: int) -> bool:
+        return rol_id in self.roles
+
+SIN_CAPACIDADES = CapacidadesRol(frozenset(), config_servidor(None))
+
+# (guild_id, member_id) -> CapacidadesRol; se invalida con los eventos de roles
+_capacidades = {}
+
+def capacidades(user_or_member) -> CapacidadesRol:
+    """Capacidades en caché de un Member (un User no tiene roles)"""
+    if not isinstance(user_or_member, discord.Member):
+        return SIN_CAPACIDADES
+    clave = (user_or_member.guild.id, user_or_member.id)
+    cap = _capacidades.get(clave)
+    if cap is None:
+        cap = _capacidades[clave] = CapacidadesRol(
+            frozenset(r.id for r in user_or_member.roles), config_servidor(user_or_member.guild.id)
+        )
+    return cap
+
+def invalidar_capacidades(guild_id: int, member_id: int = None):
+    if member_id is not None:
+        _capacidades.pop((guild_id, member_id), None)
+    else:
+        for clave in [c for c in _capacidades if c[0] == guild_id]:
+            del _capacidades[clave]
+
+@bot.event
+async def on_member_update(before: discord.Member, after: discord.Member):
+    if before.roles != after.roles:
+        invalidar_capacidades(after.guild.id, after.id)
+
+@bot.event
+async def on_member_remove(member: discord.Member):
+    invalidar_capacidades(member.guild.id, member.id)
+
+@bot.event
+async def on_guild_role_delete(role: discord.Role):
+    invalidar_capacidades(role.guild.id)
+
 def es_staff(user_or_member) -> bool:
     """Verifica si el usuario tiene permisos de staff"""
-    if not user_or_member:
-        return False
-    
-    # Si es un User, no puede tener roles
-    if isinstance(user_or_member, discord.User):
-        return False
-    
-    # Si es un Member, verificar roles
-    if isinstance(user_or_member, discord.Member):
-        try:
-            return any(r.id == config.STAFF_ROLE_ID for r in user_or_member.roles)
-        except (AttributeError, TypeError):
-            return False
-    
-    return False
+    return capacidades(user_or_member).staff
 
 def es_economia(user_or_member) -> bool:
     """Verifica si el usuario tiene permisos de economía"""
-    if not user_or_member:
-        return False
-    
-    # Si es un User, no puede tener roles
-    if isinstance(user_or_member, discord.User):
-        return False
-    
-    # Si es un Member, verificar roles
-    if isinstance(user_or_member, discord.Member):
-        try:
-            return any(r.id == config.ECONOMIA_ROLE_ID for r in user_or_member.roles)
-        except (AttributeError, TypeError):
-            return False
-    
-    return False
+    return capacidades(user_or_member).economia
 
 def es_policia(user_or_member) -> bool:
     """Verifica si el usuario es policía"""
-    if not user_or_member:
-        return False
-    
-    if isinstance(user_or_member, discord.User):
-        return False
-    
-    if isinstance(user_or_member, discord.Member):
-        try:
-            return any(r.id == config.ROL_POLICIA_ID for r in user_or_member.roles)
-        except (AttributeError, TypeError):
-            return False
-    
-    return False
+    return capacidades(user_or_member).policia
 
 def obtener_member_seguro(interaction: discord.Interaction, usuario: discord.User = None) -> discord.Member:
     """Obtiene un Member de forma segura desde un User o Interaction"""
@@ -185,38 +3209,105 @@ def obtener_member_seguro(interaction: discord.Interaction, usuario: discord.Use
     
     return None
 
+# =====================
+# PLANTILLAS DE EMBEDS
+# =====================
+# Las respuestas repetidas (cuenta no encontrada, cantidad inválida, saldo
+# insuficiente, acceso denegado...) se construyen una sola vez como payload.
+# Cada respuesta copia ese payload, rellena solo los textos con huecos
+# `{nombre}` y lo convierte con Embed.from_dict, sin repetir add_field ni
+# set_footer.
+class PlantillaEmbed:
+    """Embed fijo preconstruido que se copia y rellena en cada respuesta"""
+    __slots__ = ("payload", "huecos", "huecos_campos")
+
+    def __init__(self, titulo: str, descripcion: str = None, color=None, pie: str = None, campos=()):
+        embed = discord.Embed(title=titulo, description=descripcion, color=color or config.COLOR_ERROR)
+        for name, value, inline in campos:
+            embed.add_field(name=name, value=value, inline=inline)
+        if pie:
+            embed.set_footer(text=pie)
+        self.payload = embed.to_dict()
+        self.huecos = tuple(k for k in ("title", "description") if "{" in self.payload.get(k, ""))
+        self.huecos_campos = tuple(
+            (i, k) for i, campo in enumerate(self.payload.get("fields", ()))
+            for k in ("name", "value") if "{" in campo[k]
+        )
+
+    def render(self, pie: str = None, **params) -> discord.Embed:
+        """Embed nuevo con los huecos rellenos; el payload base no se toca"""
+        datos = dict(self.payload)
+        # Lista de campos propia: el handler puede seguir añadiendo campos
+        datos["fields"] = campos = [dict(campo) for campo in self.payload.get("fields", ())]
+        for k in self.huecos:
+            datos[k] = datos[k].format_map(params)
+        for i, k in self.huecos_campos:
+            campos[i][k] = campos[i][k].format_map(params)
+        if pie:
+            datos["footer"] = {"text": pie}
+        return discord.Embed.from_dict(datos)
+
+PLANTILLAS = {
+    "error": PlantillaEmbed("❌ {titulo}", "{descripcion}", config.COLOR_ERROR),
+    "exito": PlantillaEmbed("✅ {titulo}", "{descripcion}", config.COLOR_EXITO),
+    "info": PlantillaEmbed("ℹ️ {titulo}", "{descripcion}", config.COLOR_INFO),
+    "cuenta_no_encontrada": PlantillaEmbed(
+        "❌ Cuenta No Encontrada", "{usuario} no tiene una cuenta bancaria registrada.",
+        pie=config.FOOTER_BANCARIO,
+        campos=[("💼 Usuario", "{usuario}", True),
+                ("💡 Solución", "El usuario debe usar `/cuenta-crear` primero", False)]
+    ),
+    "cuenta_no_encontrada_admin": PlantillaEmbed(
+        "❌ Cuenta No Encontrada", "{usuario} no tiene cuenta bancaria registrada.",
+        pie=config.FOOTER_ADMINISTRATIVO,
+        campos=[("👤 Usuario", "{usuario}", True),
+                ("📋 Estado", "Sin cuenta bancaria", True)]
+    ),
+    "cuenta_propia_no_encontrada": PlantillaEmbed(
+        "❌ Cuenta No Encontrada", "No tienes cuenta bancaria. Necesitas crear una primero.",
+        pie=config.FOOTER_BANCARIO,
+        campos=[("💡 Solución", "Usa `/cuenta-crear` para crear tu cuenta", False)]
+    ),
+    "usuario_sin_cuenta": PlantillaEmbed(
+        "❌ Usuario Sin Cuenta", "{usuario} no tiene una cuenta bancaria registrada.",
+        pie=config.FOOTER_BANCARIO,
+        campos=[("👤 Usuario", "{usuario}", True),
+                ("💡 Solución", "El usuario debe usar `/cuenta-crear` primero", False)]
+    ),
+    "cantidad_invalida": PlantillaEmbed(
+        "❌ Cantidad Inválida", "La cantidad debe ser mayor que 0.", pie=config.FOOTER_BANCARIO
+    ),
+    "saldo_insuficiente": PlantillaEmbed(
+        "❌ Saldo Insuficiente", "No tienes suficiente saldo en tu tarjeta para {accion}.",
+        pie=config.FOOTER_BANCARIO,
+        campos=[("💳 Tu Saldo", "{saldo}€", True),
+                ("{etiqueta}", "{cantidad}€", True)]
+    ),
+    "acceso_denegado": PlantillaEmbed(
+        "🚫 Acceso Denegado", "{motivo}", pie=config.FOOTER_ADMINISTRATIVO,
+        campos=[("⚖️ Requerido", "Permisos de Staff/Admin", True)]
+    ),
+    "acceso_denegado_policia": PlantillaEmbed(
+        "🚫 Acceso Denegado", "{motivo}", pie="Sistema de Vehículos • Policía de Valencia",
+        campos=[("⚖️ Requerido", "Rol de Policía", True)]
+    ),
+}
+
+def embed_plantilla(nombre: str, pie: str = None, **params) -> discord.Embed:
+    """Embed de la plantilla `nombre` con sus huecos rellenos"""
+    return PLANTILLAS[nombre].render(pie, **params)
+
 def crear_embed_error(titulo: str, descripcion: str, footer: str = None) -> discord.Embed:
     """Crea un embed de error estandarizado"""
-    embed = discord.Embed(
-        title=f"❌ {titulo}",
-        description=descripcion,
-        color=config.COLOR_ERROR
-    )
-    if footer:
-        embed.set_footer(text=footer)
-    return embed
+    return embed_plantilla("error", footer, titulo=titulo, descripcion=descripcion)
 
 def crear_embed_exito(titulo: str, descripcion: str, footer: str = None) -> discord.Embed:
     """Crea un embed de éxito estandarizado"""
-    embed = discord.Embed(
-        title=f"✅ {titulo}",
-        description=descripcion,
-        color=config.COLOR_EXITO
-    )
-    if footer:
-        embed.set_footer(text=footer)
-    return embed
+    return embed_plantilla("exito", footer, titulo=titulo, descripcion=descripcion)
 
 def crear_embed_info(titulo: str, descripcion: str, footer: str = None) -> discord.Embed:
     """Crea un embed informativo estandarizado"""
-    embed = discord.Embed(
-        title=f"ℹ️ {titulo}",
-        description=descripcion,
-        color=config.COLOR_INFO
-    )
-    if footer:
-        embed.set_footer(text=footer)
-    return embed
+    return embed_plantilla("info", footer, titulo=titulo, descripcion=descripcion)
 
 # =====================
 # MANEJO DE ERRORES MEJORADO
@@ -331,10 +3422,24 @@ async def on_ready():
             name="Valencia RP ESP V2 | /ayuda para comandos"
         )
     )
-    await tree.sync()
-    print(f"✅ Bot listo como {bot.user} ({len(bot.guilds)} guilds)")
+    if config.COORDINADOR:
+        await tree.sync()
+    # Abrir ya la partición de cada servidor: sus préstamos se cobran aunque
+    # nadie use el bot allí
+    for guild in bot.guilds:
+        particiones.de(guild.id)
+    cargadas = sum(len(p.informe_carga) for p in particiones.todas())
+    print(f"✅ Bot listo como {bot.user} ({len(bot.guilds)} guilds, {len(particiones.todas())} particiones)")
     print(f"✅ Comandos sincronizados: {len(tree.get_commands())}")
-    bot.loop.create_task(pagos_prestamos_diarios())
+    print(f"✅ Arranque en {time.perf_counter() - INICIO_PROCESO:.1f}s ({cargadas}/{len(FILES) * len(particiones.todas())} tiendas cargadas)")
+    # on_ready se repite en cada reconexión: precargar solo la primera vez
+    global tarea_precarga
+    if config.PRECARGA and tarea_precarga is None:
+        tarea_precarga = asyncio.create_task(precargar_tiendas())
+
+@bot.event
+async def on_guild_join(guild: discord.Guild):
+    particiones.de(guild.id)
 
 # ----------------------
 # Economía, cuentas, transferencias y préstamos
@@ -447,16 +3552,17 @@ async def cuenta_crear(interaction: Interaction, usuario: discord.Member, banco:
     banco_info = BANCOS_VALENCIA.get(banco.value, {})
     
     # Crear cuenta nueva
-    nueva_cuenta = {
-        "banco": banco.value,
-        "tarjeta": config.SALDO_INICIAL_TARJETA,
-        "efectivo": config.SALDO_INICIAL_EFECTIVO,
-        "fecha_creacion": datetime.datetime.now().isoformat(),
-        "creado_por": str(interaction.user.id)
-    }
+    nueva_cuenta = Cuenta(
+        banco=banco.value,
+        tarjeta=config.SALDO_INICIAL_TARJETA,
+        efectivo=config.SALDO_INICIAL_EFECTIVO,
+        fecha_creacion=datetime.datetime.now().isoformat(),
+        creado_por=str(interaction.user.id)
+    )
     
-    data["cuentas"][uid] = nueva_cuenta
-    save_json("cuentas")
+    # Alta bajo el bloqueo del usuario: si otra orden la creó entretanto, se conserva esa
+    async with transaccion(uid) as tx:
+        tx.registro("cuentas", uid, nueva_cuenta)
 
     # Respuesta con embed mejorado
     embed = discord.Embed(
@@ -509,14 +3615,7 @@ async def cuenta_ver(interaction: Interaction, usuario: discord.Member = None):
     target = usuario or interaction.user
     uid = str(target.id)
     if uid not in data["cuentas"]:
-        embed = discord.Embed(
-            title="❌ Cuenta No Encontrada",
-            description=f"{target.mention} no tiene una cuenta bancaria registrada.",
-            color=discord.Color.red()
-        )
-        embed.add_field(name="💼 Usuario", value=target.mention, inline=True)
-        embed.add_field(name="💡 Solución", value="El usuario debe usar `/cuenta-crear` primero", inline=False)
-        embed.set_footer(text="Sistema Bancario • Valencia RP ESP")
+        embed = embed_plantilla("cuenta_no_encontrada", usuario=target.mention)
         await interaction.response.send_message(embed=embed, ephemeral=True)
         return
     c = data["cuentas"][uid]
@@ -537,9 +3636,71 @@ async def cuenta_ver(interaction: Interaction, usuario: discord.Member = None):
     
     await interaction.response.send_message(embed=embed)
 
+# =====================
+# RANKING DE RIQUEZA
+# =====================
+class RankingRiqueza:
+    """Ranking de patrimonio (tarjeta + efectivo) mantenido al día.
+
+    Guarda las cuentas ordenadas como (-total, uid) junto con la suma y el
+    número de cuentas, y se actualiza cada vez que se guarda una cuenta, de
+    modo que /top solo recorre las primeras posiciones.
+    """
+
+    def __init__(self):
+        self._orden = []    # (-total, uid), ordenado
+        self._totales = {}  # uid -> total
+        self.suma = 0
+        self._listo = False
+
+    @staticmethod
+    def _total(cuenta: Cuenta) -> int:
+        return cuenta.tarjeta + cuenta.efectivo
+
+    def reconstruir(self):
+        self._totales = {uid: self._total(c) for uid, c in data["cuentas"].items()}
+        self._orden = sorted((-total, uid) for uid, total in self._totales.items())
+        self.suma = sum(self._totales.values())
+        self._listo = True
+
+    def actualizar(self, uids):
+        if not self._listo:
+            return  # se construirá entero en la primera consulta
+        if not uids:
+            self.reconstruir()
+            return
+        for uid in uids:
+            uid = str(uid)
+            anterior = self._totales.pop(uid, None)
+            if anterior is not None:
+                pos = bisect.bisect_left(self._orden, (-anterior, uid))
+                del self._orden[pos]
+                self.suma -= anterior
+            cuenta = data["cuentas"].get(uid)
+            if cuenta is not None:
+                total = self._total(cuenta)
+                self._totales[uid] = total
+                bisect.insort(self._orden, (-total, uid))
+                self.suma += total
+
+    def mejores(self):
+        """Itera (uid, total) de mayor a menor patrimonio"""
+        if not self._listo:
+            self.reconstruir()
+        for total_neg, uid in self._orden:
+            yield uid, -total_neg
+
+    def __len__(self):
+        if not self._listo:
+            self.reconstruir()
+        return len(self._totales)
+
+ranking_riqueza = PorParticion(RankingRiqueza)
+observar_guardado("cuentas")(lambda uids: ranking_riqueza.actualizar(uids))
+
 @tree.command(name="top", description="Ver ranking de los usuarios más ricos de Valencia RP")
 async def top_ricos(interaction: Interaction):
-    if not data.get("cuentas"):
+    if not len(ranking_riqueza):
         embed = discord.Embed(
             title="📊 Ranking Económico",
             description="No hay cuentas bancarias registradas en el sistema.",
@@ -549,29 +3710,25 @@ async def top_ricos(interaction: Interaction):
         await interaction.response.send_message(embed=embed, ephemeral=True)
         return
     
-    # Calcular patrimonio total de cada usuario
+    # Primeros 10 usuarios que siguen en el servidor, en orden de patrimonio
     rankings = []
-    for uid, cuenta in data["cuentas"].items():
+    for uid, total in ranking_riqueza.mejores():
         try:
             user = interaction.guild.get_member(int(uid))
-            if user:  # Solo incluir usuarios que están en el servidor
-                tarjeta = cuenta.get("tarjeta", 0)
-                efectivo = cuenta.get("efectivo", 0)
-                total = tarjeta + efectivo
-                banco = cuenta.get("banco", "N/A")
-                
-                rankings.append({
-                    "user": user,
-                    "tarjeta": tarjeta,
-                    "efectivo": efectivo,
-                    "total": total,
-                    "banco": banco
-                })
-        except:
+        except (ValueError, AttributeError):
             continue  # Ignorar usuarios que no se pueden obtener
-    
-    # Ordenar por patrimonio total (de mayor a menor)
-    rankings.sort(key=lambda x: x["total"], reverse=True)
+        if not user:  # Solo incluir usuarios que están en el servidor
+            continue
+        cuenta = data["cuentas"][uid]
+        rankings.append({
+            "user": user,
+            "tarjeta": cuenta.get("tarjeta", 0),
+            "efectivo": cuenta.get("efectivo", 0),
+            "total": total,
+            "banco": cuenta.get("banco", "N/A")
+        })
+        if len(rankings) == 10:
+            break
     
     if not rankings:
         embed = discord.Embed(
@@ -590,11 +3747,7 @@ async def top_ricos(interaction: Interaction):
         color=discord.Color.gold()
     )
     
-    # Mostrar top 10
-    top_count = min(10, len(rankings))
-    
-    for i in range(top_count):
-        user_data = rankings[i]
+    for i, user_data in enumerate(rankings):
         user = user_data["user"]
         posicion = i + 1
         
@@ -619,9 +3772,9 @@ async def top_ricos(interaction: Interaction):
             inline=False
         )
     
-    # Información adicional
-    total_usuarios = len(rankings)
-    total_dinero = sum(r["total"] for r in rankings)
+    # Información adicional (agregados mantenidos por el ranking)
+    total_usuarios = len(ranking_riqueza)
+    total_dinero = ranking_riqueza.suma
     promedio = total_dinero // total_usuarios if total_usuarios > 0 else 0
     
     embed.add_field(
@@ -641,13 +3794,7 @@ async def top_ricos(interaction: Interaction):
 async def cuenta_eliminar(interaction: Interaction, usuario: discord.Member):
     # VERIFICACIÓN CRÍTICA: Solo staff puede eliminar cuentas
     if not es_staff(interaction.user):
-        embed = discord.Embed(
-            title="🚫 Acceso Denegado",
-            description="Solo el personal autorizado puede eliminar cuentas bancarias.",
-            color=discord.Color.red()
-        )
-        embed.add_field(name="⚖️ Requerido", value="Permisos de Staff/Admin", inline=True)
-        embed.set_footer(text="Sistema Administrativo • Valencia RP ESP")
+        embed = embed_plantilla("acceso_denegado", motivo="Solo el personal autorizado puede eliminar cuentas bancarias.")
         await interaction.response.send_message(embed=embed, ephemeral=True)
         return
     
@@ -655,25 +3802,21 @@ async def cuenta_eliminar(interaction: Interaction, usuario: discord.Member):
     
     # Verificar que el usuario tenga cuenta
     if uid not in data["cuentas"]:
-        embed = discord.Embed(
-            title="❌ Cuenta No Encontrada",
-            description=f"{usuario.mention} no tiene cuenta bancaria registrada.",
-            color=discord.Color.red()
-        )
-        embed.add_field(name="👤 Usuario", value=usuario.mention, inline=True)
-        embed.add_field(name="📋 Estado", value="Sin cuenta bancaria", inline=True)
-        embed.set_footer(text="Sistema Administrativo • Valencia RP ESP")
+        embed = embed_plantilla("cuenta_no_encontrada_admin", usuario=usuario.mention)
         await interaction.response.send_message(embed=embed, ephemeral=True)
         return
     
-    # Obtener datos actuales antes de eliminar
-    cuenta_actual = data["cuentas"][uid].copy()
+    # Obtener datos actuales y eliminar la cuenta bajo el bloqueo del usuario
+    async with transaccion(uid) as tx:
+        cuenta_actual = tx.registro("cuentas", uid).a_dict()
+        del data["cuentas"][uid]
     saldo_tarjeta = cuenta_actual.get("tarjeta", 0)
     saldo_efectivo = cuenta_actual.get("efectivo", 0)
     banco = cuenta_actual.get("banco", "Unknown")
     
     # BACKUP PERSISTENTE: Guardar registro de eliminación
-    if "cuentas_eliminadas" not in data:
+    # Recién creada la tienda es {}: la lista empieza con el primer registro
+    if not data.get("cuentas_eliminadas"):
         data["cuentas_eliminadas"] = []
     
     backup_record = {
@@ -694,10 +3837,6 @@ async def cuenta_eliminar(interaction: Interaction, usuario: discord.Member):
     data["cuentas_eliminadas"].append(backup_record)
     save_json("cuentas_eliminadas")
     
-    # Eliminar la cuenta
-    del data["cuentas"][uid]
-    save_json("cuentas")
-    
     # Respuesta con embed profesional
     embed = discord.Embed(
         title="🗑️ Cuenta Bancaria Eliminada",
@@ -734,51 +3873,35 @@ async def cuenta_eliminar(interaction: Interaction, usuario: discord.Member):
 ])
 async def dinero_dar(interaction: Interaction, usuario: discord.Member, cantidad: int, tipo: app_commands.Choice[str]):
     if cantidad <= 0:
-        embed = discord.Embed(
-            title="❌ Cantidad Inválida",
-            description="La cantidad debe ser mayor que 0.",
-            color=discord.Color.red()
-        )
-        embed.set_footer(text="Sistema Bancario • Valencia RP ESP")
+        embed = embed_plantilla("cantidad_invalida")
         await interaction.response.send_message(embed=embed, ephemeral=True); return
     pid = str(interaction.user.id); tid = str(usuario.id)
-    if pid not in data["cuentas"] or data["cuentas"][pid]["tarjeta"] < cantidad:
-        embed = discord.Embed(
-            title="❌ Saldo Insuficiente",
-            description="No tienes suficiente saldo en tu tarjeta para realizar esta transferencia.",
-            color=discord.Color.red())
-        saldo_actual = data["cuentas"].get(pid, {}).get("tarjeta", 0)
-        embed.add_field(name="💳 Tu Saldo", value=f"{saldo_actual}€", inline=True)
-        embed.add_field(name="💰 Requerido", value=f"{cantidad}€", inline=True)
-        embed.set_footer(text="Sistema Bancario • Valencia RP ESP")
-        await interaction.response.send_message(embed=embed, ephemeral=True); return
-    # Verificar que el usuario destinatario tenga cuenta
-    if tid not in data["cuentas"]:
-        embed = discord.Embed(
-            title="❌ Usuario Sin Cuenta",
-            description=f"{usuario.mention} no tiene una cuenta bancaria registrada.",
-            color=discord.Color.red()
-        )
-        embed.add_field(name="👤 Usuario", value=usuario.mention, inline=True)
-        embed.add_field(name="💡 Solución", value="El usuario debe usar `/cuenta-crear` primero", inline=False)
-        embed.set_footer(text="Sistema Bancario • Valencia RP ESP")
-        await interaction.response.send_message(embed=embed, ephemeral=True)
-        return
-    
-    # Procesar según el tipo de transferencia
-    tipo_valor = tipo.value
-    if tipo_valor == "efectivo":
-        data["cuentas"][pid]["tarjeta"] -= cantidad
-        data["cuentas"][tid]["efectivo"] += cantidad
-        tipo_desc = "💵 En Efectivo"
-        destino_desc = f"Efectivo de {usuario.mention}"
-    else:  # bancario
-        data["cuentas"][pid]["tarjeta"] -= cantidad
-        data["cuentas"][tid]["tarjeta"] += cantidad
-        tipo_desc = "🏦 Bancario"
-        destino_desc = f"Cuenta de {usuario.mention}"
-    
-    save_json("cuentas")
+    # Comprobación y cargo bajo el bloqueo de ambos usuarios; los rechazos se
+    # responden después de soltarlo
+    rechazo = None
+    async with transaccion(pid, tid) as tx:
+        if pid not in data["cuentas"] or data["cuentas"][pid]["tarjeta"] < cantidad:
+            rechazo = embed_plantilla("saldo_insuficiente", accion="realizar esta transferencia", saldo=data["cuentas"].get(pid, {}).get("tarjeta", 0), etiqueta="💰 Requerido", cantidad=cantidad)
+        # Verificar que el usuario destinatario tenga cuenta
+        elif tid not in data["cuentas"]:
+            rechazo = embed_plantilla("usuario_sin_cuenta", usuario=usuario.mention)
+        else:
+            # Procesar según el tipo de transferencia
+            origen = tx.registro("cuentas", pid)
+            destino = tx.registro("cuentas", tid)
+            tipo_valor = tipo.value
+            if tipo_valor == "efectivo":
+                origen["tarjeta"] -= cantidad
+                destino["efectivo"] += cantidad
+                tipo_desc = "💵 En Efectivo"
+                destino_desc = f"Efectivo de {usuario.mention}"
+            else:  # bancario
+                origen["tarjeta"] -= cantidad
+                destino["tarjeta"] += cantidad
+                tipo_desc = "🏦 Bancario"
+                destino_desc = f"Cuenta de {usuario.mention}"
+    if rechazo is not None:
+        await interaction.response.send_message(embed=rechazo, ephemeral=True); return
     
     # Respuesta con embed
     embed = discord.Embed(
@@ -805,23 +3928,12 @@ async def dinero_dar(interaction: Interaction, usuario: discord.Member, cantidad
 async def dinero_agregar(interaction: Interaction, usuario: discord.Member, cantidad: int, tipo: app_commands.Choice[str], motivo: str):
     # VERIFICACIÓN CRÍTICA: Solo staff puede generar dinero
     if not es_staff(interaction.user):
-        embed = discord.Embed(
-            title="🚫 Acceso Denegado",
-            description="Solo el personal autorizado puede generar dinero administrativo.",
-            color=discord.Color.red()
-        )
-        embed.add_field(name="⚖️ Requerido", value="Permisos de Staff/Admin", inline=True)
-        embed.set_footer(text="Sistema Administrativo • Valencia RP ESP")
+        embed = embed_plantilla("acceso_denegado", motivo="Solo el personal autorizado puede generar dinero administrativo.")
         await interaction.response.send_message(embed=embed, ephemeral=True)
         return
     
     if cantidad <= 0:
-        embed = discord.Embed(
-            title="❌ Cantidad Inválida",
-            description="La cantidad debe ser mayor que 0.",
-            color=discord.Color.red()
-        )
-        embed.set_footer(text="Sistema Administrativo • Valencia RP ESP")
+        embed = embed_plantilla("cantidad_invalida", pie=config.FOOTER_ADMINISTRATIVO)
         await interaction.response.send_message(embed=embed, ephemeral=True)
         return
     
@@ -829,29 +3941,22 @@ async def dinero_agregar(interaction: Interaction, usuario: discord.Member, cant
     
     # Verificar que el usuario tenga cuenta
     if uid not in data["cuentas"]:
-        embed = discord.Embed(
-            title="❌ Usuario Sin Cuenta",
-            description=f"{usuario.mention} no tiene cuenta bancaria registrada.",
-            color=discord.Color.red()
-        )
-        embed.add_field(name="👤 Usuario", value=usuario.mention, inline=True)
-        embed.add_field(name="💡 Solución", value="El usuario debe usar `/cuenta-crear` primero", inline=False)
-        embed.set_footer(text="Sistema Administrativo • Valencia RP ESP")
+        embed = embed_plantilla("usuario_sin_cuenta", pie=config.FOOTER_ADMINISTRATIVO, usuario=usuario.mention)
         await interaction.response.send_message(embed=embed, ephemeral=True)
         return
     
-    # Agregar dinero según el tipo especificado
+    # Agregar dinero según el tipo especificado, bajo el bloqueo del usuario
     tipo_valor = tipo.value
-    if tipo_valor == "efectivo":
-        data["cuentas"][uid]["efectivo"] += cantidad
-        destino_desc = "💵 Efectivo"
-        saldo_final = data["cuentas"][uid]["efectivo"]
-    else:  # tarjeta
-        data["cuentas"][uid]["tarjeta"] += cantidad
-        destino_desc = "🏦 Cuenta Bancaria"
-        saldo_final = data["cuentas"][uid]["tarjeta"]
-    
-    save_json("cuentas")
+    async with transaccion(uid) as tx:
+        cuenta = tx.registro("cuentas", uid)
+        if tipo_valor == "efectivo":
+            cuenta["efectivo"] += cantidad
+            destino_desc = "💵 Efectivo"
+            saldo_final = cuenta["efectivo"]
+        else:  # tarjeta
+            cuenta["tarjeta"] += cantidad
+            destino_desc = "🏦 Cuenta Bancaria"
+            saldo_final = cuenta["tarjeta"]
     
     # Respuesta con embed profesional
     embed = discord.Embed(
@@ -877,47 +3982,33 @@ async def dinero_agregar(interaction: Interaction, usuario: discord.Member, cant
 @app_commands.describe(cantidad="Cantidad a retirar de la tarjeta")
 async def retirar_efectivo(interaction: Interaction, cantidad: int):
     if cantidad <= 0:
-        embed = discord.Embed(
-            title="❌ Cantidad Inválida",
-            description="La cantidad debe ser mayor que 0.",
-            color=discord.Color.red()
-        )
-        embed.set_footer(text="Sistema Bancario • Valencia RP ESP")
+        embed = embed_plantilla("cantidad_invalida")
         await interaction.response.send_message(embed=embed, ephemeral=True)
         return
     
     uid = str(interaction.user.id)
     
     # Verificar que tenga cuenta
-    if uid not in data["cuentas"]:
-        embed = discord.Embed(
-            title="❌ Cuenta No Encontrada",
-            description="No tienes cuenta bancaria. Necesitas crear una primero.",
-            color=discord.Color.red()
-        )
-        embed.add_field(name="💡 Solución", value="Usa `/cuenta-crear` para crear tu cuenta", inline=False)
-        embed.set_footer(text="Sistema Bancario • Valencia RP ESP")
-        await interaction.response.send_message(embed=embed, ephemeral=True)
-        return
-    
-    # Verificar saldo suficiente en tarjeta
-    if data["cuentas"][uid]["tarjeta"] < cantidad:
-        saldo_actual = data["cuentas"][uid]["tarjeta"]
-        embed = discord.Embed(
-            title="❌ Saldo Insuficiente",
-            description="No tienes suficiente dinero en tu tarjeta para retirar esa cantidad.",
-            color=discord.Color.red()
-        )
-        embed.add_field(name="💳 Tu Saldo", value=f"{saldo_actual}€", inline=True)
-        embed.add_field(name="📤 Solicitado", value=f"{cantidad}€", inline=True)
-        embed.set_footer(text="Sistema Bancario • Valencia RP ESP")
+    if uid not in data["cuentas"]:
+        embed = embed_plantilla("cuenta_propia_no_encontrada")
         await interaction.response.send_message(embed=embed, ephemeral=True)
         return
     
-    # Realizar la transferencia interna
-    data["cuentas"][uid]["tarjeta"] -= cantidad
-    data["cuentas"][uid]["efectivo"] += cantidad
-    save_json("cuentas")
+    # Comprobar y mover el dinero bajo el bloqueo del usuario
+    rechazo = None
+    async with transaccion(uid) as tx:
+        # Verificar saldo suficiente en tarjeta
+        if data["cuentas"][uid]["tarjeta"] < cantidad:
+            saldo_actual = data["cuentas"][uid]["tarjeta"]
+            rechazo = embed_plantilla("saldo_insuficiente", accion="retirar esa cantidad", saldo=saldo_actual, etiqueta="📤 Solicitado", cantidad=cantidad)
+        else:
+            # Realizar la transferencia interna
+            cuenta = tx.registro("cuentas", uid)
+            cuenta["tarjeta"] -= cantidad
+            cuenta["efectivo"] += cantidad
+    if rechazo is not None:
+        await interaction.response.send_message(embed=rechazo, ephemeral=True)
+        return
     
     # Respuesta con embed
     cuenta = data["cuentas"][uid]
@@ -943,50 +4034,22 @@ async def cobrar_sueldo(interaction: Interaction):
 
     # Verificar que el usuario tenga cuenta
     if uid not in data["cuentas"]:
-        embed = discord.Embed(
-            title="❌ Cuenta No Encontrada",
-            description="No tienes cuenta bancaria. Necesitas crear una primero.",
-            color=discord.Color.red()
-        )
-        embed.add_field(name="💡 Solución", value="Usa `/cuenta-crear` para crear tu cuenta", inline=False)
-        embed.set_footer(text="Sistema Bancario • Valencia RP ESP")
+        embed = embed_plantilla("cuenta_propia_no_encontrada")
         await interaction.response.send_message(embed=embed, ephemeral=True)
         return
 
-    # Diccionario de sueldos por ID de rol
-    sueldos_roles = {
-        1401538045567565875: 1900,
-        1401538045567565876: 1800,
-        1401538045567565877: 1770,
-        1401538045567565881: 1500,
-        1401538045567565882: 1400,
-        1401538045567565883: 1267,
-        1401538045584605204: 1800,
-        1401538045584605205: 1700,
-        1401538045584605206: 1500,
-        1401538045634674790: 600
-    }
-
-    # Detectar el rol del usuario con mayor sueldo
-    roles_usuario = [role.id for role in interaction.user.roles]
-    sueldo_bruto = 0
-    rol_trabajo = "Ciudadano"
-
-    for rol_id, sueldo in sueldos_roles.items():
-        if rol_id in roles_usuario and sueldo > sueldo_bruto:
-            sueldo_bruto = sueldo
-            rol_trabajo = f"<@&{rol_id}>"
-
-        if sueldo_bruto == 0:
-            sueldo_bruto = 1200  # Sueldo por defecto si no tiene rol de trabajo
+    # Sueldo del rol mejor pagado (precalculado en la caché de roles)
+    cap = capacidades(interaction.user)
+    sueldo_bruto = cap.sueldo
+    rol_trabajo = f"<@&{cap.rol_sueldo}>" if cap.rol_sueldo else "Ciudadano"
 
     # Calcular impuestos (7% de ejemplo)
     impuestos = int(sueldo_bruto * 0.065)
     sueldo_neto = sueldo_bruto - impuestos
 
     # Agregar dinero a la cuenta del usuario
-    data["cuentas"][uid]["tarjeta"] += sueldo_neto
-    save_json("cuentas")
+    async with transaccion(uid) as tx:
+        tx.registro("cuentas", uid)["tarjeta"] += sueldo_neto
 
     # Mensaje inicial
     await interaction.response.send_message(
@@ -1051,7 +4114,7 @@ async def cobrar_sueldo(interaction: Interaction):
         }
 
         data["oposiciones"][uid].append(nueva_oposicion)
-        save_json("oposiciones")
+        save_json("oposiciones", uid)
 
         embed = discord.Embed(
             title="OPOSICIONES {corp_nombre[corporacion.value]}",
@@ -1089,32 +4152,38 @@ async def pedir_prestamo(interaction: Interaction, cantidad: int, meses: int):
         embed.add_field(name="🗺️ Meses Mínimos", value="1 mes", inline=True)
         embed.set_footer(text="Sistema Bancario • Valencia RP ESP")
         await interaction.response.send_message(embed=embed, ephemeral=True); return
-    # si existe préstamo activo con restante > 0
-    if uid in data["prestamos"] and data["prestamos"][uid].get("restante",0) > 0:
-        embed = discord.Embed(
-            title="⚠️ Préstamo Activo",
-            description="Ya tienes un préstamo activo. Debes pagarlo completamente antes de solicitar otro.",
-            color=discord.Color.orange()
-        )
-        restante = data["prestamos"][uid].get("restante", 0)
-        embed.add_field(name="💰 Monto Restante", value=f"{restante}€", inline=True)
-        embed.add_field(name="💡 Acción", value="Usa `/pagar-prestamo` para pagar", inline=True)
-        embed.set_footer(text="Sistema Bancario • Valencia RP ESP")
-        await interaction.response.send_message(embed=embed, ephemeral=True); return
-    fecha = datetime.date.today().isoformat()
-    total_dias = meses * 30
-    cuota_diaria = max(1, cantidad // total_dias)
-    data["prestamos"][uid] = {
-        "cantidad": cantidad,
-        "restante": cantidad,
-        "fecha": fecha,
-        "meses": meses,
-        "dias_totales": total_dias,
-        "cuota_diaria": cuota_diaria,
-        "ultimo_descuento": None
-    }
-    data["cuentas"][uid]["tarjeta"] += cantidad
-    save_json("prestamos"); save_json("cuentas")
+    # Préstamo y abono en la misma transacción: o se guardan ambos o ninguno
+    rechazo = None
+    async with transaccion(uid) as tx:
+        # si existe préstamo activo con restante > 0
+        if uid in data["prestamos"] and data["prestamos"][uid].get("restante",0) > 0:
+            rechazo = discord.Embed(
+                title="⚠️ Préstamo Activo",
+                description="Ya tienes un préstamo activo. Debes pagarlo completamente antes de solicitar otro.",
+                color=discord.Color.orange()
+            )
+            restante = data["prestamos"][uid].get("restante", 0)
+            rechazo.add_field(name="💰 Monto Restante", value=f"{restante}€", inline=True)
+            rechazo.add_field(name="💡 Acción", value="Usa `/pagar-prestamo` para pagar", inline=True)
+            rechazo.set_footer(text="Sistema Bancario • Valencia RP ESP")
+        else:
+            fecha = datetime.date.today().isoformat()
+            total_dias = meses * 30
+            cuota_diaria = max(1, cantidad // total_dias)
+            tx.registro("prestamos", uid)
+            data["prestamos"][uid] = Prestamo(
+                cantidad=cantidad,
+                restante=cantidad,
+                fecha=fecha,
+                meses=meses,
+                dias_totales=total_dias,
+                cuota_diaria=cuota_diaria,
+                ultimo_descuento=None,
+                proximo_cobro=time.time() + PlanificadorPrestamos.PERIODO
+            )
+            tx.registro("cuentas", uid)["tarjeta"] += cantidad
+    if rechazo is not None:
+        await interaction.response.send_message(embed=rechazo, ephemeral=True); return
     
     # Respuesta con embed
     embed = discord.Embed(
@@ -1135,37 +4204,31 @@ async def pedir_prestamo(interaction: Interaction, cantidad: int, meses: int):
 @app_commands.describe(cantidad="Cantidad a pagar")
 async def pagar_prestamo(interaction: Interaction, cantidad: int):
     uid = str(interaction.user.id)
-    if uid not in data["prestamos"] or data["prestamos"][uid]["restante"] <= 0:
-        embed = discord.Embed(
-            title="❌ Sin Préstamo Pendiente",
-            description="No tienes ningún préstamo activo para pagar.",
-            color=discord.Color.red()
-        )
-        embed.add_field(name="💡 Alternativa", value="Puedes solicitar un préstamo con `/pedir-prestamo`", inline=False)
-        embed.set_footer(text="Sistema Bancario • Valencia RP ESP")
-        await interaction.response.send_message(embed=embed, ephemeral=True); return
-    if uid not in data["cuentas"] or data["cuentas"][uid]["tarjeta"] < cantidad:
-        embed = discord.Embed(
-            title="❌ Saldo Insuficiente",
-            description="No tienes suficiente saldo en tu tarjeta para pagar el préstamo.",
-            color=discord.Color.red()
-        )
-        saldo_actual = data["cuentas"].get(uid, {}).get("tarjeta", 0)
-        embed.add_field(name="💳 Tu Saldo", value=f"{saldo_actual}€", inline=True)
-        embed.add_field(name="💰 Necesario", value=f"{cantidad}€", inline=True)
-        embed.set_footer(text="Sistema Bancario • Valencia RP ESP")
-        await interaction.response.send_message(embed=embed, ephemeral=True); return
-    
-    # Realizar el pago
-    data["cuentas"][uid]["tarjeta"] -= cantidad
-    data["prestamos"][uid]["restante"] -= cantidad
-    if data["prestamos"][uid]["restante"] < 0:
-        data["prestamos"][uid]["restante"] = 0
-    
-    # Obtener información del préstamo para el mensaje
-    prestamo = data["prestamos"][uid]
-    restante = prestamo["restante"]
-    save_json("cuentas"); save_json("prestamos")
+    rechazo = None
+    async with transaccion(uid) as tx:
+        if uid not in data["prestamos"] or data["prestamos"][uid]["restante"] <= 0:
+            rechazo = discord.Embed(
+                title="❌ Sin Préstamo Pendiente",
+                description="No tienes ningún préstamo activo para pagar.",
+                color=discord.Color.red()
+            )
+            rechazo.add_field(name="💡 Alternativa", value="Puedes solicitar un préstamo con `/pedir-prestamo`", inline=False)
+            rechazo.set_footer(text="Sistema Bancario • Valencia RP ESP")
+        elif uid not in data["cuentas"] or data["cuentas"][uid]["tarjeta"] < cantidad:
+            rechazo = embed_plantilla("saldo_insuficiente", accion="pagar el préstamo", saldo=data["cuentas"].get(uid, {}).get("tarjeta", 0), etiqueta="💰 Necesario", cantidad=cantidad)
+        else:
+            # Realizar el pago
+            cuenta = tx.registro("cuentas", uid)
+            prestamo = tx.registro("prestamos", uid)
+            cuenta["tarjeta"] -= cantidad
+            prestamo["restante"] -= cantidad
+            if prestamo["restante"] < 0:
+                prestamo["restante"] = 0
+            
+            # Obtener información del préstamo para el mensaje
+            restante = prestamo["restante"]
+    if rechazo is not None:
+        await interaction.response.send_message(embed=rechazo, ephemeral=True); return
     
     # Respuesta pública con embed
     embed_publico = discord.Embed(
@@ -1184,26 +4247,20 @@ async def pagar_prestamo(interaction: Interaction, cantidad: int):
     await interaction.response.send_message(embed=embed_publico)
     
     # Enviar notificación por mensaje directo
-    try:
-        user = bot.get_user(int(uid))
-        if user:
-            embed = discord.Embed(
-                title="💳 Pago de Préstamo Registrado",
-                description=f"Has realizado un pago de **{cantidad}€** a tu préstamo.",
-                color=discord.Color.blue()
-            )
-            embed.add_field(name="💰 Cantidad Pagada", value=f"{cantidad}€", inline=True)
-            embed.add_field(name="📊 Restante", value=f"{restante}€", inline=True)
-            if restante == 0:
-                embed.add_field(name="🎉 Estado", value="**¡PRÉSTAMO LIQUIDADO!**", inline=False)
-                embed.color = discord.Color.green()
-            embed.set_footer(text="Sistema Bancario • Valencia RP ESP")
-            embed.timestamp = discord.utils.utcnow()
-            
-            await user.send(embed=embed)
-    except Exception:
-        # Si falla el MD, no afecta la operación principal
-        pass
+    embed = discord.Embed(
+        title="💳 Pago de Préstamo Registrado",
+        description=f"Has realizado un pago de **{cantidad}€** a tu préstamo.",
+        color=discord.Color.blue()
+    )
+    embed.add_field(name="💰 Cantidad Pagada", value=f"{cantidad}€", inline=True)
+    embed.add_field(name="📊 Restante", value=f"{restante}€", inline=True)
+    if restante == 0:
+        embed.add_field(name="🎉 Estado", value="**¡PRÉSTAMO LIQUIDADO!**", inline=False)
+        embed.color = discord.Color.green()
+    embed.set_footer(text="Sistema Bancario • Valencia RP ESP")
+    embed.timestamp = discord.utils.utcnow()
+    # Si falla el MD, no afecta la operación principal
+    notificaciones.encolar(uid, embed=embed)
 
 @tree.command(name="prestamos", description="Ver estado de tu préstamo")
 async def prestamos_ver(interaction: Interaction):
@@ -1244,50 +4301,168 @@ async def prestamos_ver(interaction: Interaction):
 # Parte 3 — TAREA DIARIA PARA DESCONTAR PRÉSTAMOS Y ENVIAR MD
 # (PEGA justo después de la Parte 2)
 # ----------------------
-async def pagos_prestamos_diarios():
-    await bot.wait_until_ready()
-    while not bot.is_closed():
-        hoy = datetime.date.today().isoformat()
-        for uid, p in list(data.get("prestamos", {}).items()):
-            if p.get("restante",0) <= 0:
+class PlanificadorPrestamos:
+    """Cobro diario de préstamos por fecha de vencimiento.
+
+    Cada préstamo guarda su próximo cobro ("proximo_cobro", epoch) en su propio
+    registro, así que el calendario sobrevive a los reinicios. En memoria hay un
+    montículo (vencimiento, uid); la tarea duerme hasta el primer vencimiento,
+    cobra de una vez todo lo vencido en una sola transacción y deja los MD en
+    la cola de notificaciones.
+    """
+
+    PERIODO = 24 * 60 * 60
+
+    def __init__(self, lote_max: int):
+        self.lote_max = lote_max
+        self._monticulo = []
+        self._listo = False
+        self._despertar = None
+        self._tarea = None
+
+    @staticmethod
+    def vencimiento(p) -> float:
+        if p.get("proximo_cobro") is not None:
+            return p["proximo_cobro"]
+        # Préstamos anteriores al planificador: mañana a las 00:00 si ya se
+        # cobró hoy, si no cuanto antes
+        ultimo = p.get("ultimo_descuento")
+        if ultimo:
+            dia = datetime.date.fromisoformat(ultimo) + datetime.timedelta(days=1)
+            return datetime.datetime.combine(dia, datetime.time()).timestamp()
+        return 0.0
+
+    @classmethod
+    def siguiente(cls, vencimiento: float, ahora: float) -> float:
+        """Próximo cobro tras `vencimiento`. Cuenta desde el vencimiento y no
+        desde ahora, para que el horario no se desplace; los días perdidos con
+        el bot apagado no se recuperan"""
+        if not vencimiento:
+            return ahora + cls.PERIODO
+        perdidos = max(0, int((ahora - vencimiento) // cls.PERIODO))
+        return vencimiento + (perdidos + 1) * cls.PERIODO
+
+    def reconstruir(self):
+        prestamos = data["prestamos"]
+        self._monticulo = [
+            (self.vencimiento(p), uid)
+            for uid, p in prestamos.items()
+            if p.get("restante", 0) > 0
+        ]
+        heapq.heapify(self._monticulo)
+        self._listo = True
+
+    def actualizar(self, uids):
+        """Observador de "prestamos": programa los préstamos guardados"""
+        if not self._listo:
+            return  # el bucle lo construye entero al arrancar
+        if not uids:
+            self.reconstruir()
+        else:
+            for uid in uids:
+                p = data["prestamos"].get(str(uid))
+                if p and p.get("restante", 0) > 0:
+                    # Las entradas viejas se descartan al sacarlas
+                    heapq.heappush(self._monticulo, (self.vencimiento(p), str(uid)))
+        if self._despertar is not None:
+            self._despertar.set()
+
+    def pendientes(self) -> int:
+        return len(self._monticulo)
+
+    def iniciar(self):
+        if self._tarea is not None and not self._tarea.done():
+            return
+        self._despertar = asyncio.Event()
+        self._tarea = asyncio.get_running_loop().create_task(self._bucle())
+
+    async def detener(self):
+        if self._tarea is not None:
+            self._tarea.cancel()
+            self._tarea = None
+
+    def _sacar_vencidos(self, ahora: float) -> list:
+        uids = []
+        vistos = set()
+        while self._monticulo and self._monticulo[0][0] <= ahora and len(uids) < self.lote_max:
+            venc, uid = heapq.heappop(self._monticulo)
+            p = data["prestamos"].get(uid)
+            # Entrada obsoleta: préstamo pagado, borrado o reprogramado
+            if uid in vistos or not p or p.get("restante", 0) <= 0 or self.vencimiento(p) != venc:
+                continue
+            vistos.add(uid)
+            uids.append(uid)
+        return uids
+
+    async def _bucle(self):
+        await bot.wait_until_ready()
+        self.reconstruir()
+        while True:
+            self._despertar.clear()
+            espera = self._monticulo[0][0] - time.time() if self._monticulo else self.PERIODO
+            if espera > 0:
+                try:
+                    await asyncio.wait_for(self._despertar.wait(), timeout=espera)
+                except asyncio.TimeoutError:
+                    pass
                 continue
-            # aplicar una cuota diaria si no aplicada hoy
-            ultimo = p.get("ultimo_descuento")
-            if ultimo == hoy:
+            uids = self._sacar_vencidos(time.time())
+            if not uids:
                 continue
-            cuota = p.get("cuota_diaria", max(1, p["cantidad"] // max(1,p["dias_totales"])))
-            # asegurar cuenta
-            if uid in data["cuentas"] and data["cuentas"][uid]["tarjeta"] >= cuota:
-                data["cuentas"][uid]["tarjeta"] -= cuota
-                p["restante"] -= cuota
+            try:
+                await self.cobrar(uids)
+            except Exception:
+                logging.exception("Error cobrando préstamos")
+                # Reprogramar lo que no se llegó a cobrar
+                self.actualizar(uids)
+                await asyncio.sleep(60)
+
+    async def cobrar(self, uids):
+        """Aplica la cuota de cada préstamo vencido en un único lote"""
+        hoy = datetime.date.today().isoformat()
+        ahora = time.time()
+        avisos = []
+        async with transaccion(*uids) as tx:
+            for uid in uids:
+                # Con shards otro proceso puede haberlo cobrado ya
+                p = data["prestamos"].get(uid)
+                if not p or p.get("restante", 0) <= 0 or self.vencimiento(p) > ahora:
+                    continue
+                p = tx.registro("prestamos", uid)
+                p["proximo_cobro"] = self.siguiente(self.vencimiento(p), ahora)
                 p["ultimo_descuento"] = hoy
-                save_json("cuentas"); save_json("prestamos")
-                # notificar por MD con embed
-                user = bot.get_user(int(uid))
-                if user:
-                    try:
-                        embed_md = discord.Embed(
-                            title="💸 Pago Automático de Préstamo",
-                            description=f"Se ha descontado automáticamente **{cuota}€** de tu cuenta para el pago de tu préstamo.",
-                            color=discord.Color.blue()
-                        )
-                        embed_md.add_field(name="💰 Descontado", value=f"{cuota}€", inline=True)
-                        embed_md.add_field(name="📊 Restante", value=f"{p['restante']}€", inline=True)
-                        embed_md.add_field(name="💳 Saldo en tarjeta", value=f"{data['cuentas'][uid]['tarjeta']}€", inline=True)
-                        if p['restante'] == 0:
-                            embed_md.add_field(name="🎉 ¡Préstamo Completado!", value="Has liquidado completamente tu préstamo.", inline=False)
-                            embed_md.color = discord.Color.green()
-                        embed_md.set_footer(text="Sistema Bancario Automático • Valencia RP ESP")
-                        embed_md.timestamp = discord.utils.utcnow()
-                        
-                        await user.send(embed=embed_md)
-                    except:
-                        pass
-            else:
+                cuota = p.get("cuota_diaria", max(1, p.cantidad // max(1, p.dias_totales)))
+                cuota = min(cuota, p.restante)
                 # si no tiene saldo suficiente se registra intento y no se paga
-                p["ultimo_descuento"] = hoy  # evitar bucle diario, se intentará descontar cada día pero no quitar más
-                save_json("prestamos")
-        await asyncio.sleep(24*60*60)  # dormir 24h
+                cuenta = data["cuentas"].get(uid)
+                if cuenta is None or cuenta.tarjeta < cuota:
+                    continue
+                cuenta = tx.registro("cuentas", uid)
+                cuenta.tarjeta -= cuota
+                p.restante -= cuota
+                avisos.append((uid, cuota, p.restante, cuenta.tarjeta))
+        logging.info(f"Préstamos: {len(uids)} vencidos, {len(avisos)} cobrados")
+        for uid, cuota, restante, saldo in avisos:
+            notificaciones.encolar(uid, embed=embed_cobro_prestamo(cuota, restante, saldo))
+
+def embed_cobro_prestamo(cuota, restante, saldo) -> discord.Embed:
+    embed_md = discord.Embed(
+        title="💸 Pago Automático de Préstamo",
+        description=f"Se ha descontado automáticamente **{cuota}€** de tu cuenta para el pago de tu préstamo.",
+        color=discord.Color.blue()
+    )
+    embed_md.add_field(name="💰 Descontado", value=f"{cuota}€", inline=True)
+    embed_md.add_field(name="📊 Restante", value=f"{restante}€", inline=True)
+    embed_md.add_field(name="💳 Saldo en tarjeta", value=f"{saldo}€", inline=True)
+    if restante == 0:
+        embed_md.add_field(name="🎉 ¡Préstamo Completado!", value="Has liquidado completamente tu préstamo.", inline=False)
+        embed_md.color = discord.Color.green()
+    embed_md.set_footer(text="Sistema Bancario Automático • Valencia RP ESP")
+    embed_md.timestamp = discord.utils.utcnow()
+    return embed_md
+
+planificador_prestamos = PorParticion(lambda: PlanificadorPrestamos(config.PRESTAMOS_LOTE_MAX), servicio=True)
+observar_guardado("prestamos")(lambda uids: planificador_prestamos.actualizar(uids))
 
 # ----------------------
 # Parte 4 — INVENTARIO, TIENDA, ENTREGAR/ROBAR OBJETOS
@@ -1382,34 +4557,31 @@ async def mirar_inventario(interaction: Interaction, usuario: discord.Member):
 @app_commands.describe(usuario="Usuario", objeto="Nombre del objeto", cantidad="Cantidad")
 async def entregar_objeto(interaction: Interaction, usuario: discord.Member, objeto: str, cantidad: int):
     if cantidad <= 0:
-        embed = discord.Embed(
-            title="❌ Cantidad Inválida",
-            description="La cantidad debe ser mayor que 0.",
-            color=discord.Color.red()
-        )
-        embed.set_footer(text="Sistema de Inventario • Valencia RP ESP")
+        embed = embed_plantilla("cantidad_invalida", pie=config.FOOTER_INVENTARIO)
         await interaction.response.send_message(embed=embed, ephemeral=True); return
     uid = str(interaction.user.id); tid = str(usuario.id)
-    inv = data["inventario"].get(uid, {})
-    if inv.get(objeto,0) < cantidad:
-        embed = discord.Embed(
-            title="❌ Inventario Insuficiente",
-            description=f"No tienes suficiente **{objeto}** en tu inventario.",
-            color=discord.Color.red()
-        )
-        tengo = inv.get(objeto, 0)
-        embed.add_field(name="📦 Tienes", value=f"{tengo} {objeto}", inline=True)
-        embed.add_field(name="📤 Necesitas", value=f"{cantidad} {objeto}", inline=True)
-        embed.set_footer(text="Sistema de Inventario • Valencia RP ESP")
-        await interaction.response.send_message(embed=embed, ephemeral=True); return
-    inv[objeto] -= cantidad
-    if inv[objeto] <= 0:
-        del inv[objeto]
-    data["inventario"][uid] = inv
-    target_inv = data["inventario"].get(tid, {})
-    target_inv[objeto] = target_inv.get(objeto,0) + cantidad
-    data["inventario"][tid] = target_inv
-    save_json("inventario")
+    rechazo = None
+    async with transaccion(uid, tid) as tx:
+        inv = data["inventario"].get(uid, {})
+        if inv.get(objeto,0) < cantidad:
+            rechazo = discord.Embed(
+                title="❌ Inventario Insuficiente",
+                description=f"No tienes suficiente **{objeto}** en tu inventario.",
+                color=discord.Color.red()
+            )
+            tengo = inv.get(objeto, 0)
+            rechazo.add_field(name="📦 Tienes", value=f"{tengo} {objeto}", inline=True)
+            rechazo.add_field(name="📤 Necesitas", value=f"{cantidad} {objeto}", inline=True)
+            rechazo.set_footer(text="Sistema de Inventario • Valencia RP ESP")
+        else:
+            inv = tx.registro("inventario", uid)
+            inv[objeto] -= cantidad
+            if inv[objeto] <= 0:
+                del inv[objeto]
+            target_inv = tx.registro("inventario", tid, {})
+            target_inv[objeto] = target_inv.get(objeto,0) + cantidad
+    if rechazo is not None:
+        await interaction.response.send_message(embed=rechazo, ephemeral=True); return
     
     # Respuesta con embed
     embed = discord.Embed(
@@ -1429,28 +4601,31 @@ async def entregar_objeto(interaction: Interaction, usuario: discord.Member, obj
 @app_commands.describe(objeto="Objeto a robar", usuario="Objetivo")
 async def robar_inventario(interaction: Interaction, usuario: discord.Member, objeto: str):
     uid = str(interaction.user.id); tid = str(usuario.id)
-    target_inv = data["inventario"].get(tid, {})
-    if target_inv.get(objeto,0) <= 0:
-        embed = discord.Embed(
-            title="❌ Objeto No Encontrado",
-            description=f"{usuario.mention} no tiene **{objeto}** en su inventario.",
-            color=discord.Color.red()
-        )
-        embed.add_field(name="🔎 Objetivo", value=usuario.mention, inline=True)
-        embed.add_field(name="📦 Objeto Buscado", value=objeto, inline=True)
-        embed.set_footer(text="Sistema de Inventario • Valencia RP ESP")
-        await interaction.response.send_message(embed=embed, ephemeral=True); return
-    # probabilidad simple
-    if random.random() < 0.5:
-        # exito
-        target_inv[objeto] -= 1
-        if target_inv[objeto] <= 0: del target_inv[objeto]
-        data["inventario"][tid] = target_inv
-        inv = data["inventario"].get(uid, {})
-        inv[objeto] = inv.get(objeto,0) + 1
-        data["inventario"][uid] = inv
-        save_json("inventario")
-        
+    # Ladrón y víctima se bloquean en orden: dos robos cruzados no se atascan
+    rechazo = None
+    async with transaccion(uid, tid) as tx:
+        target_inv = data["inventario"].get(tid, {})
+        if target_inv.get(objeto,0) <= 0:
+            rechazo = discord.Embed(
+                title="❌ Objeto No Encontrado",
+                description=f"{usuario.mention} no tiene **{objeto}** en su inventario.",
+                color=discord.Color.red()
+            )
+            rechazo.add_field(name="🔎 Objetivo", value=usuario.mention, inline=True)
+            rechazo.add_field(name="📦 Objeto Buscado", value=objeto, inline=True)
+            rechazo.set_footer(text="Sistema de Inventario • Valencia RP ESP")
+        else:
+            # probabilidad simple
+            exito = random.random() < 0.5
+            if exito:
+                target_inv = tx.registro("inventario", tid)
+                target_inv[objeto] -= 1
+                if target_inv[objeto] <= 0: del target_inv[objeto]
+                inv = tx.registro("inventario", uid, {})
+                inv[objeto] = inv.get(objeto,0) + 1
+    if rechazo is not None:
+        await interaction.response.send_message(embed=rechazo, ephemeral=True); return
+    if exito:
         # Robo exitoso - embed
         embed = discord.Embed(
             title="💰 Robo Exitoso",
@@ -1536,23 +4711,26 @@ async def comprar_objeto(interaction: Interaction, objeto: str):
         await interaction.response.send_message(embed=embed, ephemeral=True); return
     precio = TIENDA[objeto]
     uid = str(interaction.user.id)
-    if uid not in data["cuentas"] or data["cuentas"][uid]["tarjeta"] < precio:
-        embed = discord.Embed(
-            title="❌ Dinero Insuficiente",
-            description="No tienes suficiente dinero en tu tarjeta para comprar este objeto.",
-            color=discord.Color.red()
-        )
-        saldo_actual = data["cuentas"].get(uid, {}).get("tarjeta", 0)
-        embed.add_field(name="💳 Tu Saldo", value=f"{saldo_actual}€", inline=True)
-        embed.add_field(name="💰 Precio", value=f"{precio}€", inline=True)
-        embed.add_field(name="📦 Objeto", value=objeto, inline=True)
-        embed.set_footer(text="Sistema de Tienda • Valencia RP ESP")
-        await interaction.response.send_message(embed=embed, ephemeral=True); return
-    data["cuentas"][uid]["tarjeta"] -= precio
-    inv = data["inventario"].get(uid, {})
-    inv[objeto] = inv.get(objeto,0) + 1
-    data["inventario"][uid] = inv
-    save_json("cuentas"); save_json("inventario")
+    # Cargo y objeto en la misma transacción
+    rechazo = None
+    async with transaccion(uid) as tx:
+        if uid not in data["cuentas"] or data["cuentas"][uid]["tarjeta"] < precio:
+            rechazo = discord.Embed(
+                title="❌ Dinero Insuficiente",
+                description="No tienes suficiente dinero en tu tarjeta para comprar este objeto.",
+                color=discord.Color.red()
+            )
+            saldo_actual = data["cuentas"].get(uid, {}).get("tarjeta", 0)
+            rechazo.add_field(name="💳 Tu Saldo", value=f"{saldo_actual}€", inline=True)
+            rechazo.add_field(name="💰 Precio", value=f"{precio}€", inline=True)
+            rechazo.add_field(name="📦 Objeto", value=objeto, inline=True)
+            rechazo.set_footer(text="Sistema de Tienda • Valencia RP ESP")
+        else:
+            tx.registro("cuentas", uid)["tarjeta"] -= precio
+            inv = tx.registro("inventario", uid, {})
+            inv[objeto] = inv.get(objeto,0) + 1
+    if rechazo is not None:
+        await interaction.response.send_message(embed=rechazo, ephemeral=True); return
     
     # Respuesta con embed
     embed = discord.Embed(
@@ -1616,21 +4794,115 @@ CODIGO_PENAL = {
     "6.5": {"descripcion":"Atentado contra la autoridad - Pena de prisión de 2 a 5 años","precio":1000}
 }
 
-# ID del rol de Policía (cámbialo por el tuyo)
-ROL_POLICIA_ID = 1401538045567565877  
+class CodigoPenalVersionado:
+    """Versiones del código penal guardadas en data["codigo_penal"]
+    ({"<n>": {codigo: {"descripcion", "precio"}}}).
+
+    Cada multa guarda solo los códigos y la versión con la que se impuso, así
+    que cambiar CODIGO_PENAL no altera las multas antiguas: al arrancar, si no
+    coincide con la última versión guardada, se registra como versión nueva.
+    """
+
+    def __init__(self):
+        self._actual = None
+
+    def _versiones(self) -> dict:
+        return data["codigo_penal"]
+
+    def _ultima(self) -> int:
+        return max(map(int, self._versiones()), default=0)
+
+    def _registrar(self, tabla: dict) -> int:
+        version = self._ultima() + 1
+        self._versiones()[str(version)] = tabla
+        save_json("codigo_penal", str(version))
+        logging.info(f"Código penal: registrada la versión {version}")
+        return version
+
+    def version_actual(self) -> int:
+        if self._actual is None:
+            versiones = self._versiones()
+            # La más reciente igual a CODIGO_PENAL (las de migración no cuentan)
+            self._actual = next(
+                (v for v in sorted(map(int, versiones), reverse=True) if versiones[str(v)] == CODIGO_PENAL),
+                None
+            )
+            if self._actual is None:
+                self._actual = self._registrar(copy.deepcopy(CODIGO_PENAL))
+        return self._actual
+
+    def articulo(self, version, codigo: str) -> ArticuloPenal:
+        entrada = self._versiones().get(str(version), {}).get(codigo)
+        if entrada is None:
+            return ArticuloPenal.de(codigo, "Artículo desconocido", 0)
+        return ArticuloPenal.de(codigo, entrada["descripcion"], entrada["precio"])
+
+    def articulos(self, multa: Multa) -> list:
+        """Artículos completos de una multa (normalizada o antigua)"""
+        version = multa.get("cp")
+        return [
+            a if isinstance(a, ArticuloPenal) else self.articulo(version, a)
+            for a in multa.get("articulos", ())
+        ]
+
+    def texto_articulos(self, multa: Multa) -> str:
+        return _texto_articulos(self, multa.get("cp"), multa.get("articulos", ()))
+
+    def version_para(self, articulos) -> int:
+        """Versión que contiene exactamente estos artículos; si ninguna
+        encaja se registra una: el código actual con ellos encima"""
+        versiones = self._versiones()
+        for version in sorted(map(int, versiones), reverse=True):
+            tabla = versiones[str(version)]
+            if all(tabla.get(a.codigo) == {"descripcion": a.descripcion, "precio": a.precio} for a in articulos):
+                return version
+        tabla = copy.deepcopy(CODIGO_PENAL)
+        for a in articulos:
+            tabla[a.codigo] = {"descripcion": a.descripcion, "precio": a.precio}
+        return self._registrar(tabla)
+
+@functools.lru_cache(maxsize=4096)
+def _texto_articulos(tabla, version, articulos) -> str:
+    # Formato exacto como el ejemplo del usuario; se cachea por (versión, códigos)
+    return ", ".join(
+        f"Artículo {a['codigo']}: {a['descripcion']} - {a['precio']}€"
+        for a in (x if isinstance(x, ArticuloPenal) else tabla.articulo(version, x) for x in articulos)
+    )
+
+codigo_penal = PorParticion(CodigoPenalVersionado)
+
+def migrar_multas() -> int:
+    """Migración única: pasa las multas con artículos completos al formato
+    normalizado (códigos + versión). Devuelve cuántas se migraron"""
+    migradas = 0
+    multas = data["multas"]
+    # Primero los uids a migrar: en SQLite items() no deja los registros en
+    # caché y hay que modificar los que guardará save_json
+    pendientes = [
+        uid for uid, lista in multas.items()
+        if any(isinstance(m, Multa) and not m.normalizada() for m in lista)
+    ]
+    for uid in pendientes:
+        for multa in multas[uid]:
+            if not isinstance(multa, Multa) or multa.normalizada():
+                continue
+            articulos = multa["articulos"]
+            multa["cp"] = codigo_penal.version_para(articulos)
+            multa["articulos"] = [a.codigo for a in articulos]
+            migradas += 1
+    if migradas:
+        # Reescritura completa: la tienda queda entera en el formato nuevo
+        save_json("multas")
+    return migradas
+
+# Rol de Policía que puede multar: ROL_POLICIA_MULTAS_ID de cada servidor
 
 @tree.command(name="multas-poner", description="Poner multas mediante códigos (ej: 1.1,2.3) - SOLO POLICÍA")
 @app_commands.describe(usuario="Usuario a multar", articulos="Códigos separados por coma")
 async def multas_poner(interaction: Interaction, usuario: discord.Member, articulos: str):
     # 🔒 Verificación: solo usuarios con rol Policía
-    if ROL_POLICIA_ID not in [r.id for r in interaction.user.roles]:
-        embed = discord.Embed(
-            title="🚫 Acceso Denegado",
-            description="Este comando solo puede ser usado por la Policía Local de Valencia.",
-            color=discord.Color.red()
-        )
-        embed.add_field(name="⚖️ Requerido", value="Rol de Policía", inline=True)
-        embed.set_footer(text="Sistema de Multas • Código Penal de Valencia")
+    if not capacidades(interaction.user).tiene(config_servidor(interaction.guild_id).ROL_POLICIA_MULTAS_ID):
+        embed = embed_plantilla("acceso_denegado_policia", pie="Sistema de Multas • Código Penal de Valencia", motivo="Este comando solo puede ser usado por la Policía Local de Valencia.")
         await interaction.response.send_message(embed=embed, ephemeral=True)
         return
 
@@ -1638,21 +4910,20 @@ async def multas_poner(interaction: Interaction, usuario: discord.Member, articu
     lista = []; total = 0
     for c in cods:
         if c in CODIGO_PENAL:
-            lista.append({"codigo":c, **CODIGO_PENAL[c]})
+            lista.append(c)
             total += CODIGO_PENAL[c]["precio"]
 
     codigo = generar_codigo_multa()
     uid = str(usuario.id)
-    if uid not in data["multas"]:
-        data["multas"][uid] = []
-    data["multas"][uid].append({
-        "codigo":codigo, 
-        "agente":interaction.user.mention, 
-        "articulos":lista, 
-        "total":total, 
-        "fecha": datetime.date.today().isoformat()
-    })
-    save_json("multas")
+    async with transaccion(uid) as tx:
+        tx.registro("multas", uid, []).append(Multa(
+            codigo=codigo,
+            agente=interaction.user.mention,
+            articulos=lista,
+            cp=codigo_penal.version_actual(),
+            total=total,
+            fecha=datetime.date.today().isoformat()
+        ))
 
     # Embed profesional
     embed = discord.Embed(
@@ -1665,7 +4936,7 @@ async def multas_poner(interaction: Interaction, usuario: discord.Member, articu
     embed.add_field(name="💰 Total", value=f"{total}€", inline=True)
 
     articulos_texto = []
-    for art in lista:
+    for art in codigo_penal.articulos(data["multas"][uid][-1]):
         articulos_texto.append(f"**Art. {art['codigo']}**: {art['descripcion']} ({art['precio']}€)")
 
     if articulos_texto:
@@ -1703,69 +4974,52 @@ async def multas_ver(interaction: Interaction, usuario: discord.Member):
         embed.set_footer(text="Sistema de Consultas • Código Penal de Valencia")
         await interaction.response.send_message(embed=embed); return
     
-    total_all = 0
-    for i, m in enumerate(multas, start=1):
-        # Formato exacto como el ejemplo del usuario
-        articulos_text = []
-        for a in m["articulos"]:
-            articulos_text.append(f"Artículo {a['codigo']}: {a['descripcion']} - {a['precio']}€")
-        
-        multa_info = f"""**Agente:** {m['agente']}
-**Artículos:** {', '.join(articulos_text)}
-**Código:** {m['codigo']}
-**Fecha:** {m.get('fecha', 'No registrada')}"""
-        
-        embed.add_field(
-            name=f"⚖️ Multa Nº {i}",
-            value=multa_info,
-            inline=False
-        )
-        total_all += m['total']
-    
-    # Estado general del usuario
-    embed.add_field(name="📊 Total Acumulado", value=f"**{total_all}€**", inline=True)
-    embed.add_field(name="📄 Licencia", value=("✅ Posee licencia" if uid in data.get("carnets",{}) else "❌ Sin licencia"), inline=True)
-    embed.add_field(name="🚗 Estado Vehicular", value="En revisión", inline=True)
-    
-    embed.set_footer(text="Sistema de Consultas • Código Penal de Valencia")
-    embed.timestamp = discord.utils.utcnow()
-    
-    await interaction.response.send_message(embed=embed)
+    embed, view = pagina_historial("multas", usuario, 0)
+    await interaction.response.send_message(embed=embed, view=view)
 
 @tree.command(name="pagar-multas", description="Pagar multa por código")
 @app_commands.describe(codigo="Código de multa", cantidad="Cantidad a pagar")
 async def pagar_multas(interaction: Interaction, codigo: str, cantidad: int):
     uid_user = str(interaction.user.id)
-    for uid, lista in data["multas"].items():
-        for multa in lista:
-            if multa["codigo"] == codigo:
-                if uid_user not in data["cuentas"] or data["cuentas"][uid_user]["tarjeta"] < cantidad:
-                    await interaction.response.send_message("❌ No tienes saldo para pagar.", ephemeral=True); return
-                if cantidad < multa["total"]:
-                    await interaction.response.send_message(f"❌ Debes pagar al menos {multa['total']}€", ephemeral=True); return
-                data["cuentas"][uid_user]["tarjeta"] -= cantidad
-                lista.remove(multa)
-                save_json("multas"); save_json("cuentas")
-                
-                # Respuesta con embed profesional
-                embed = discord.Embed(
-                    title="✅ Multa Pagada",
-                    description=f"Has pagado exitosamente la multa **{codigo}**",
-                    color=discord.Color.green()
-                )
-                embed.add_field(name="📄 Código de Multa", value=codigo, inline=True)
-                embed.add_field(name="💰 Cantidad Pagada", value=f"{cantidad}€", inline=True)
-                embed.add_field(name="💳 Saldo Restante", value=f"{data['cuentas'][uid_user]['tarjeta']}€", inline=True)
-                embed.add_field(name="📊 Total de Multa", value=f"{multa['total']}€", inline=True)
-                embed.add_field(name="📅 Fecha de Pago", value=datetime.date.today().strftime("%d/%m/%Y"), inline=True)
-                embed.add_field(name="✅ Estado", value="**LIQUIDADA**", inline=True)
-                embed.set_footer(text="Sistema de Multas • Código Penal de Valencia")
-                embed.set_author(name=interaction.user.display_name, icon_url=interaction.user.display_avatar.url)
-                embed.timestamp = discord.utils.utcnow()
-                
-                await interaction.response.send_message(embed=embed)
-                return
-    await interaction.response.send_message("❌ Código no encontrado.", ephemeral=True)
+    encontrada = indice_multas.buscar(codigo)
+    if encontrada is None:
+        await interaction.response.send_message("❌ Código no encontrado.", ephemeral=True); return
+    uid = encontrada[0]
+    # Cargo y baja de la multa en la misma transacción
+    rechazo = None
+    async with transaccion(uid_user, uid) as tx:
+        # Volver a buscarla ya con el bloqueo: otro pago pudo llevársela
+        encontrada = indice_multas.buscar(codigo)
+        if encontrada is None or encontrada[0] != uid:
+            rechazo = "❌ Código no encontrado."
+        elif uid_user not in data["cuentas"] or data["cuentas"][uid_user]["tarjeta"] < cantidad:
+            rechazo = "❌ No tienes saldo para pagar."
+        elif cantidad < encontrada[2]["total"]:
+            rechazo = f"❌ Debes pagar al menos {encontrada[2]['total']}€"
+        else:
+            _, pos, multa = encontrada
+            tx.registro("cuentas", uid_user)["tarjeta"] -= cantidad
+            del tx.registro("multas", uid)[pos]
+    if rechazo is not None:
+        await interaction.response.send_message(rechazo, ephemeral=True); return
+    
+    # Respuesta con embed profesional
+    embed = discord.Embed(
+        title="✅ Multa Pagada",
+        description=f"Has pagado exitosamente la multa **{codigo}**",
+        color=discord.Color.green()
+    )
+    embed.add_field(name="📄 Código de Multa", value=codigo, inline=True)
+    embed.add_field(name="💰 Cantidad Pagada", value=f"{cantidad}€", inline=True)
+    embed.add_field(name="💳 Saldo Restante", value=f"{data['cuentas'][uid_user]['tarjeta']}€", inline=True)
+    embed.add_field(name="📊 Total de Multa", value=f"{multa['total']}€", inline=True)
+    embed.add_field(name="📅 Fecha de Pago", value=datetime.date.today().strftime("%d/%m/%Y"), inline=True)
+    embed.add_field(name="✅ Estado", value="**LIQUIDADA**", inline=True)
+    embed.set_footer(text="Sistema de Multas • Código Penal de Valencia")
+    embed.set_author(name=interaction.user.display_name, icon_url=interaction.user.display_avatar.url)
+    embed.timestamp = discord.utils.utcnow()
+    
+    await interaction.response.send_message(embed=embed)
 
 @tree.command(name="multas-eliminar", description="Eliminar una multa por código (SOLO STAFF)")
 @app_commands.describe(usuario="Usuario", codigo="Código de la multa")
@@ -1773,43 +5027,35 @@ async def multas_eliminar(interaction: Interaction, usuario: discord.Member, cod
     if not es_staff(interaction.user):
         await interaction.response.send_message("🚫 Solo staff.", ephemeral=True); return
     uid = str(usuario.id)
-    lista = data.get("multas", {}).get(uid, [])
-    for m in lista:
-        if m["codigo"] == codigo:
-            lista.remove(m); save_json("multas")
-            # Respuesta con embed profesional
-            embed = discord.Embed(
-                title="🗑️ Multa Eliminada",
-                description=f"La multa **{codigo}** ha sido eliminada del historial de {usuario.mention}",
-                color=discord.Color.blue()
-            )
-            embed.add_field(name="📄 Código", value=codigo, inline=True)
-            embed.add_field(name="👤 Usuario", value=usuario.mention, inline=True)
-            embed.add_field(name="🚔 Staff", value=interaction.user.mention, inline=True)
-            embed.set_footer(text="Sistema Administrativo • Código Penal de Valencia")
-            embed.set_author(name="Eliminación de Multa", icon_url=interaction.user.display_avatar.url)
-            embed.timestamp = discord.utils.utcnow()
-            
-            await interaction.response.send_message(embed=embed)
-            return
-    await interaction.response.send_message("❌ No encontrada.", ephemeral=True)
-
-# ID del rol de Policía (cámbialo por el tuyo)
-ROL_POLICIA_ID = 1401538045567565877  
+    async with transaccion(uid) as tx:
+        # Buscarla con el bloqueo tomado: un pago pudo llevársela
+        encontrada = indice_multas.buscar(codigo)
+        if encontrada is not None and encontrada[0] == uid:
+            del tx.registro("multas", uid)[encontrada[1]]
+    if encontrada is None or encontrada[0] != uid:
+        await interaction.response.send_message("❌ No encontrada.", ephemeral=True); return
+    # Respuesta con embed profesional
+    embed = discord.Embed(
+        title="🗑️ Multa Eliminada",
+        description=f"La multa **{codigo}** ha sido eliminada del historial de {usuario.mention}",
+        color=discord.Color.blue()
+    )
+    embed.add_field(name="📄 Código", value=codigo, inline=True)
+    embed.add_field(name="👤 Usuario", value=usuario.mention, inline=True)
+    embed.add_field(name="🚔 Staff", value=interaction.user.mention, inline=True)
+    embed.set_footer(text="Sistema Administrativo • Código Penal de Valencia")
+    embed.set_author(name="Eliminación de Multa", icon_url=interaction.user.display_avatar.url)
+    embed.timestamp = discord.utils.utcnow()
+    
+    await interaction.response.send_message(embed=embed)
 
 # Vehículos: incautar
 @tree.command(name="incautar", description="Incautar vehículo a un usuario - SOLO POLICÍA")
 @app_commands.describe(usuario="Usuario", matricula="Matrícula", modelo="Modelo", articulos="Artículos/motivo")
 async def incautar(interaction: Interaction, usuario: discord.Member, matricula: str, modelo: str, articulos: str):
     # 🔒 Verificación: solo rol Policía
-    if ROL_POLICIA_ID not in [r.id for r in interaction.user.roles]:
-        embed = discord.Embed(
-            title="🚫 Acceso Denegado",
-            description="Este comando solo puede ser usado por la Policía.",
-            color=discord.Color.red()
-        )
-        embed.add_field(name="⚖️ Requerido", value="Rol de Policía", inline=True)
-        embed.set_footer(text="Sistema de Vehículos • Policía de Valencia")
+    if not capacidades(interaction.user).tiene(config_servidor(interaction.guild_id).ROL_POLICIA_MULTAS_ID):
+        embed = embed_plantilla("acceso_denegado_policia", motivo="Este comando solo puede ser usado por la Policía.")
         await interaction.response.send_message(embed=embed, ephemeral=True)
         return
 
@@ -1822,7 +5068,7 @@ async def incautar(interaction: Interaction, usuario: discord.Member, matricula:
         "motivo": articulos, 
         "fecha": datetime.date.today().isoformat()
     })
-    save_json("vehiculos")
+    save_json("vehiculos", uid)
     await interaction.response.send_message(
         f"✅ Vehículo **{modelo}** ({matricula}) incautado a {usuario.mention}"
     )
@@ -1837,14 +5083,8 @@ async def incautar(interaction: Interaction, usuario: discord.Member, matricula:
 )
 async def retirar(interaction: Interaction, usuario: discord.Member, licencia: app_commands.Choice[str], vehiculo: app_commands.Choice[str]):
     # 🔒 Verificación: solo rol Policía
-    if ROL_POLICIA_ID not in [r.id for r in interaction.user.roles]:
-        embed = discord.Embed(
-            title="🚫 Acceso Denegado",
-            description="Este comando solo puede ser usado por la Policía.",
-            color=discord.Color.red()
-        )
-        embed.add_field(name="⚖️ Requerido", value="Rol de Policía", inline=True)
-        embed.set_footer(text="Sistema de Vehículos • Policía de Valencia")
+    if not capacidades(interaction.user).tiene(config_servidor(interaction.guild_id).ROL_POLICIA_MULTAS_ID):
+        embed = embed_plantilla("acceso_denegado_policia", motivo="Este comando solo puede ser usado por la Policía.")
         await interaction.response.send_message(embed=embed, ephemeral=True)
         return
 
@@ -1854,7 +5094,7 @@ async def retirar(interaction: Interaction, usuario: discord.Member, licencia: a
     if licencia.value == "SI":
         if uid in data["carnets"]:
             del data["carnets"][uid]
-            save_json("carnets")
+            save_json("carnets", uid)
             mensajes.append("🚫 Licencia retirada")
         else:
             mensajes.append("ℹ️ No tenía licencia")
@@ -1862,7 +5102,7 @@ async def retirar(interaction: Interaction, usuario: discord.Member, licencia: a
     if vehiculo.value == "SI":
         if uid in data["vehiculos"] and data["vehiculos"][uid]:
             data["vehiculos"].pop(uid, None)
-            save_json("vehiculos")
+            save_json("vehiculos", uid)
             mensajes.append("🚔 Vehículos retirados")
         else:
             mensajes.append("ℹ️ No tenía vehículos incautados")
@@ -1881,9 +5121,9 @@ async def poner_sancion(interaction: Interaction, usuario: discord.Member, motiv
     if not es_staff(interaction.user):
         await interaction.response.send_message("🚫 Solo staff puede.", ephemeral=True); return
     uid = str(usuario.id)
-    s = {"staff": interaction.user.mention, "motivo": motivo, "fecha": datetime.date.today().strftime("%d/%m/%Y"), "apelable": apelable.value, "tipo": tipo.value}
+    s = Sancion(staff=interaction.user.mention, motivo=motivo, fecha=datetime.date.today().strftime("%d/%m/%Y"), apelable=apelable.value, tipo=tipo.value)
     data["sanciones"].setdefault(uid, []).append(s)
-    save_json("sanciones")
+    save_json("sanciones", uid)
     # mensaje público
     embed = Embed(title="⚠️ Nueva sanción impuesta", color=discord.Color.red())
     embed.add_field(name="Usuario", value=usuario.mention, inline=True)
@@ -1902,7 +5142,7 @@ async def quitar_sancion(interaction: Interaction, usuario: discord.Member, nume
     uid = str(usuario.id)
     if uid not in data["sanciones"] or numero < 1 or numero > len(data["sanciones"][uid]):
         await interaction.response.send_message("❌ Número inválido.", ephemeral=True); return
-    elim = data["sanciones"][uid].pop(numero-1); save_json("sanciones")
+    elim = data["sanciones"][uid].pop(numero-1); save_json("sanciones", uid)
     embed = Embed(title="✅ Sanción eliminada", color=discord.Color.green())
     embed.add_field(name="Usuario", value=usuario.mention)
     embed.add_field(name="Motivo eliminado", value=elim.get("motivo","-"))
@@ -1917,10 +5157,209 @@ async def sanciones_ver(interaction: Interaction, usuario: discord.Member):
         embed = Embed(title=f"Registro de sanciones de {usuario.display_name}", color=discord.Color.green())
         embed.add_field(name="Antecedentes", value="Sin sanciones", inline=False)
         await interaction.response.send_message(embed=embed); return
-    embed = Embed(title=f"📋 Sanciones de {usuario.display_name}", description=f"Este usuario tiene {len(sancs)} sanción(es):", color=discord.Color.orange())
-    for i, s in enumerate(sancs, start=1):
-        embed.add_field(name=f"Sanción Nº {i}", value=f"{s.get('staff')}\n{s.get('motivo')} - {s.get('fecha')}\nApelable: {s.get('apelable')}\nTipo: {s.get('tipo')}", inline=False)
-    await interaction.response.send_message(embed=embed)
+    embed, view = pagina_historial("sanciones", usuario, 0)
+    await interaction.response.send_message(embed=embed, view=view)
+
+@tree.command(name="vehiculos-incautados", description="Ver vehículos incautados de un usuario")
+@app_commands.describe(usuario="Usuario a consultar")
+async def vehiculos_incautados(interaction: Interaction, usuario: discord.Member):
+    if not data["vehiculos"].get(str(usuario.id)):
+        await interaction.response.send_message(f"✅ {usuario.mention} no tiene vehículos incautados.", ephemeral=True); return
+    embed, view = pagina_historial("vehiculos", usuario, 0)
+    await interaction.response.send_message(embed=embed, view=view)
+
+@tree.command(name="formaciones-ver", description="Ver oposiciones y formaciones de un usuario")
+@app_commands.describe(usuario="Usuario a consultar")
+async def formaciones_ver(interaction: Interaction, usuario: discord.Member):
+    if not data["oposiciones"].get(str(usuario.id)):
+        await interaction.response.send_message(f"ℹ️ {usuario.mention} no tiene formaciones registradas.", ephemeral=True); return
+    embed, view = pagina_historial("oposiciones", usuario, 0)
+    await interaction.response.send_message(embed=embed, view=view)
+
+# =====================
+# HISTORIALES PAGINADOS
+# =====================
+# Multas, sanciones, vehículos y formaciones se muestran por páginas. Solo se
+# formatea la página pedida (un corte de la lista del usuario) y los campos
+# ya formateados se guardan hasta que se guarda esa lista otra vez, para los
+# HISTORIALES_EN_CACHE historiales consultados más recientemente. Los
+# botones llevan tipo, usuario y página en el custom_id, así que no guardan
+# estado y siguen funcionando tras un reinicio.
+HISTORIALES_EN_CACHE = 500  # (tipo, usuario) con páginas formateadas, por partición
+LIMITE_CAMPO = 1024  # caracteres del valor de un campo de embed en Discord
+
+class TipoHistorial:
+    def __init__(self, key, titulo, color, pie, campo, descripcion=None, resumen=None, extra=None, por_pagina=5):
+        self.key = key
+        self.titulo = titulo            # nombre -> título
+        self.color = color
+        self.pie = pie
+        self.campo = campo              # (nº, registro) -> (name, value)
+        self.descripcion = descripcion  # lista -> texto
+        self.resumen = resumen          # lista -> [(name, value, inline)], se cachea
+        self.extra = extra              # uid -> [(name, value, inline)], siempre al día
+        self.por_pagina = por_pagina
+
+def _resumen_multas(lista):
+    return [("📊 Total Acumulado", f"**{sum(m['total'] for m in lista)}€**", True)]
+
+def _extra_multas(uid):
+    return [
+        ("📄 Licencia", "✅ Posee licencia" if uid in data.get("carnets", {}) else "❌ Sin licencia", True),
+        ("🚗 Estado Vehicular", "En revisión", True),
+    ]
+
+HISTORIALES = {
+    "multas": TipoHistorial(
+        "multas",
+        titulo=lambda nombre: f"📄 Registro de multas de {nombre}",
+        descripcion=lambda lista: "Antecedentes del usuario seleccionado",
+        color=discord.Color.orange(),
+        pie="Sistema de Consultas • Código Penal de Valencia",
+        campo=lambda i, m: (
+            f"⚖️ Multa Nº {i}",
+            f"**Agente:** {m['agente']}\n"
+            f"**Artículos:** {codigo_penal.texto_articulos(m)}\n"
+            f"**Código:** {m['codigo']}\n"
+            f"**Fecha:** {m.get('fecha', 'No registrada')}"
+        ),
+        resumen=_resumen_multas,
+        extra=_extra_multas,
+    ),
+    "sanciones": TipoHistorial(
+        "sanciones",
+        titulo=lambda nombre: f"📋 Sanciones de {nombre}",
+        descripcion=lambda lista: f"Este usuario tiene {len(lista)} sanción(es):",
+        color=discord.Color.orange(),
+        pie=config.FOOTER_ADMINISTRATIVO,
+        campo=lambda i, s: (
+            f"Sanción Nº {i}",
+            f"{s.get('staff')}\n{s.get('motivo')} - {s.get('fecha')}\nApelable: {s.get('apelable')}\nTipo: {s.get('tipo')}"
+        ),
+    ),
+    "vehiculos": TipoHistorial(
+        "vehiculos",
+        titulo=lambda nombre: f"🚔 Vehículos incautados de {nombre}",
+        descripcion=lambda lista: f"{len(lista)} vehículo(s) incautado(s)",
+        color=discord.Color.dark_blue(),
+        pie="Sistema de Vehículos • Policía de Valencia",
+        campo=lambda i, v: (
+            f"🚗 {i}. {v.get('modelo', '-')} ({v.get('matricula', '-')})",
+            f"**Motivo:** {v.get('motivo', '-')}\n**Fecha:** {v.get('fecha', 'No registrada')}"
+        ),
+    ),
+    "oposiciones": TipoHistorial(
+        "oposiciones",
+        titulo=lambda nombre: f"🎓 Formaciones de {nombre}",
+        descripcion=lambda lista: f"{len(lista)} formación(es) registrada(s)",
+        color=discord.Color.green(),
+        pie="Sistema de Formación • Valencia RP",
+        campo=lambda i, o: (
+            f"📜 {i}. {o.get('corporacion_nombre', o.get('corporacion', '-'))}",
+            f"**Código:** {o.get('codigo', '-')}\n**Instructor:** {o.get('instructor', '-')}\n"
+            f"**Fecha:** {o.get('fecha', '-')}\n**Estado:** {o.get('estado', '-')}"
+        ),
+    ),
+}
+
+class CacheHistoriales(collections.OrderedDict):
+    """(tipo, uid) -> {nº de página o "resumen": campos ya formateados}; al
+    pasar de HISTORIALES_EN_CACHE se descarta el consultado hace más tiempo"""
+
+    def paginas(self, clave) -> dict:
+        cache = self.get(clave)
+        if cache is None:
+            cache = self[clave] = {}
+            if len(self) > HISTORIALES_EN_CACHE:
+                self.popitem(last=False)
+        else:
+            self.move_to_end(clave)
+        return cache
+
+_paginas_historial = PorParticion(CacheHistoriales)
+
+def _campo_historial(name, value):
+    """Recorta un campo que no cabría en Discord (muchos artículos en una multa)"""
+    if len(value) > LIMITE_CAMPO:
+        value = value[:LIMITE_CAMPO - 3] + "..."
+    return name, value
+
+def _invalidador_historial(nombre):
+    def invalidar(uids):
+        if not uids:
+            for clave in [c for c in _paginas_historial if c[0] == nombre]:
+                del _paginas_historial[clave]
+        for uid in uids:
+            _paginas_historial.pop((nombre, str(uid)), None)
+    return invalidar
+
+for _nombre, _tipo in HISTORIALES.items():
+    observar_guardado(_tipo.key)(_invalidador_historial(_nombre))
+
+def pagina_historial(nombre: str, usuario, pagina: int):
+    """Embed y botones de una página del historial `nombre` de `usuario`"""
+    tipo = HISTORIALES[nombre]
+    uid = str(usuario.id)
+    lista = data[tipo.key].get(uid) or []
+    paginas = max(1, -(-len(lista) // tipo.por_pagina))
+    pagina = min(max(pagina, 0), paginas - 1)
+
+    cache = _paginas_historial.paginas((nombre, uid))
+    if pagina not in cache:
+        inicio = pagina * tipo.por_pagina
+        cache[pagina] = [
+            _campo_historial(*tipo.campo(i, registro))
+            for i, registro in enumerate(lista[inicio:inicio + tipo.por_pagina], start=inicio + 1)
+        ]
+    if tipo.resumen and "resumen" not in cache:
+        cache["resumen"] = tipo.resumen(lista)
+
+    embed = discord.Embed(
+        title=tipo.titulo(getattr(usuario, "display_name", None) or f"<@{uid}>"),
+        description=tipo.descripcion(lista) if tipo.descripcion else None,
+        color=tipo.color
+    )
+    if getattr(usuario, "display_avatar", None):
+        embed.set_thumbnail(url=usuario.display_avatar.url)
+    for name, value in cache[pagina]:
+        embed.add_field(name=name, value=value, inline=False)
+    for name, value, inline in cache.get("resumen", []) + (tipo.extra(uid) if tipo.extra else []):
+        embed.add_field(name=name, value=value, inline=inline)
+    embed.set_footer(text=f"{tipo.pie} • Página {pagina + 1}/{paginas}")
+    embed.timestamp = discord.utils.utcnow()
+
+    view = View(timeout=None)
+    if paginas > 1:
+        view.add_item(BotonPagina(nombre, uid, pagina - 1, "a", disabled=pagina == 0))
+        view.add_item(BotonPagina(nombre, uid, pagina + 1, "s", disabled=pagina >= paginas - 1))
+    return embed, view
+
+class BotonPagina(discord.ui.DynamicItem[Button], template=r"pag:(?P<tipo>\w+):(?P<uid>\d+):(?P<pagina>-?\d+):(?P<dir>[as])"):
+    """Botón anterior/siguiente de un historial paginado"""
+
+    def __init__(self, nombre: str, uid: str, pagina: int, direccion: str, disabled: bool = False):
+        super().__init__(Button(
+            label="◀ Anterior" if direccion == "a" else "Siguiente ▶",
+            style=discord.ButtonStyle.secondary,
+            custom_id=f"pag:{nombre}:{uid}:{pagina}:{direccion}",
+            disabled=disabled
+        ))
+        self.nombre = nombre
+        self.uid = uid
+        self.pagina = pagina
+
+    @classmethod
+    async def from_custom_id(cls, interaction: Interaction, item: Button, match):
+        return cls(match["tipo"], match["uid"], int(match["pagina"]), match["dir"])
+
+    async def callback(self, interaction: Interaction):
+        if self.nombre not in HISTORIALES:
+            await interaction.response.send_message("⚠️ Historial desconocido.", ephemeral=True); return
+        usuario = (interaction.guild.get_member(int(self.uid)) if interaction.guild else None) or bot.get_user(int(self.uid))
+        if usuario is None:
+            usuario = discord.Object(id=int(self.uid))
+        embed, view = pagina_historial(self.nombre, usuario, self.pagina)
+        await interaction.response.edit_message(embed=embed, view=view)
 
 # ----------------------
 # Parte 7 — VOTACIONES, RECLAMAR ROBO (confirmación negociador), MANTENIMIENTO y ADMIN
@@ -1985,20 +5424,143 @@ async def reclamar_robo(interaction: Interaction, establecimiento: app_commands.
     # enviar embed y luego mensaje pidiendo confirmación (guardar mensaje)
     await interaction.response.send_message(embed=embed)
     confirm_msg = await interaction.followup.send(f"{negociador.mention}, podría confirmar el robo? Si es así responde A ESTE MENSAJE con **Confirmo** (usa reply).")
-    # check: author is negociador, content "confirmo", and message is a reply to confirm_msg
-    def check(m):
-        return m.author.id == negociador.id and m.content.lower().strip() == "confirmo" and m.reference and m.reference.message_id == confirm_msg.id
-    try:
-        msg = await bot.wait_for("message", timeout=3600.0, check=check)
+    # on_message resuelve la respuesta buscando confirm_msg.id en el registro
+    confirmaciones_robo.registrar(confirm_msg, negociador, interaction.channel)
+
+class RuedaTemporizadores:
+    """Rueda de temporizadores: `ranuras` casillas de `resolucion` segundos.
+
+    Cada clave va a la casilla de su vencimiento con las vueltas que le
+    faltan; una sola tarea avanza una casilla por tic y caduca lo que toca,
+    en vez de un temporizador por clave.
+    """
+
+    def __init__(self, resolucion: float, ranuras: int, al_caducar):
+        self.resolucion = resolucion
+        self._ranuras = [dict() for _ in range(ranuras)]  # clave -> vueltas restantes
+        self._donde = {}  # clave -> índice de casilla
+        self._actual = 0
+        self._al_caducar = al_caducar
+        self._tarea = None
+
+    def programar(self, clave, vence: float):
+        self.cancelar(clave)
+        tics = max(1, int((vence - time.time()) // self.resolucion) + 1)
+        indice = (self._actual + tics) % len(self._ranuras)
+        self._ranuras[indice][clave] = (tics - 1) // len(self._ranuras)
+        self._donde[clave] = indice
+
+    def cancelar(self, clave):
+        indice = self._donde.pop(clave, None)
+        if indice is not None:
+            self._ranuras[indice].pop(clave, None)
+
+    def __len__(self):
+        return len(self._donde)
+
+    def iniciar(self):
+        if self._tarea is None or self._tarea.done():
+            self._tarea = asyncio.get_running_loop().create_task(self._bucle())
+
+    async def detener(self):
+        if self._tarea is not None:
+            self._tarea.cancel()
+            self._tarea = None
+
+    def tic(self):
+        self._actual = (self._actual + 1) % len(self._ranuras)
+        casilla = self._ranuras[self._actual]
+        caducadas = [clave for clave, vueltas in casilla.items() if vueltas == 0]
+        for clave in list(casilla):
+            casilla[clave] -= 1
+        for clave in caducadas:
+            del casilla[clave]
+            del self._donde[clave]
+        return caducadas
+
+    async def _bucle(self):
+        while True:
+            await asyncio.sleep(self.resolucion)
+            for clave in self.tic():
+                try:
+                    await self._al_caducar(clave)
+                except Exception:
+                    logging.exception(f"Error caducando {clave}")
+
+class ConfirmacionesRobo:
+    """Robos a la espera de que el negociador responda "Confirmo".
+
+    Se guardan en data["confirmaciones_robo"] por id del mensaje de
+    confirmación, así que on_message solo hace una búsqueda por id de la
+    respuesta y las pendientes sobreviven a un reinicio.
+    """
+
+    PLAZO = 3600.0
+
+    def __init__(self):
+        self.rueda = RuedaTemporizadores(30.0, 128, self._caducar)
+
+    def iniciar(self):
+        """Programa las pendientes guardadas y arranca la rueda"""
+        for clave, pendiente in data["confirmaciones_robo"].items():
+            self.rueda.programar(clave, pendiente["vence"])
+        self.rueda.iniciar()
+
+    async def detener(self):
+        await self.rueda.detener()
+
+    def registrar(self, confirm_msg, negociador, canal):
+        clave = str(confirm_msg.id)
+        vence = time.time() + self.PLAZO
+        data["confirmaciones_robo"][clave] = {
+            "negociador": negociador.id,
+            "canal": canal.id,
+            "vence": vence,
+        }
+        save_json("confirmaciones_robo", clave)
+        self.rueda.programar(clave, vence)
+
+    def _quitar(self, clave):
+        self.rueda.cancelar(clave)
+        pendiente = data["confirmaciones_robo"].pop(clave, None)
+        if pendiente is not None:
+            save_json("confirmaciones_robo", clave)
+        return pendiente
+
+    async def procesar(self, mensaje: discord.Message) -> bool:
+        """Llamado desde on_message. True si el mensaje confirmaba un robo"""
+        if mensaje.reference is None:
+            return False
+        clave = str(mensaje.reference.message_id)
+        pendiente = data["confirmaciones_robo"].get(clave)
+        if pendiente is None:
+            return False
+        if mensaje.author.id != pendiente["negociador"] or mensaje.content.lower().strip() != "confirmo":
+            return False
+        self._quitar(clave)
         # si confirma, ping al rol economía
-        guild = interaction.guild
-        rol = guild.get_role(ECONOMIA_ROLE_ID) if guild else None
+        guild = mensaje.guild
+        rol = guild.get_role(config_servidor(guild).ECONOMIA_ROLE_ID) if guild else None
         if rol:
-            await interaction.channel.send(f"{rol.mention} ✅ El negociador ha confirmado el robo. Procedan a entregar el dinero.")
+            await mensaje.channel.send(f"{rol.mention} ✅ El negociador ha confirmado el robo. Procedan a entregar el dinero.")
         else:
-            await interaction.channel.send("⚠️ No se encontró el rol Encargado Economía.")
-    except asyncio.TimeoutError:
-        await interaction.channel.send(f"❌ Tiempo de confirmación expirado. El negociador {negociador.mention} no respondió.")
+            await mensaje.channel.send("⚠️ No se encontró el rol Encargado Economía.")
+        return True
+
+    async def _caducar(self, clave):
+        pendiente = data["confirmaciones_robo"].get(clave)
+        if pendiente is None:
+            return
+        await bot.wait_until_ready()
+        canal = bot.get_channel(pendiente["canal"])
+        if canal is None and config.SHARD_IDS is not None:
+            return  # servidor de un shard de otro proceso: allí caduca
+        if self._quitar(clave) is None:
+            return
+        if canal:
+            await canal.send(f"❌ Tiempo de confirmación expirado. El negociador <@{pendiente['negociador']}> no respondió.")
+
+confirmaciones_robo = PorParticion(ConfirmacionesRobo, servicio=True)
 
 # Mantenimiento: encender/apagar (solo staff)
 @tree.command(name="mantenimiento", description="Activar/desactivar modo mantenimiento (SOLO STAFF)")
@@ -2009,9 +5571,210 @@ async def mantenimiento(interaction: Interaction, activar: app_commands.Choice[s
         await interaction.response.send_message("🚫 Solo staff.", ephemeral=True); return
     config = data.get("config", {})
     config["mantenimiento"] = True if activar.value == "SI" else False
-    data["config"] = config; save_json("config")
+    data["config"] = config; save_json("config", "mantenimiento")
     await interaction.response.send_message(f"🔧 Mantenimiento {'activado' if config['mantenimiento'] else 'desactivado'}.")
 
+# Guardado inmediato (solo staff): vacía las escrituras pendientes
+@tree.command(name="guardar-datos", description="Forzar el guardado de los datos pendientes (SOLO STAFF)")
+async def guardar_datos(interaction: Interaction):
+    if not es_staff(interaction.user):
+        await interaction.response.send_message("🚫 Solo staff.", ephemeral=True); return
+    pendientes = escritor.pendientes()
+    tiendas = await escritor.flush() if escritor.activo() else 0
+    await interaction.response.send_message(
+        f"💾 Datos guardados: {pendientes} registro(s) pendiente(s) en {tiendas} tienda(s).",
+        ephemeral=True
+    )
+
+@tree.command(name="notificaciones", description="Estado de la cola de MD (SOLO STAFF)")
+async def estado_notificaciones(interaction: Interaction):
+    if not es_staff(interaction.user):
+        await interaction.response.send_message("🚫 Solo staff.", ephemeral=True); return
+    e = notificaciones.estadisticas()
+    embed = discord.Embed(title="📬 Cola de Notificaciones", color=config.COLOR_INFO)
+    embed.add_field(name="📥 En cola", value=f"{e['en_cola']} (+{e['reintentos_programados']} en espera de reintento)", inline=False)
+    embed.add_field(name="✅ Enviadas", value=str(e["enviadas"]), inline=True)
+    embed.add_field(name="❌ Fallidas", value=str(e["fallidas"]), inline=True)
+    embed.add_field(name="🔁 Reintentos", value=f"{e['reintentos']} ({e['limitadas_429']} por 429)", inline=True)
+    embed.add_field(name="⏱️ Latencia", value=f"media {e['latencia_media_ms']:.0f} ms | máx {e['latencia_max_ms']:.0f} ms", inline=False)
+    embed.set_footer(text=config.FOOTER_ADMINISTRATIVO)
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+@tree.command(name="metricas", description="Latencia de los comandos (SOLO STAFF)")
+@app_commands.describe(comando="Ver el detalle de un comando (opcional)")
+async def ver_metricas(interaction: Interaction, comando: str = None):
+    if not es_staff(interaction.user):
+        await interaction.response.send_message("🚫 Solo staff.", ephemeral=True); return
+    embed = discord.Embed(title="⏱️ Métricas de Comandos", color=config.COLOR_INFO)
+    if comando is not None:
+        hist = metricas.comandos.get(comando.lstrip("/"))
+        if hist is None:
+            await interaction.response.send_message("❌ Ese comando no tiene mediciones todavía.", ephemeral=True); return
+        embed.description = f"`/{comando.lstrip('/')}` • {hist['total'].n} ejecuciones"
+        for fase, h in hist.items():
+            embed.add_field(
+                name=fase,
+                value=f"p50 {h.percentil(50):.0f} ms | p99 {h.percentil(99):.0f} ms | máx {h.maximo:.0f} ms",
+                inline=False
+            )
+        embed.add_field(name="⚠️ Fuera de plazo", value=str(metricas.fuera_de_plazo.get(comando.lstrip("/"), 0)), inline=True)
+        embed.add_field(name="❌ Errores", value=str(metricas.errores.get(comando.lstrip("/"), 0)), inline=True)
+        embed.add_field(name="⏳ Diferidos", value=str(metricas.diferidas.get(comando.lstrip("/"), 0)), inline=True)
+    else:
+        filas = metricas.resumen("plazo")
+        if not filas:
+            embed.description = "Sin mediciones todavía."
+        for nombre, h in filas[:15]:
+            embed.add_field(
+                name=f"/{nombre} ({h.n})",
+                value=(
+                    f"p50 {h.percentil(50):.0f} ms | p99 {h.percentil(99):.0f} ms | máx {h.maximo:.0f} ms\n"
+                    f"guardado p99 {metricas.comandos[nombre]['guardado'].percentil(99):.1f} ms • "
+                    f"fuera de plazo {metricas.fuera_de_plazo.get(nombre, 0)} • "
+                    f"diferidos {metricas.diferidas.get(nombre, 0)}"
+                ),
+                inline=False
+            )
+    embed.set_footer(text=f"{config.FOOTER_ADMINISTRATIVO} • Desde {metricas.desde:%d/%m %H:%M}")
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+@tree.command(name="bucle", description="Retraso del bucle de eventos y bloqueos recientes (SOLO STAFF)")
+async def ver_bucle(interaction: Interaction):
+    if not es_staff(interaction.user):
+        await interaction.response.send_message("🚫 Solo staff.", ephemeral=True); return
+    v = vigilante_bucle
+    embed = discord.Embed(title="🌀 Bucle de Eventos", color=config.COLOR_INFO)
+    embed.add_field(
+        name="⏱️ Retraso",
+        value=f"p50 {v.retraso.percentil(50):.1f} ms | p99 {v.retraso.percentil(99):.1f} ms | máx {v.retraso.maximo:.0f} ms",
+        inline=False
+    )
+    embed.add_field(name="🧱 Bloqueos", value=f"{v.total_bloqueos} (umbral {v.umbral * 1000:.0f} ms)", inline=True)
+    # Bloqueos por comando
+    por_comando = collections.Counter(b.comando or "(fuera de comandos)" for b in v.recientes)
+    if por_comando:
+        embed.add_field(
+            name="📋 Por comando (recientes)",
+            value="\n".join(f"`{c}`: {n}" for c, n in por_comando.most_common(5)),
+            inline=True
+        )
+    for b in list(v.recientes)[-5:][::-1]:
+        embed.add_field(
+            name=f"{datetime.datetime.fromtimestamp(b.inicio):%H:%M:%S} • {b.duracion_ms:.0f} ms",
+            value=f"Comando: `{b.comando or '-'}`\nFunción: `{b.funcion or '-'}`\n`{b.pila[-1] if b.pila else '-'}`",
+            inline=False
+        )
+    embed.set_footer(text=f"{config.FOOTER_ADMINISTRATIVO} • Pilas completas en {ARCHIVO_BUCLE_LENTO}")
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+@tree.command(name="perfilador-iniciar", description="Perfilar el bot durante N segundos (SOLO STAFF)")
+@app_commands.describe(
+    segundos="Duración del perfil",
+    intervalo_ms="Milisegundos entre muestras (más bajo = más detalle y más coste)",
+    comando="Quedarse solo con las muestras de este comando (opcional)"
+)
+async def perfilador_iniciar(interaction: Interaction, segundos: app_commands.Range[int, 1, 3600] = 60,
+                             intervalo_ms: app_commands.Range[int, 1, 1000] = 10, comando: str = None):
+    if not es_staff(interaction.user):
+        await interaction.response.send_message("🚫 Solo staff.", ephemeral=True); return
+    if perfilador.activo:
+        await interaction.response.send_message("⚠️ Ya hay un perfil en marcha. Usa `/perfilador-detener`.", ephemeral=True); return
+    comando = comando.lstrip("/") if comando else None
+    if comando and comando not in codigos_comando.values():
+        await interaction.response.send_message("❌ Comando desconocido.", ephemeral=True); return
+    segundos = min(segundos, config.PERFIL_MAX_SEGUNDOS)
+    tarea = perfilador.iniciar(segundos, intervalo_ms, comando)
+    await interaction.response.send_message(
+        f"🔬 Perfilando {segundos}s (una muestra cada {intervalo_ms} ms"
+        + (f", solo `/{comando}`" if comando else "") + "). El resumen llegará aquí al terminar.",
+        ephemeral=True
+    )
+
+    async def enviar_resumen():
+        resumen = await tarea
+        # El token de la interacción dura 15 min: más allá, el resumen queda en /perfilador-detener
+        with contextlib.suppress(discord.HTTPException):
+            await interaction.followup.send(embed=embed_perfil(resumen), ephemeral=True)
+    # Fuera del handler, para no contar la espera como latencia del comando
+    asyncio.create_task(enviar_resumen())
+
+@tree.command(name="perfilador-detener", description="Parar el perfil en curso y ver el resumen (SOLO STAFF)")
+async def perfilador_detener(interaction: Interaction):
+    if not es_staff(interaction.user):
+        await interaction.response.send_message("🚫 Solo staff.", ephemeral=True); return
+    if not perfilador.activo and perfilador.ultimo is None:
+        await interaction.response.send_message("ℹ️ No hay ningún perfil.", ephemeral=True); return
+    await interaction.response.defer(ephemeral=True)
+    perfilador.detener()
+    while perfilador.activo:
+        await asyncio.sleep(0.05)
+    await interaction.followup.send(embed=embed_perfil(perfilador.ultimo), ephemeral=True)
+
+@tree.command(name="config-servidor", description="Recargar y ver la configuración y la partición de este servidor (SOLO STAFF)")
+async def ver_config_servidor(interaction: Interaction):
+    if not es_staff(interaction.user):
+        await interaction.response.send_message("🚫 Solo staff.", ephemeral=True); return
+    # Releer data/config/servidores/<id>.json y recalcular los permisos
+    _configs_servidor.pop(interaction.guild_id, None)
+    ajustes = config_servidor(interaction.guild_id)
+    if interaction.guild_id is not None:
+        invalidar_capacidades(interaction.guild_id)
+    particion = particion_actual()
+    embed = discord.Embed(title="🏛️ Configuración del Servidor", color=config.COLOR_INFO)
+    embed.add_field(
+        name="🆔 Roles y canales",
+        value="\n".join(f"`{clave}`: {getattr(ajustes, clave)}" for clave in ConfigServidor.IDS),
+        inline=False
+    )
+    embed.add_field(name="💼 Sueldos", value=f"{len(ajustes.SUELDOS_ROLES)} roles • {ajustes.SUELDO_POR_DEFECTO}€ por defecto", inline=False)
+    embed.add_field(name="🗂️ Partición", value=f"{particion} (`{particion.dir}`)", inline=False)
+    embed.add_field(name="📦 Tiendas cargadas", value=f"{len(particion.informe_carga)}/{len(particion.files)}", inline=True)
+    embed.add_field(name="💾 Pendientes de guardar", value=str(particion.escritor.pendientes()), inline=True)
+    shard = interaction.guild.shard_id if interaction.guild else 0
+    estado = ""
+    if particion.compartida:
+        estado = f"\nServicio de estado: {'🟢 conectado' if cliente_estado.conectado() else '🔴 sin conexión'} • {cliente_estado.cambios_recibidos} cambios recibidos"
+    embed.add_field(name="🧩 Shard", value=f"{shard} de {bot.shard_count} • proceso `{config.PROCESO}`{estado}", inline=False)
+    embed.set_footer(text=f"{config.FOOTER_ADMINISTRATIVO} • {os.path.join(DIR_CONFIG_SERVIDORES, f'{interaction.guild_id}.json')}")
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+@tree.command(name="copias", description="Ver y crear copias de seguridad (SOLO STAFF)")
+@app_commands.describe(crear="Crear una copia ahora")
+async def copias(interaction: Interaction, crear: bool = False):
+    if not es_staff(interaction.user):
+        await interaction.response.send_message("🚫 Solo staff.", ephemeral=True); return
+    await interaction.response.defer(ephemeral=True)
+    if crear:
+        await servicio_copias.copiar()
+    ids = servicio_copias.listar()
+    embed = discord.Embed(title="🗄️ Copias de Seguridad", color=config.COLOR_INFO)
+    if not ids:
+        embed.description = "No hay copias todavía."
+    else:
+        embed.description = "\n".join(f"`{i}`" for i in reversed(ids[-15:]))
+        embed.add_field(name="📦 Total", value=str(len(ids)), inline=True)
+        embed.add_field(name="💡 Restaurar", value="`/copia-restaurar copia:<id>`", inline=True)
+    embed.set_footer(text=config.FOOTER_ADMINISTRATIVO)
+    await interaction.followup.send(embed=embed, ephemeral=True)
+
+@tree.command(name="copia-restaurar", description="Restaurar los datos desde una copia de seguridad (SOLO STAFF)")
+@app_commands.describe(copia="Id de la copia (ver /copias)", tienda="Restaurar solo esta tienda (opcional)")
+async def copia_restaurar(interaction: Interaction, copia: str, tienda: str = None):
+    if not es_staff(interaction.user):
+        await interaction.response.send_message("🚫 Solo staff.", ephemeral=True); return
+    if copia not in servicio_copias.listar():
+        await interaction.response.send_message("❌ Copia no encontrada. Usa `/copias` para verlas.", ephemeral=True); return
+    if tienda is not None and tienda not in FILES:
+        await interaction.response.send_message(f"❌ Tienda desconocida. Opciones: {', '.join(FILES)}", ephemeral=True); return
+    await interaction.response.defer(ephemeral=True)
+    # Copia del estado actual antes de pisarlo, por si hay que deshacer
+    previa, _ = await servicio_copias.copiar()
+    restauradas = await servicio_copias.restaurar(copia, [tienda] if tienda else None)
+    await interaction.followup.send(
+        f"♻️ Restauradas {len(restauradas)} tienda(s) desde `{copia}`. Estado anterior guardado en `{previa}`.",
+        ephemeral=True
+    )
+
 # ----------------------
 # --- COMANDOS DE DNI ---
 # ----------------------
@@ -2051,10 +5814,11 @@ async def solicitar_dni(
         await interaction.response.send_message("La foto debe ser en formato PNG.", ephemeral=True)
         return
 
-    canal_revision = interaction.guild.get_channel(1415316625397387318)
+    ajustes = config_servidor(interaction.guild_id)
+    canal_revision = interaction.guild.get_channel(ajustes.CANAL_REVISION_DNI)
 
     # Hacer ping al rol de revisión
-    await canal_revision.send("<@&1416126180888674374>")
+    await canal_revision.send(f"<@&{ajustes.ROL_REVISION_DNI}>")
 
     # Crear embed de solicitud
     embed_solicitud = Embed(title="🪪 Solicitud de DNI", color=discord.Color.blue())
@@ -2066,50 +5830,109 @@ async def solicitar_dni(
     embed_solicitud.add_field(name="Nacionalidad", value=nacionalidad, inline=True)
     embed_solicitud.set_image(url=foto.url)
 
-    # Crear botones de aceptación y rechazo
-    view = View()
-    view.add_item(Button(label="Aceptar", style=discord.ButtonStyle.green, custom_id="aceptar"))
-    view.add_item(Button(label="Rechazar", style=discord.ButtonStyle.red, custom_id="rechazar"))
+    # Guardar la solicitud pendiente: los botones llevan su id en el custom_id
+    # y se resuelven aunque el bot se reinicie entre medias
+    id_solicitud = nuevo_id_solicitud()
+    data["solicitudes_dni"][id_solicitud] = {
+        "usuario": usuario.id,
+        "nombre": nombre,
+        "apellidos": apellidos,
+        "edad": edad,
+        "sexo": sexo.value,
+        "nacimiento": nacimiento,
+        "nacionalidad": nacionalidad,
+        "foto": foto.url,
+        "solicitante": interaction.user.id,
+        "fecha": datetime.datetime.now().isoformat(timespec="seconds"),
+    }
+    save_json("solicitudes_dni", id_solicitud)
+
+    view = View(timeout=None)
+    view.add_item(BotonSolicitudDNI(id_solicitud, "aceptar"))
+    view.add_item(BotonSolicitudDNI(id_solicitud, "rechazar"))
 
     # Enviar embed con botones
-    mensaje_revision = await canal_revision.send(embed=embed_solicitud, view=view)
-
-    # Función para esperar la interacción del botón
-    def check(inter):
-        return inter.message.id == mensaje_revision.id
+    await canal_revision.send(embed=embed_solicitud, view=view)
 
     await interaction.response.send_message("Solicitud de DNI enviada para revisión.", ephemeral=True)
 
-    # Esperar a que alguien presione un botón
-    interaction_revision = await interaction.client.wait_for("interaction", check=check)
+def nuevo_id_solicitud() -> str:
+    return f"{time.time_ns():x}"
+
+class BotonSolicitudDNI(discord.ui.DynamicItem[Button], template=r"dni:(?P<accion>aceptar|rechazar):(?P<id>[0-9a-f]+)"):
+    """Botón persistente de revisión de DNI (custom_id = dni:<accion>:<id>)"""
+
+    def __init__(self, id_solicitud: str, accion: str):
+        aceptar = accion == "aceptar"
+        super().__init__(Button(
+            label="Aceptar" if aceptar else "Rechazar",
+            style=discord.ButtonStyle.green if aceptar else discord.ButtonStyle.red,
+            custom_id=f"dni:{accion}:{id_solicitud}"
+        ))
+        self.id_solicitud = id_solicitud
+        self.accion = accion
+
+    @classmethod
+    async def from_custom_id(cls, interaction: Interaction, item: Button, match):
+        return cls(match["id"], match["accion"])
+
+    async def callback(self, interaction: Interaction):
+        solicitud = data["solicitudes_dni"].get(self.id_solicitud)
+        if solicitud is None:
+            await interaction.response.send_message("⚠️ Esta solicitud ya fue resuelta.", ephemeral=True)
+            return
+        if self.accion == "aceptar":
+            aprobar_solicitud_dni(self.id_solicitud, solicitud)
+            await interaction.response.send_message("✅ Solicitud de DNI aprobada.", ephemeral=True)
+        else:
+            await interaction.response.send_modal(ModalRechazoDNI(self.id_solicitud))
+
+def aprobar_solicitud_dni(id_solicitud: str, solicitud: dict):
+    uid = str(solicitud["usuario"])
+    dni = generar_dni()
+    data["dnis"][uid] = {
+        "nombre": solicitud["nombre"],
+        "apellidos": solicitud["apellidos"],
+        "fecha": solicitud["nacimiento"],
+        "sexo": solicitud["sexo"],
+        "dni": dni,
+    }
+    save_json("dnis", uid)
+    del data["solicitudes_dni"][id_solicitud]
+    save_json("solicitudes_dni", id_solicitud)
+
+    embed_aprobacion = Embed(
+        title="✅ | Solicitud de DNI ha sido aprobada",
+        description="Tu solicitud de DNI ha sido aprobada, hecha un vistazo a estos detalles importantes:",
+        color=discord.Color.green()
+    )
+    embed_aprobacion.add_field(name="Número de DNI", value=dni, inline=True)
+    embed_aprobacion.add_field(name="Fecha de emisión", value=datetime.date.today().strftime("%d/%m/%Y"), inline=True)
+    embed_aprobacion.add_field(name="Fecha de caducidad", value=(datetime.date.today() + datetime.timedelta(days=3650)).strftime("%d/%m/%Y"), inline=True)
+    embed_aprobacion.add_field(name="Información adicional", value="Puedes ver tu DNI con el comando `/ver-dni`", inline=False)
+
+    notificaciones.encolar(uid, embed=embed_aprobacion)
 
-    # Procesar la acción de aceptar o rechazar
-    if interaction_revision.data["custom_id"] == "aceptar":
-        dni = generar_dni()
-        embed_aprobacion = Embed(
-            title="✅ | Solicitud de DNI ha sido aprobada",
-            description="Tu solicitud de DNI ha sido aprobada, hecha un vistazo a estos detalles importantes:",
-            color=discord.Color.green()
-        )
-        embed_aprobacion.add_field(name="Número de DNI", value=dni, inline=True)
-        embed_aprobacion.add_field(name="Fecha de emisión", value=datetime.date.today().strftime("%d/%m/%Y"), inline=True)
-        embed_aprobacion.add_field(name="Fecha de caducidad", value=(datetime.date.today() + datetime.timedelta(days=3650)).strftime("%d/%m/%Y"), inline=True)
-        embed_aprobacion.add_field(name="Información adicional", value="Puedes ver tu DNI con el comando `/ver-dni`", inline=False)
+class ModalRechazoDNI(Modal, title="Motivo de rechazo"):
+    motivo = TextInput(label="Motivo de rechazo", placeholder="Ingrese el motivo de rechazo")
 
-        await usuario.send(embed=embed_aprobacion)
+    def __init__(self, id_solicitud: str):
+        super().__init__()
+        self.id_solicitud = id_solicitud
 
-    elif interaction_revision.data["custom_id"] == "rechazar":
-        modal = Modal(title="Motivo de rechazo")
-        modal.add_item(TextInput(label="Motivo de rechazo", placeholder="Ingrese el motivo de rechazo"))
-        await interaction_revision.response.send_modal(modal)
-        await modal.wait()
-        motivo_rechazo = modal.children[0].value
+    async def on_submit(self, interaction: Interaction):
+        # Otro revisor pudo resolverla mientras se escribía el motivo
+        solicitud = data["solicitudes_dni"].pop(self.id_solicitud, None)
+        if solicitud is None:
+            await interaction.response.send_message("⚠️ Esta solicitud ya fue resuelta.", ephemeral=True)
+            return
+        save_json("solicitudes_dni", self.id_solicitud)
 
-        motivo_rechazo = modal.children[0].value
         embed_denegacion = Embed(title="❌ | Tu solicitud de DNI a sido denegada", color=discord.Color.red())
-        embed_denegacion.add_field(name="Motivo", value=motivo_rechazo, inline=True)
+        embed_denegacion.add_field(name="Motivo", value=self.motivo.value, inline=True)
 
-        await usuario.send(embed=embed_denegacion)
+        notificaciones.encolar(solicitud["usuario"], embed=embed_denegacion)
+        await interaction.response.send_message("❌ Solicitud de DNI rechazada.", ephemeral=True)
 
 
 @tree.command(name="ver-dni", description="Ver el DNI de un usuario")
@@ -2150,10 +5973,10 @@ async def eliminar_dni(interaction: Interaction, usuario: discord.Member):
     # También eliminar carnet si tiene
     if uid in data["carnets"]:
         del data["carnets"][uid]
-        save_json("carnets")
+        save_json("carnets", uid)
     
     del data["dnis"][uid]
-    save_json("dnis")
+    save_json("dnis", uid)
     
     await interaction.response.send_message(f"✅ DNI (y carnet si existía) eliminado de {usuario.mention}")
 
@@ -2197,7 +6020,7 @@ async def crear_carnet(interaction: Interaction, usuario: discord.Member, tipo:
         "fecha_expedicion": fecha_expedicion,
         "valido": True
     }
-    save_json("carnets")
+    save_json("carnets", uid)
     
     embed = Embed(title="🚗 Licencia de Conducir Expedida", color=discord.Color.green())
     embed.set_thumbnail(url=usuario.display_avatar.url)
@@ -2250,7 +6073,7 @@ async def eliminar_carnet(interaction: Interaction, usuario: discord.Member):
         return
     
     del data["carnets"][uid]
-    save_json("carnets")
+    save_json("carnets", uid)
     
     await interaction.response.send_message(f"✅ Licencia de conducir eliminada de {usuario.mention}")
 
@@ -2298,7 +6121,7 @@ class ModalRechazo(Modal, title="❌ Rechazar Solicitud"):
         self.usuario = usuario
 
     async def on_submit(self, interaction: discord.Interaction):
-        canal_solicitudes = interaction.guild.get_channel(config.CANAL_SOLICITUDES)
+        canal_solicitudes = interaction.guild.get_channel(config_servidor(interaction.guild).CANAL_SOLICITUDES)
 
         # Mensaje público en el canal de solicitudes
         if canal_solicitudes:
@@ -2307,12 +6130,10 @@ class ModalRechazo(Modal, title="❌ Rechazar Solicitud"):
             )
 
         # Mensaje privado al usuario
-        try:
-            await self.usuario.send(
-                f"🚫 Tu solicitud de verificación fue rechazada.\n**Motivo:** {self.motivo.value}"
-            )
-        except discord.Forbidden:
-            pass
+        notificaciones.encolar(
+            self.usuario,
+            f"🚫 Tu solicitud de verificación fue rechazada.\n**Motivo:** {self.motivo.value}"
+        )
 
         await interaction.response.send_message(
             f"Has rechazado la solicitud de {self.usuario.mention} con el motivo:\n**{self.motivo.value}**",
@@ -2327,19 +6148,17 @@ class VerificarRechazar(View):
 
     @discord.ui.button(label="✅ Verificar", style=discord.ButtonStyle.green)
     async def verificar(self, interaction: discord.Interaction, button: Button):
-        rol = interaction.guild.get_role(config.ROL_VERIFICADO)
+        rol = interaction.guild.get_role(config_servidor(interaction.guild).ROL_VERIFICADO)
         if rol:
             await self.usuario.add_roles(rol, reason="Solicitud de verificación aceptada")
             await interaction.response.send_message(
                 f"✅ {self.usuario.mention} ha sido verificado correctamente.",
                 ephemeral=False
             )
-            try:
-                await self.usuario.send(
-                    "🎉 ¡Felicidades! Tu solicitud de verificación ha sido aceptada y ya tienes acceso al servidor."
-                )
-            except discord.Forbidden:
-                pass
+            notificaciones.encolar(
+                self.usuario,
+                "🎉 ¡Felicidades! Tu solicitud de verificación ha sido aceptada y ya tienes acceso al servidor."
+            )
         else:
             await interaction.response.send_message(
                 "⚠️ No se encontró el rol de verificado. Revisa la configuración.",
@@ -2357,14 +6176,20 @@ async def on_message(mensaje: discord.Message):
     if mensaje.author.bot:
         return
 
-    if mensaje.channel.id == config.CANAL_VERIFICACIONES:
-        canal_solicitudes = bot.get_channel(config.CANAL_SOLICITUDES)
-        if canal_solicitudes:
-            embed = embed_solicitud_verificacion(mensaje)
-            await canal_solicitudes.send(embed=embed, view=VerificarRechazar(mensaje.author))
-        await mensaje.delete()  # Borra el mensaje original para mantener limpio
+    with en_servidor(mensaje.guild.id if mensaje.guild else None):
+        # Respuesta "Confirmo" a un /reclamar-robo pendiente
+        if await confirmaciones_robo.procesar(mensaje):
+            return
+
+        ajustes = config_servidor(mensaje.guild)
+        if mensaje.channel.id == ajustes.CANAL_VERIFICACIONES:
+            canal_solicitudes = bot.get_channel(ajustes.CANAL_SOLICITUDES)
+            if canal_solicitudes:
+                embed = embed_solicitud_verificacion(mensaje)
+                await canal_solicitudes.send(embed=embed, view=VerificarRechazar(mensaje.author))
+            await mensaje.delete()  # Borra el mensaje original para mantener limpio
 
-    await bot.process_commands(mensaje)
+        await bot.process_commands(mensaje)
 
 # =====================
 # SISTEMA DE ALERTAS VALENCIA RP  
@@ -2490,7 +6315,8 @@ async def alerta(interaction: Interaction, nivel: app_commands.Choice[str]):
     embed_alerta.timestamp = discord.utils.utcnow()
     
     # Guardar alerta en el sistema
-    if "alertas" not in data:
+    # Recién creada la tienda es {}: la lista empieza con el primer registro
+    if not data.get("alertas"):
         data["alertas"] = []
     
     nueva_alerta = {
@@ -2523,7 +6349,39 @@ async def alerta(interaction: Interaction, nivel: app_commands.Choice[str]):
 # ----------------------
 # --- FIN: INICIO DEL BOT ---
 # ----------------------
-if not config.TOKEN:
+if len(sys.argv) > 1 and sys.argv[1] in ("importar-json", "exportar-json"):
+    # Migración de almacenamiento: python main.py importar-json | exportar-json
+    if sys.argv[1] == "importar-json":
+        importar_json_a_sqlite()
+    else:
+        exportar_sqlite_a_json()
+    print(f"✅ Migración '{sys.argv[1]}' completada ({len(particiones.todas())} particiones)")
+elif len(sys.argv) > 1 and sys.argv[1] == "migrar-multas":
+    # Migración única al formato normalizado de multas (todas las particiones)
+    for particion in particiones.en_disco():
+        with usar_particion(particion):
+            migradas = migrar_multas()
+        print(f"✅ {migradas} multas de la {particion} migradas al código penal versionado")
+elif len(sys.argv) > 1 and sys.argv[1] == "restaurar-copia":
+    # python main.py restaurar-copia [id_servidor] [id]  (sin id: lista las copias)
+    argumentos = sys.argv[2:]
+    particion = particiones.principal()
+    if argumentos and argumentos[0].isdigit():
+        particion = particiones.abrir(int(argumentos.pop(0)))
+    if not argumentos:
+        for id_copia in listar_copias(particion):
+            print(id_copia)
+    else:
+        tiendas = restaurar_copia_sin_bot(argumentos[0], particion)
+        print(f"✅ Restauradas {len(tiendas)} tiendas de la {particion} desde la copia {argumentos[0]}")
+elif len(sys.argv) > 1 and sys.argv[1] == "servicio-estado":
+    # Bloqueos y avisos de cambios para los procesos de shards (ALMACENAMIENTO=compartido)
+    logging.basicConfig(level=logging.INFO)
+    try:
+        asyncio.run(servicio_estado.servir())
+    except KeyboardInterrupt:
+        print(f"🛑 Servicio de estado detenido: {servicio_estado.estadisticas()}")
+elif not config.TOKEN:
     print("❌ TOKEN no encontrado en variables de entorno (Secrets).")
     print("Por favor, configura la variable DISCORD_TOKEN en Replit Secrets.")
 else:
@@ -0,0 +1,31 @@
+"""Entorno de pruebas: main.py se importa una vez, sin token y con data/ en
+una carpeta temporal, como lo hace banco_carga.py"""
+import os, sys, tempfile, types
+
+import pytest
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+
+os.chdir(tempfile.mkdtemp(prefix="pruebas_rp_"))
+os.environ.pop("DISCORD_TOKEN", None)
+os.environ.setdefault("MULTISERVIDOR", "1")
+os.environ.setdefault("SERVIDOR_PRINCIPAL", "111")
+os.environ.setdefault("METRICAS_PUERTO", "0")
+os.environ.setdefault("VIGILANTE_INTERVALO", "0")
+# keep_alive (el servidor web de Replit) no va en el repositorio y en las
+# pruebas no debe arrancar nada
+sys.modules.setdefault("keep_alive", types.SimpleNamespace(keep_alive=lambda: None))
+
+import main as rp  # noqa: E402
+
+
+@pytest.fixture
+def particion(tmp_path):
+    """Partición nueva en una carpeta temporal (servidor 999)"""
+    return rp.Particion(999, str(tmp_path))
+
+
+def reabrir(particion):
+    """La misma carpeta vista por un proceso recién arrancado"""
+    return rp.Particion(particion.servidor, particion.dir)
@@ -0,0 +1,37 @@
+"""Copias de seguridad incrementales"""
+import main as rp
+
+
+def test_copia_sqlite_solo_recomprime_las_tablas_escritas(tmp_path, monkeypatch):
+    monkeypatch.setattr(rp.config, "ALMACENAMIENTO", "sqlite")
+    particion = rp.Particion(999, str(tmp_path))
+    cuentas = particion.almacenes["cuentas"].cargar()
+    multas = particion.almacenes["multas"].cargar()
+    cuentas["1"] = rp.tipar_registro("cuentas", {"tarjeta": 1, "efectivo": 0})
+    multas["1"] = rp.tipar_tienda("multas", {"1": []})["1"]
+    cuentas.guardar(None, ["1"])
+    multas.guardar(None, ["1"])
+
+    rp.crear_copia(particion, "20260101-000000")
+    cuentas["1"].tarjeta = 2
+    cuentas.guardar(None, ["1"])
+    manifiesto = rp.crear_copia(particion, "20260101-010000")
+
+    assert manifiesto["tiendas"]["multas"]["enlazada"] is True
+    assert manifiesto["tiendas"]["cuentas"]["enlazada"] is False
+    assert rp.leer_tienda_de_copia(particion, "20260101-010000", "cuentas")["1"]["tarjeta"] == 2
+
+
+def test_copia_sqlite_vuelca_la_tabla_fila_a_fila(tmp_path, monkeypatch):
+    monkeypatch.setattr(rp.config, "ALMACENAMIENTO", "sqlite")
+    particion = rp.Particion(999, str(tmp_path))
+    cuentas = particion.almacenes["cuentas"].cargar()
+    for uid in ("1", "2", 'raro"ñ'):
+        cuentas[uid] = rp.tipar_registro("cuentas", {"tarjeta": 7, "efectivo": 1, "banco": "Caixa ñ"})
+    cuentas.guardar(None, None)
+
+    manifiesto = rp.crear_copia(particion, "20260101-000000")
+    copia = rp.leer_tienda_de_copia(particion, "20260101-000000", "cuentas")
+    assert manifiesto["tiendas"]["cuentas"]["registros"] == 3
+    assert copia == {uid: cuentas[uid].a_dict() for uid in ("1", "2", 'raro"ñ')}
+    assert rp.leer_tienda_de_copia(particion, "20260101-000000", "prestamos") == {}
@@ -0,0 +1,130 @@
+"""Reproducción del diario (WAL) de las tiendas JSON y caídas a medias"""
+import json, os
+
+import main as rp
+from conftest import reabrir
+
+
+def cargar(particion, key="cuentas"):
+    return reabrir(particion).almacenes[key].cargar()
+
+
+def test_diario_se_reproduce_sobre_la_instantanea(particion):
+    almacen = particion.almacenes["cuentas"]
+    almacen.compactar({"1": {"tarjeta": 10}, "2": {"tarjeta": 20}})
+    valor = {"1": {"tarjeta": 15}, "3": {"tarjeta": 30}}
+    almacen.guardar(valor, ["1", "2", "3"])
+
+    assert os.path.exists(almacen.path_diario)
+    assert cargar(particion) == valor
+
+
+def test_lote_confirmado_cuenta_entero(particion):
+    cuentas, multas = particion.almacenes["cuentas"], particion.almacenes["multas"]
+    tx = rp.nuevo_id_transaccion()
+    rp.escribir_lote(particion, tx, [
+        (cuentas, cuentas.preparar({"1": {"tarjeta": 5}}, ["1"], tx)),
+        (multas, multas.preparar({"1": [{"importe": 5}]}, ["1"], tx)),
+    ])
+
+    assert cargar(particion, "cuentas") == {"1": {"tarjeta": 5}}
+    assert cargar(particion, "multas") == {"1": [{"importe": 5}]}
+
+
+def test_lote_sin_confirmar_se_descarta_entero(particion):
+    """Caída tras escribir los diarios y antes de transacciones.log"""
+    cuentas, multas = particion.almacenes["cuentas"], particion.almacenes["multas"]
+    cuentas.compactar({"1": {"tarjeta": 100}})
+    tx = rp.nuevo_id_transaccion()
+    cuentas.escribir_diario(cuentas.preparar({"1": {"tarjeta": 0}}, ["1"], tx)[0])
+    multas.escribir_diario(multas.preparar({"1": [{"importe": 100}]}, ["1"], tx)[0])
+
+    assert cargar(particion, "cuentas") == {"1": {"tarjeta": 100}}
+    assert cargar(particion, "multas") == {}
+
+
+def test_linea_a_medio_escribir_se_descarta(particion):
+    almacen = particion.almacenes["cuentas"]
+    almacen.guardar({"1": {"tarjeta": 1}}, ["1"])
+    with open(almacen.path_diario, "a", encoding="utf-8") as f:
+        f.write('{"k": "1", "v": {"tarj')
+
+    assert cargar(particion) == {"1": {"tarjeta": 1}}
+
+
+def test_instantanea_que_no_cuadra_va_a_cuarentena(particion):
+    particion.almacenes["cuentas"].compactar({"1": {"tarjeta": 1}})
+    with open(particion.files["cuentas"], "w", encoding="utf-8") as f:
+        json.dump({"1": {"tarjeta": 10**9}}, f)
+
+    nueva = reabrir(particion)
+    valor, estado = rp.leer_tienda(nueva, "cuentas")
+    assert (valor, estado) == ({}, "cuarentena")
+    assert os.listdir(nueva.dir_cuarentena)
+
+
+def test_caida_al_compactar_no_reaplica_el_diario_viejo(particion, monkeypatch):
+    """Caída entre sustituir la instantánea y borrar el diario"""
+    almacen = particion.almacenes["cuentas"]
+    almacen.compactar({"1": {"tarjeta": 1}, "2": {"tarjeta": 2}})
+    almacen.guardar({"1": {"tarjeta": 5}, "2": {"tarjeta": 2}}, ["1", "2"])
+    # Cambios que solo llegan a disco con la instantánea nueva
+    valor = {"1": {"tarjeta": 9}}
+
+    def caida(path):
+        raise SystemExit("caída")
+    monkeypatch.setattr(rp.os, "remove", caida)
+    try:
+        almacen.compactar(valor)
+    except SystemExit:
+        pass
+    monkeypatch.undo()
+    assert os.path.exists(almacen.path_diario)
+
+    assert cargar(particion) == valor
+    # El diario viejo se borra y lo siguiente se anota sobre la instantánea nueva
+    assert not os.path.exists(almacen.path_diario)
+    nueva = reabrir(particion).almacenes["cuentas"]
+    nueva.cargar()
+    nueva.guardar({"1": {"tarjeta": 9}, "3": {"tarjeta": 3}}, ["3"])
+    assert cargar(particion) == {"1": {"tarjeta": 9}, "3": {"tarjeta": 3}}
+
+
+def test_diario_sin_base_se_sigue_reproduciendo(particion):
+    """Diarios escritos antes de que llevaran la línea base"""
+    almacen = particion.almacenes["cuentas"]
+    almacen.compactar({"1": {"tarjeta": 1}})
+    with open(almacen.path_diario, "w", encoding="utf-8") as f:
+        f.write('{"k": "1", "v": {"tarjeta": 2}}\n')
+
+    assert cargar(particion) == {"1": {"tarjeta": 2}}
+
+
+def test_transacciones_log_se_poda_al_compactar(tmp_path, monkeypatch):
+    monkeypatch.setattr(rp, "DIARIO_MAX_ENTRADAS", 5)
+    monkeypatch.setattr(rp, "PODA_TRANSACCIONES", 10)
+    particion = rp.Particion(999, str(tmp_path))
+    cuentas, multas, sanciones = (particion.almacenes[k] for k in ("cuentas", "multas", "sanciones"))
+    valor_c, valor_m = {}, {}
+
+    def lote(*partes):
+        tx = rp.nuevo_id_transaccion()
+        rp.escribir_lote(particion, tx, [(a, a.preparar(v, [uid], tx)) for a, v, uid in partes])
+        return tx
+
+    # Un lote en una tienda que no se vuelve a tocar: su diario no se compacta
+    viejo = lote((sanciones, {"9": [{"motivo": "x"}]}, "9"))
+    for i in range(300):
+        valor_c[str(i % 7)] = {"tarjeta": i}
+        valor_m[str(i % 3)] = [{"importe": i}]
+        lote((cuentas, valor_c, str(i % 7)), (multas, valor_m, str(i % 3)))
+
+    with open(particion.archivo_transacciones, encoding="utf-8") as f:
+        lineas = f.read().split()
+    assert len(lineas) < 40
+    assert viejo in lineas
+    assert len(particion.transacciones_confirmadas()) < 40
+
+    assert cargar(particion, "cuentas") == valor_c
+    assert cargar(particion, "multas") == valor_m
+    assert cargar(particion, "sanciones") == {"9": [{"motivo": "x"}]}
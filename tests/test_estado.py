@@ -0,0 +1,54 @@
+"""Servicio de estado: bloqueos de un proceso que se desconecta"""
+import asyncio, json
+
+import main as rp
+
+SERVIDOR = 4343
+
+
+async def conectar(puerto):
+    reader, writer = await asyncio.open_connection("127.0.0.1", puerto)
+
+    async def recibir():
+        return json.loads(await asyncio.wait_for(reader.readline(), 1))
+
+    def enviar(mensaje):
+        writer.write(rp._linea_estado(mensaje))
+
+    return recibir, enviar, writer
+
+
+def test_desconexion_invalida_antes_de_ceder_los_bloqueos():
+    async def probar():
+        servicio = rp.ServicioEstado("127.0.0.1", 0)
+        await servicio.iniciar()
+        puerto = servicio._servidor.sockets[0].getsockname()[1]
+        try:
+            recibir_a, enviar_a, writer_a = await conectar(puerto)
+            recibir_b, enviar_b, _ = await conectar(puerto)
+            enviar_a({"op": "bloquear", "id": 1, "claves": ["555:7", "555:8"]})
+            assert await recibir_a() == {"op": "concedido", "id": 1}
+            enviar_b({"op": "bloquear", "id": 1, "claves": ["555:7"]})
+            await asyncio.sleep(0.05)
+            writer_a.close()  # muere sin "liberar" ni publicar lo escrito
+            return [await recibir_b(), await recibir_b()]
+        finally:
+            await servicio.detener()
+    assert asyncio.run(probar()) == [
+        {"op": "cambios", "cambios": [["555", None, "7"], ["555", None, "8"]]},
+        {"op": "concedido", "id": 1},
+    ]
+
+
+def test_cambio_sin_tienda_olvida_el_uid_en_todas(tmp_path, monkeypatch):
+    monkeypatch.setattr(rp.config, "ALMACENAMIENTO", "sqlite")
+    particion = rp.Particion(SERVIDOR, str(tmp_path))
+    monkeypatch.setitem(rp.particiones._servidores, SERVIDOR, particion)
+    cuentas = particion.almacenes["cuentas"].cargar()
+    for uid in ("5", "6"):
+        cuentas[uid] = rp.tipar_registro("cuentas", {"tarjeta": 10, "efectivo": 0})
+    cuentas.guardar(None, None)
+    assert set(cuentas._cache) == {"5", "6"}
+
+    rp.cliente_estado._aplicar([[particion.nombre, None, "5"]])
+    assert set(cuentas._cache) == {"6"}
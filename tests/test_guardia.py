@@ -0,0 +1,112 @@
+"""Guardia de respuesta: defer automático y redirección a followup"""
+import asyncio, types
+
+import discord
+import pytest
+
+import main as rp
+
+
+class Registro(list):
+    def anotar(self, *evento):
+        self.append(evento)
+
+
+@pytest.fixture
+def registro(monkeypatch):
+    """Sustituye las llamadas HTTP de InteractionResponse por anotaciones"""
+    registro = Registro()
+
+    async def send_message(self, content=None, **kwargs):
+        if self.is_done():
+            raise discord.InteractionResponded(self._parent)
+        self._response_type = discord.InteractionResponseType.channel_message
+        registro.anotar("send_message", content, kwargs.get("ephemeral", False))
+
+    async def defer(self, **kwargs):
+        if self.is_done():
+            raise discord.InteractionResponded(self._parent)
+        await asyncio.sleep(0)
+        self._response_type = discord.InteractionResponseType.deferred_channel_message
+        registro.anotar("defer", kwargs.get("ephemeral", False))
+
+    monkeypatch.setattr(rp, "_send_message_original", rp._marcar_respuesta(send_message))
+    monkeypatch.setattr(rp, "_defer_original", rp._marcar_respuesta(defer))
+    return registro
+
+
+def interaccion(registro, medida=True):
+    class Mensaje:
+        async def delete(self, *, delay=None):
+            registro.anotar("borrar_followup", delay)
+
+    async def enviar(content=None, **kwargs):
+        registro.anotar("followup", content, kwargs.get("ephemeral", False))
+        return Mensaje()
+
+    async def borrar_original():
+        registro.anotar("borrar_original")
+
+    inter = types.SimpleNamespace(
+        extras={}, created_at=discord.utils.utcnow(),
+        followup=types.SimpleNamespace(send=enviar),
+        delete_original_response=borrar_original,
+    )
+    respuesta = discord.InteractionResponse.__new__(discord.InteractionResponse)
+    respuesta._parent = inter
+    respuesta._response_type = None
+    inter.response = respuesta
+    if medida:
+        inter.extras["medicion"] = rp.Medicion("prueba", inter)
+    return inter
+
+
+def test_mensaje_efimero_tras_el_defer_automatico(registro):
+    async def probar():
+        inter = interaccion(registro)
+        rp._diferir_si_tarda(inter, inter.extras["medicion"])
+        return await inter.response.send_message("hola", ephemeral=True, delete_after=5)
+    mensaje = asyncio.run(probar())
+    assert mensaje is not None
+    assert registro == [("defer", False), ("borrar_original",),
+                        ("followup", "hola", True), ("borrar_followup", 5)]
+
+
+def test_defer_efimero_del_handler_borra_el_pensando_publico(registro):
+    async def probar():
+        inter = interaccion(registro)
+        rp._diferir_si_tarda(inter, inter.extras["medicion"])
+        await inter.response.defer(ephemeral=True)
+        await inter.response.send_message("privado", ephemeral=True)
+    asyncio.run(probar())
+    assert registro == [("defer", False), ("borrar_original",), ("followup", "privado", True)]
+
+
+def test_defer_publico_del_handler_conserva_el_pensando(registro):
+    async def probar():
+        inter = interaccion(registro)
+        rp._diferir_si_tarda(inter, inter.extras["medicion"])
+        await inter.response.defer()
+        await inter.response.send_message("público")
+    asyncio.run(probar())
+    assert registro == [("defer", False), ("followup", "público", False)]
+
+
+def test_segunda_respuesta_sin_defer_automatico_falla(registro):
+    async def probar():
+        inter = interaccion(registro)
+        await inter.response.send_message("uno")
+        await inter.response.send_message("dos")
+    with pytest.raises(discord.InteractionResponded):
+        asyncio.run(probar())
+    assert registro == [("send_message", "uno", False)]
+
+
+def test_sin_medicion_no_se_redirige(registro):
+    async def probar():
+        inter = interaccion(registro, medida=False)
+        await inter.response.defer()
+        await inter.response.send_message("tarde")
+    with pytest.raises(discord.InteractionResponded):
+        asyncio.run(probar())
+    assert registro == [("defer", False)]
@@ -0,0 +1,30 @@
+"""Historiales paginados: caché de páginas y límites de Discord"""
+import types
+
+import main as rp
+
+SERVIDOR = 556
+
+
+def usuario(uid):
+    return types.SimpleNamespace(id=uid, display_name=f"Usuario {uid}", display_avatar=None)
+
+
+def test_campos_largos_se_recortan_al_limite_de_discord():
+    with rp.en_servidor(SERVIDOR):
+        rp.data["vehiculos"]["1"] = [{"modelo": "Coche", "matricula": "0000AAA", "motivo": "x" * 3000}]
+        embed, _ = rp.pagina_historial("vehiculos", usuario(1), 0)
+    campo = embed.to_dict()["fields"][0]
+    assert len(campo["value"]) == rp.LIMITE_CAMPO
+    assert campo["value"].endswith("...")
+
+
+def test_cache_de_paginas_acotada(monkeypatch):
+    monkeypatch.setattr(rp, "HISTORIALES_EN_CACHE", 3)
+    with rp.en_servidor(SERVIDOR):
+        for uid in range(10, 20):
+            rp.data["sanciones"][str(uid)] = [{"staff": "s", "motivo": "m", "fecha": "f"}]
+            rp.pagina_historial("sanciones", usuario(uid), 0)
+        rp.pagina_historial("sanciones", usuario(17), 0)
+        claves = list(rp._paginas_historial.actual())
+    assert claves == [("sanciones", "18"), ("sanciones", "19"), ("sanciones", "17")]
@@ -0,0 +1,64 @@
+"""Histograma de latencias y endpoint de las métricas"""
+import asyncio, logging, random, time
+
+import main as rp
+
+
+def test_percentiles_con_error_relativo_dentro_de_un_cubo():
+    azar = random.Random(7)
+    muestras = [azar.lognormvariate(2, 1.5) for _ in range(20000)]
+    hist = rp.HistogramaLatencia()
+    for ms in muestras:
+        hist.registrar(ms)
+    muestras.sort()
+    for p in (50, 90, 99, 99.9):
+        exacto = muestras[int(len(muestras) * p / 100) - 1]
+        assert abs(hist.percentil(p) - exacto) / exacto < 1 / 128
+
+
+def test_muestra_en_el_limite_cuenta_en_su_le():
+    hist = rp.HistogramaLatencia()
+    for ms in (5.0, 5.0, 5.2, 9.9, 10.0, 2500):
+        hist.registrar(ms)
+    assert hist.acumulado_hasta((0.005, 0.01, 1)) == [2, 5, 5]
+
+
+def test_cada_proceso_de_shards_tiene_su_puerto(monkeypatch):
+    monkeypatch.setattr(rp.config, "METRICAS_PUERTO", 9464)
+    monkeypatch.setattr(rp.config, "SHARD_IDS", None)
+    assert rp.puerto_metricas() == 9464
+    monkeypatch.setattr(rp.config, "SHARD_IDS", [2, 3])
+    assert rp.puerto_metricas() == 9466
+    monkeypatch.setattr(rp.config, "METRICAS_PUERTO", 0)
+    assert rp.puerto_metricas() == 0
+
+
+def test_debug_asyncio_lleva_los_callbacks_lentos_al_registro_del_bucle():
+    class Captura(logging.Handler):
+        def __init__(self):
+            super().__init__()
+            self.mensajes = []
+
+        def emit(self, record):
+            self.mensajes.append(record.getMessage())
+
+    captura = Captura()
+    rp.registro_bucle.addHandler(captura)
+    vigilante = rp.VigilanteBucle(0.01, 20, debug_asyncio=True)
+
+    async def probar():
+        vigilante.iniciar()
+        try:
+            await asyncio.sleep(0)
+            time.sleep(0.05)  # bloquea el bucle
+            await asyncio.sleep(0.02)
+        finally:
+            await vigilante.detener()
+    try:
+        asyncio.run(probar())
+    finally:
+        rp.registro_bucle.removeHandler(captura)
+        asyncio_log = logging.getLogger("asyncio")
+        for h in [h for h in asyncio_log.handlers if isinstance(h, rp._AvisosAsyncio)]:
+            asyncio_log.removeHandler(h)
+    assert any(m.startswith("asyncio: Executing ") for m in captura.mensajes)
@@ -0,0 +1,54 @@
+"""Enrutado de cada interacción a la partición de su servidor"""
+import asyncio
+
+import pytest
+
+import main as rp
+
+
+@pytest.fixture(autouse=True)
+def conectado(monkeypatch):
+    # Los servidores parciales de Interaction necesitan el usuario del bot
+    usuario = rp.discord.ClientUser(state=rp.bot._connection, data={
+        "id": "2", "username": "bot", "discriminator": "0", "avatar": None})
+    monkeypatch.setattr(rp.bot._connection, "user", usuario)
+
+
+def recibir(monkeypatch, payload):
+    """Pasa un INTERACTION_CREATE por los parsers del bot y devuelve la
+    partición que ve el listener on_interaction"""
+    vistas = []
+
+    async def on_interaction(interaction):
+        vistas.append(rp.particion_actual())
+
+    async def probar():
+        # El bot no ha arrancado: sus eventos se programan en este bucle
+        monkeypatch.setattr(rp.bot, "loop", asyncio.get_running_loop())
+        rp.bot.add_listener(on_interaction)
+        try:
+            rp.bot._connection.parsers["INTERACTION_CREATE"](payload)
+            await asyncio.sleep(0)
+        finally:
+            rp.bot.remove_listener(on_interaction)
+    asyncio.run(probar())
+    return vistas
+
+
+def componente(**extra):
+    return {
+        "id": "1", "application_id": "2", "type": 3, "token": "x", "version": 1,
+        "attachment_size_limit": 8 * 1024 * 1024,
+        "data": {"custom_id": "nadie:escucha", "component_type": 2},
+        **extra,
+    }
+
+
+def test_interaccion_de_un_servidor_va_a_su_particion(monkeypatch):
+    vistas = recibir(monkeypatch, componente(guild_id="4242"))
+    assert [p.servidor for p in vistas] == [4242]
+    assert vistas[0] is rp.particiones.de(4242)
+
+
+def test_interaccion_sin_servidor_va_a_la_principal(monkeypatch):
+    assert recibir(monkeypatch, componente()) == [rp.particiones.principal()]
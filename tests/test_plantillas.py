@@ -0,0 +1,20 @@
+"""Plantillas de embeds"""
+import main as rp
+
+
+def test_plantilla_rellena_huecos_sin_tocar_la_base():
+    embed = rp.embed_plantilla("saldo_insuficiente", accion="pagar", saldo=5, etiqueta="💰 Necesario", cantidad=10)
+    embed.add_field(name="Extra", value="x")
+    datos = embed.to_dict()
+
+    assert type(embed) is rp.discord.Embed
+    assert datos["description"] == "No tienes suficiente saldo en tu tarjeta para pagar."
+    assert [(c["name"], c["value"]) for c in datos["fields"]] == [("💳 Tu Saldo", "5€"), ("💰 Necesario", "10€"), ("Extra", "x")]
+    assert datos["color"] == rp.config.COLOR_ERROR.value
+    assert datos["footer"]["text"] == rp.config.FOOTER_BANCARIO
+    assert len(rp.PLANTILLAS["saldo_insuficiente"].payload["fields"]) == 2
+
+
+def test_pie_propio():
+    embed = rp.crear_embed_error("Fallo", "algo", footer="Pie")
+    assert (embed.title, embed.description, embed.footer.text) == ("❌ Fallo", "algo", "Pie")
@@ -0,0 +1,23 @@
+"""Capacidades por rol precalculadas: sueldo de /sueldo"""
+import main as rp
+
+AJUSTES = rp.config_servidor(None)
+
+
+def sueldo(*roles):
+    cap = rp.CapacidadesRol(frozenset(roles), AJUSTES)
+    return cap.sueldo, cap.rol_sueldo
+
+
+def test_sin_rol_de_trabajo_cobra_el_sueldo_por_defecto():
+    assert sueldo() == (rp.SUELDO_POR_DEFECTO, None)
+
+
+def test_rol_peor_pagado_que_el_defecto_no_lo_rebaja():
+    rol = 1401538045634674790
+    assert rp.SUELDOS_ROLES[rol] < rp.SUELDO_POR_DEFECTO
+    assert sueldo(rol) == (rp.SUELDO_POR_DEFECTO, None)
+
+
+def test_se_cobra_el_rol_mejor_pagado():
+    assert sueldo(1401538045634674790, 1401538045567565881, 1401538045567565876) == (1800, 1401538045567565876)
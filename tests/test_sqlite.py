@@ -0,0 +1,34 @@
+"""Tiendas en SQLite: caché de registros y recorridos completos"""
+import pytest
+
+import main as rp
+
+
+@pytest.fixture
+def cuentas(tmp_path, monkeypatch):
+    monkeypatch.setattr(rp.config, "ALMACENAMIENTO", "sqlite")
+    particion = rp.Particion(999, str(tmp_path))
+    tienda = particion.almacenes["cuentas"].cargar()
+    for uid in range(100):
+        tienda[str(uid)] = rp.tipar_registro("cuentas", {"tarjeta": uid, "efectivo": 0})
+    tienda.guardar(None, None)
+    tienda.olvidar()
+    return tienda
+
+
+def test_recorrer_la_tabla_no_la_deja_en_cache(cuentas):
+    assert sum(c.tarjeta for _, c in cuentas.items()) == sum(range(100))
+    assert cuentas._cache == {}
+
+
+def test_recorrido_ve_la_cache_sin_escribir(cuentas):
+    cuentas["5"].tarjeta = 500
+    cuentas["nuevo"] = rp.tipar_registro("cuentas", {"tarjeta": 1, "efectivo": 0})
+    del cuentas["7"]
+
+    vistos = dict(cuentas.items())
+    assert vistos["5"] is cuentas["5"] and vistos["5"].tarjeta == 500
+    assert vistos["nuevo"].tarjeta == 1
+    assert "7" not in vistos
+    assert len(vistos) == len(cuentas) == 100
+    assert set(cuentas._cache) == {"5", "nuevo"}
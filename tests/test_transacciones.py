@@ -0,0 +1,74 @@
+"""Transacciones económicas: deshacer y respuestas fuera de los bloqueos"""
+import asyncio, types
+
+import pytest
+
+import main as rp
+
+SERVIDOR = 555
+
+
+def interaccion(uid, bloqueado):
+    """Interacción mínima que anota, al responder, si `uid` sigue bloqueado"""
+    respuestas = []
+
+    async def send_message(content=None, **kwargs):
+        respuestas.append((content or kwargs["embed"].title, bloqueado()))
+
+    return types.SimpleNamespace(
+        user=types.SimpleNamespace(id=uid),
+        response=types.SimpleNamespace(send_message=send_message),
+    ), respuestas
+
+
+def test_excepcion_deshace_los_cambios():
+    async def probar():
+        with rp.en_servidor(SERVIDOR):
+            rp.data["cuentas"]["1"] = rp.tipar_registro("cuentas", {"tarjeta": 10, "efectivo": 0})
+            with pytest.raises(ZeroDivisionError):
+                async with rp.transaccion("1") as tx:
+                    tx.registro("cuentas", "1").tarjeta -= 10
+                    tx.registro("cuentas", "2", rp.tipar_registro("cuentas", {"tarjeta": 10, "efectivo": 0}))
+                    1 / 0
+            return rp.data["cuentas"]["1"].tarjeta, "2" in rp.data["cuentas"]
+    assert asyncio.run(probar()) == (10, False)
+
+
+def test_rechazo_se_responde_con_los_bloqueos_sueltos():
+    async def probar():
+        with rp.en_servidor(SERVIDOR):
+            rp.data["cuentas"]["3"] = rp.tipar_registro("cuentas", {"tarjeta": 5, "efectivo": 0})
+            bloqueos = rp.gestor_bloqueos.actual()._bloqueos
+            bloqueado = lambda: any(b.locked() for b in bloqueos.values())
+            inter, respuestas = interaccion(3, bloqueado)
+            destino = types.SimpleNamespace(id=4, mention="<@4>")
+            tipo = rp.app_commands.Choice(name="Bancario", value="bancario")
+            await rp.tree.get_command("dinero-dar").callback(inter, destino, 100, tipo)
+            return respuestas
+    respuestas = asyncio.run(probar())
+    assert len(respuestas) == 1
+    assert respuestas[0][1] is False
+
+
+def test_cuenta_eliminar_guarda_el_saldo_y_borra_la_cuenta(monkeypatch):
+    monkeypatch.setattr(rp, "es_staff", lambda usuario: True)
+    enviados = []
+
+    async def send_message(content=None, **kwargs):
+        enviados.append(kwargs["embed"])
+
+    persona = lambda uid: types.SimpleNamespace(
+        id=uid, mention=f"<@{uid}>", display_name=f"usuario{uid}",
+        display_avatar=types.SimpleNamespace(url="https://cdn.discordapp.com/embed/avatars/0.png"))
+    inter = types.SimpleNamespace(user=persona(1),
+                                  response=types.SimpleNamespace(send_message=send_message))
+
+    async def probar():
+        with rp.en_servidor(SERVIDOR):
+            rp.data["cuentas"]["9"] = rp.tipar_registro("cuentas", {"banco": "BBVA", "tarjeta": 70, "efectivo": 5})
+            await rp.tree.get_command("cuenta-eliminar").callback(inter, persona(9))
+            return "9" in rp.data["cuentas"], rp.data["cuentas_eliminadas"][-1]
+    sigue, copia = asyncio.run(probar())
+    assert not sigue
+    assert (copia["banco"], copia["saldo_tarjeta"], copia["saldo_efectivo"]) == ("BBVA", 70, 5)
+    assert enviados[0].title == "🗑️ Cuenta Bancaria Eliminada"